@@ -0,0 +1,302 @@
+# BENCHMARK SUITE OF THE SIMILARITY QUERY PATH, ON DETERMINISTIC SYNTHETIC CRASH DUMPS.
+# python -m crashsimilarity.bench --sizes 1000 10000 --output before.json
+# python -m crashsimilarity.bench --sizes 1000 10000 --compare before.json
+from crashsimilarity import stacktrace
+from crashsimilarity.cache import DownloaderCache, LRUCache
+from crashsimilarity.models import distances, doc2vec, quantization, word2vec
+from crashsimilarity.stacktrace import StackTraceProcessor, StackTracesGetter
+from crashsimilarity.store import TraceStore
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+STAGES = ['ingestion', 'training', 'wcd', 'rwmd', 'wmd', 'top_similar_traces', 'signature_similarity', 'edit_distance_structural', 'caches']
+
+NAMESPACES = ['js', 'js::jit', 'js::gc', 'mozilla', 'mozilla::dom', 'mozilla::net', 'mozilla::layers', 'mozilla::ipc', 'nsThread', 'nsTimerImpl']
+CLASSES = ['GCMarker', 'BaselineCompiler', 'Element', 'HttpChannel', 'CompositorBridge', 'MessageChannel', 'EventQueue', 'RefPtr<T>']
+VERBS = ['Run', 'Process', 'Mark', 'Dispatch', 'Paint', 'Collect', 'Invoke', 'OnMessageReceived', '~Destructor']
+MODULES = ['ntdll.dll', 'kernel32.dll', 'KERNELBASE.dll', 'libc.so.6', 'libpthread.so.0', 'CoreFoundation']
+PREFIXES = ['', '', '', 'shutdownhang | ', 'OOM | small | ', 'IPCError-browser | ']
+
+
+def synthetic_crashes(count, signatures=None, functions=None, seed=0):
+    """
+    Crash dump records shaped like the Socorro ones: the crashes of a signature come from a few stacks and differ by some
+    of their frames, frequent functions are shared by many stacks, some frames are module addresses and some crashes
+    have frames of xul without symbols
+    :param signatures: number of distinct signatures, with Zipf distributed crashes (Default count / 20)
+    :param functions: number of distinct functions (Default count / 2)
+    :return: list of {'proto_signature', 'signature', 'uuid'}
+    """
+    rng = random.Random(seed)
+    signatures = signatures or max(count // 20, 1)
+    functions = functions or max(count // 2, 100)
+    names = ['{}::{}::{}{}'.format(rng.choice(NAMESPACES), rng.choice(CLASSES), rng.choice(VERBS), i) for i in range(functions)]
+
+    def function():
+        # Pareto distributed ranks, so that a few functions are in most of the stacks.
+        return names[min(int(rng.paretovariate(1.2)) - 1, functions - 1) if rng.random() < 0.7 else rng.randrange(functions)]
+
+    def frame():
+        if rng.random() < 0.15:
+            return '{}@0x{:x}'.format(rng.choice(MODULES), rng.randrange(1 << 20))
+        return function()
+
+    families = []
+    for _ in range(signatures):
+        top = function()
+        stacks = [[top] + [frame() for _ in range(rng.randint(3, 30))] for _ in range(rng.randint(1, 4))]
+        families.append((rng.choice(PREFIXES) + top, stacks))
+    weights = [1.0 / (rank + 1) for rank in range(signatures)]
+
+    crashes = []
+    for signature, stacks in rng.choices(families, weights, k=count):
+        stack = rng.choice(stacks)
+        frames = [stack[0]]
+        for f in stack[1:]:
+            if rng.random() < 0.05:
+                frames.append(frame())
+            if rng.random() < 0.9:
+                frames.append(f)
+        if rng.random() < 0.02:
+            frames.insert(rng.randrange(1, len(frames) + 1), 'xul.dll@0x{:x}'.format(rng.randrange(1 << 24)))
+        crashes.append({'proto_signature': ' | '.join(frames), 'signature': signature, 'uuid': str(uuid.UUID(int=rng.getrandbits(128)))})
+    return crashes
+
+
+def write_dumps(crashes, directory, days=3):
+    """Split the crashes in one crash dump file per day, named like the downloaded ones"""
+    paths = []
+    for day in range(days):
+        path = os.path.join(directory, 'firefox-crashes-2016-11-{:02d}.json'.format(day + 1))
+        with open(path, 'w') as f:
+            for crash in crashes[day::days]:
+                f.write(json.dumps(crash) + '\n')
+        paths.append(path)
+    return paths
+
+
+def _timed(function, *args, **kwargs):
+    """:return: (result of the call, wall time in seconds)"""
+    t = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - t
+
+
+def bench_ingestion(paths, workers):
+    stores, convert = _timed(lambda: [TraceStore.open(path) for path in paths])
+    _, open_seconds = _timed(lambda: [TraceStore.open(path) for path in paths])
+    traces, process = _timed(lambda: list(StackTraceProcessor.process_stores(paths, 10, workers=workers)))
+    return {'crashes': sum(map(len, stores)), 'traces': len(traces), 'workers': workers,
+            'convert_seconds': convert, 'open_seconds': open_seconds, 'process_seconds': process}
+
+
+def bench_training(model_class, paths, workers):
+    model, train = _timed(model_class, paths, force_train=True, ingest_workers=workers)
+    _, load = _timed(model_class, paths, ingest_workers=workers)
+    return model, {'traces': len(model.get_corpus()), 'vocabulary': len(model.get_model().wv.vocab),
+                   'train_seconds': train, 'load_seconds': load}
+
+
+def bench_wcd(model, queries):
+    _, seconds = _timed(lambda: [model.wcd_distances(query_indices) for query_indices in queries])
+    return {'queries': len(queries), 'seconds_per_query': seconds / len(queries)}
+
+
+def bench_rwmd(model, queries):
+    model._distance_columns.clear()
+    all_distances, columns = _timed(lambda: [model._query_distances(query_indices) for query_indices in queries])
+    _, seconds = _timed(lambda: [model.rwmd_distances(d) for d in all_distances])
+    return {'queries': len(queries), 'distance_columns_seconds_per_query': columns / len(queries), 'seconds_per_query': seconds / len(queries)}
+
+
+def bench_wmd(model, queries, candidates=50):
+    """WMD of the candidates of every query with the smallest RWMD, as confirmed by top_similar_traces"""
+    computed = 0
+    seconds = 0.0
+    for query_indices in queries:
+        all_distances = model._query_distances(query_indices)
+        doc_ids = np.argsort(model.rwmd_distances(all_distances), kind='stable')[:candidates].tolist()
+        wmds, query_seconds = _timed(lambda: list(model.wmdistances(query_indices, all_distances, doc_ids)))
+        computed += len(wmds)
+        seconds += query_seconds
+    return {'wmds': computed, 'seconds_per_wmd': seconds / max(computed, 1)}
+
+
+def bench_top_similar_traces(model, stack_traces, top=10):
+    model._results.clear()
+    model._distance_columns.clear()
+    model.tier_counts.clear()
+    _, cold = _timed(lambda: [model.top_similar_traces(stack_trace, top) for stack_trace in stack_traces])
+    counts = dict(model.tier_counts)
+    _, cached = _timed(lambda: [model.top_similar_traces(stack_trace, top) for stack_trace in stack_traces])
+    return {'queries': len(stack_traces), 'top': top, 'tier_counts': counts,
+            'seconds_per_query': cold / len(stack_traces), 'cached_seconds_per_query': cached / len(stack_traces)}
+
+
+def bench_signature_similarity(model, paths, signatures, top=10):
+    full, full_seconds = _timed(lambda: [model.signature_similarity(paths, s, s, download=False) for s in signatures])
+    _, top_seconds = _timed(lambda: [model.signature_similarity(paths, s, s, top, top, download=False) for s in signatures])
+    return {'signatures': len(signatures), 'pairs': sum(map(len, full)), 'top': top,
+            'seconds_per_signature': full_seconds / len(signatures), 'top_bottom_seconds_per_signature': top_seconds / len(signatures)}
+
+
+def bench_edit_distance_structural(traces, queries=10, python_pairs=200):
+    pairs = list(zip(traces, traces[1:]))[:python_pairs]
+    _, python = _timed(lambda: [distances.edit_distance_structural(trace1, trace2) for trace1, trace2 in pairs])
+    _, batched = _timed(lambda: [distances.edit_distances_structural(traces[i], traces) for i in range(queries)])
+    _, pairwise = _timed(distances.pairwise_edit_distances_structural, traces)
+    return {'traces': len(traces), 'python_seconds_per_pair': python / max(len(pairs), 1),
+            'batched_seconds_per_pair': batched / (queries * len(traces)),
+            'pairwise_seconds_per_pair': pairwise / max(len(traces) * (len(traces) - 1) // 2, 1)}
+
+
+def bench_caches(directory, operations=10000, downloads=1000):
+    lru = LRUCache(operations // 2)
+    _, lru_set = _timed(lambda: [lru.__setitem__(i, i) for i in range(operations)])
+    _, lru_get = _timed(lambda: [lru.get(i) for i in range(operations)])
+
+    downloader_cache = DownloaderCache(file_name=os.path.join(directory, 'downloader_cache.sqlite'))
+    value = {'hits': [{'proto_signature': 'a | b | c', 'signature': 'a'}] * 10}
+    _, download_set = _timed(lambda: [downloader_cache.__setitem__(('bench', i), value) for i in range(downloads)])
+    _, download_get = _timed(lambda: [downloader_cache[('bench', i)] for i in range(downloads)])
+    return {'lru_set_seconds_per_op': lru_set / operations, 'lru_get_seconds_per_op': lru_get / operations,
+            'downloader_set_seconds_per_op': download_set / downloads, 'downloader_get_seconds_per_op': download_get / downloads}
+
+
+def bench_size(size, model_class, stages, queries, seed, workers, directory):
+    """:return: {stage: measures} of the selected stages on a corpus of size synthetic crashes"""
+    results = {}
+    crashes = synthetic_crashes(size, seed=seed)
+    paths = write_dumps(crashes, directory)
+    if 'ingestion' in stages:
+        results['ingestion'] = bench_ingestion(paths, workers)
+
+    if set(stages) & {'training', 'wcd', 'rwmd', 'wmd', 'top_similar_traces', 'signature_similarity'}:
+        model, training = bench_training(model_class, paths, workers)
+        if 'training' in stages:
+            results['training'] = training
+
+        doc_ids = random.Random(seed).sample(range(len(model.get_corpus())), min(queries, len(model.get_corpus())))
+        query_indices = [np.unique(model.get_corpus().indices(doc_id)) for doc_id in doc_ids]
+        for stage, bench in [('wcd', bench_wcd), ('rwmd', bench_rwmd), ('wmd', bench_wmd)]:
+            if stage in stages:
+                results[stage] = bench(model, query_indices)
+        if 'top_similar_traces' in stages:
+            results['top_similar_traces'] = bench_top_similar_traces(model, [' | '.join(model.get_trace(doc_id)[0]) for doc_id in doc_ids])
+        if 'signature_similarity' in stages:
+            results['signature_similarity'] = bench_signature_similarity(model, paths, StackTracesGetter.get_top_signatures(paths, 5))
+
+    if 'edit_distance_structural' in stages:
+        traces = [StackTraceProcessor.preprocess(crash['proto_signature'], 10) for crash in crashes[:200]]
+        results['edit_distance_structural'] = bench_edit_distance_structural(traces)
+    if 'caches' in stages:
+        results['caches'] = bench_caches(directory)
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, model='doc2vec', stages=STAGES, queries=20, seed=0, workers=1, work_dir=None):
+    """
+    :param work_dir: directory of the crash dumps and of the models, which are trained in its trained_models directory
+                     (Default a temporary directory, removed once done)
+    :return: {'meta': environment of the run, 'sizes': {size: {stage: measures}}}
+    """
+    model_class = doc2vec.Doc2Vec if model == 'doc2vec' else word2vec.Word2Vec
+    report = {
+        'meta': {
+            'commit': _commit(), 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count(), 'model': model, 'seed': seed, 'queries': queries, 'workers': workers,
+            'native': {'normalizer': stacktrace.FrameNormalizer is not None, 'edit_distances': distances.native_edit_distances is not None,
+                       'dot_int8': quantization.native_dot_int8 is not None},
+        },
+        'sizes': {},
+    }
+    temporary = work_dir is None
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='crashsimilarity_bench_') if temporary else work_dir)
+    cwd = os.getcwd()
+    try:
+        for size in sizes:
+            directory = os.path.join(work_dir, str(size))
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            # The models are saved relatively to the working directory.
+            os.chdir(directory)
+            report['sizes'][str(size)] = bench_size(size, model_class, stages, queries, seed, workers, directory)
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def compare(baseline, report, threshold=1.25, min_seconds=1e-3):
+    """
+    :param threshold: ratio over which a timing is a regression
+    :param min_seconds: timings under it in both reports are ignored, as they are mostly noise
+    :return: list of (path of the timing, baseline seconds, seconds) of the regressions
+    """
+    regressions = []
+
+    def walk(old, new, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                walk(old[key], value, path + [key])
+            elif 'seconds' in key and max(value, old[key]) >= min_seconds and value > old[key] * threshold:
+                regressions.append(('.'.join(path + [key]), old[key], value))
+
+    walk(baseline.get('sizes', {}), report['sizes'], [])
+    return regressions
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the similarity query path on synthetic crash dumps')
+    parser.add_argument('--sizes', help='Numbers of crashes of the synthetic corpora(Default 1000 10000)', default=[1000, 10000], nargs='+', type=int)
+    parser.add_argument('--model', help='Embedding algorithm(Default doc2vec)', default='doc2vec', choices=['doc2vec', 'word2vec'])
+    parser.add_argument('--stages', help='Stages to measure(Default all of them)', default=STAGES, nargs='+', choices=STAGES)
+    parser.add_argument('--queries', help='Number of corpus traces used as queries(Default 20)', default=20, type=int)
+    parser.add_argument('--seed', help='Seed of the synthetic crashes and of the queries(Default 0)', default=0, type=int)
+    parser.add_argument('--workers', help='Number of processes reading the crash dumps(Default 1)', default=1, type=int)
+    parser.add_argument('--work-dir', help='Directory of the crash dumps and of the models(Default a temporary directory)', default=None)
+    parser.add_argument('--output', help='JSON report file(Default standard output)', default=None)
+    parser.add_argument('--compare', help='JSON report of a previous run, whose timings are compared with this one', default=None)
+    parser.add_argument('--threshold', help='Ratio over which a timing is a regression(Default 1.25)', default=1.25, type=float)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    report = run(args.sizes, args.model, args.stages, args.queries, args.seed, args.workers, args.work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for path, old, new in regressions:
+            print('regression {}: {:.6f} s -> {:.6f} s ({:.2f}x)'.format(path, old, new, new / old if old else float('inf')), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
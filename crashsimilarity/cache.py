@@ -1,6 +1,15 @@
+import os
 import pickle
+import sqlite3
+import threading
+import time
 from abc import abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import date, timedelta
 
+from crashsimilarity import utils
 from crashsimilarity.stacktrace import StackTraceProcessor
 
 
@@ -30,28 +39,186 @@ class BaseCache(object):
         if not file_name:
             file_name = self.file_name
         rv = self.load(file_name)
-        return rv if rv else self.build(data)
+        return rv if rv is not None else self.build(data, file_name)
 
 
-class DownloaderCache(dict, BaseCache):
-    def __init__(self, *args, **kwargs):
-        self.update(*args, **kwargs)
-        BaseCache.__init__(self, "downloader")
+class LRUCache(object):
+    """
+    Bounded in-memory mapping that evicts its least recently used entries, safe to share between threads
+    Attributes:
+        hits, misses: number of get calls that found their key or not
+    """
+    def __init__(self, max_size, size_of=None):
+        """
+        :param max_size: maximum total size of the values
+        :param size_of: size of a value (Default 1, max_size is then a number of entries)
+        """
+        self.max_size = max_size
+        self._size_of = size_of if size_of else lambda value: 1
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    def __setitem__(self, k, v):
-        super().__setitem__(k, v)
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def __setitem__(self, key, value):
+        size = self._size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                self._size -= self._entries.popitem(last=False)[1][1]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class DownloaderCache(MutableMapping, BaseCache):
+    """
+    Downloads cached in a SQLite database, shared by all the threads and processes that use the same file
+    Every write only stores its own entry. Entries whose key contains a date older than max_age are expired,
+    and the least recently used entries are evicted once the values take more than max_size bytes
+    """
+    _SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, pickled_key BLOB, value BLOB, day TEXT, size INTEGER, accessed REAL);
+        CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+        CREATE INDEX IF NOT EXISTS entries_day ON entries (day);
+        CREATE TABLE IF NOT EXISTS total (size INTEGER);
+        INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+    '''
+    # Number of writes between two expirations.
+    EXPIRE_EVERY = 1000
+
+    def __init__(self, data=None, file_name=None, max_age=timedelta(days=1), max_size=256 * 1024 * 1024):
+        """
+        :param max_age: entries whose key contains a date older than max_age before today are expired
+        :param max_size: total size in bytes of the pickled values kept
+        """
+        BaseCache.__init__(self, "downloader", file_name if file_name else 'downloader_cache.sqlite')
+        self.max_age = max_age
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+        self.expire()
+        if data:
+            self.update(data)
+
+    def _db(self):
+        # sqlite3 connections can't be shared by threads, nor across a fork.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = sqlite3.connect(self.file_name, timeout=60, isolation_level=None)
+            self._local.db.execute('PRAGMA journal_mode=WAL')
+            self._local.db.executescript(self._SCHEMA)
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
         try:
-            self.dump()
-        except AttributeError:
-            pass
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _day(key):
+        parts = key if isinstance(key, tuple) else (key,)
+        return next((part.strftime('%Y-%m-%d') for part in parts if isinstance(part, date)), None)
+
+    def _cutoff(self):
+        return (utils.utc_today() - self.max_age).strftime('%Y-%m-%d')
+
+    def __getitem__(self, k):
+        row = self._db().execute('SELECT value FROM entries WHERE key = ? AND (day IS NULL OR day >= ?)', (repr(k), self._cutoff())).fetchone()
+        if row is None:
+            raise KeyError(k)
+        self._db().execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), repr(k)))
+        return pickle.loads(row[0])
+
+    def __contains__(self, k):
+        return self._db().execute('SELECT 1 FROM entries WHERE key = ? AND (day IS NULL OR day >= ?)', (repr(k), self._cutoff())).fetchone() is not None
+
+    def __setitem__(self, k, v):
+        value = pickle.dumps(v)
+        with self._transaction() as db:
+            old = db.execute('SELECT size FROM entries WHERE key = ?', (repr(k),)).fetchone()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', (repr(k), pickle.dumps(k), value, self._day(k), len(value), time.time()))
+            db.execute('UPDATE total SET size = size + ?', (len(value) - (old[0] if old else 0),))
+            self._evict(db)
+        self._writes += 1
+        if self._writes % self.EXPIRE_EVERY == 0:
+            self.expire()
+
+    def __delitem__(self, k):
+        with self._transaction() as db:
+            old = db.execute('SELECT size FROM entries WHERE key = ?', (repr(k),)).fetchone()
+            if old is None:
+                raise KeyError(k)
+            db.execute('DELETE FROM entries WHERE key = ?', (repr(k),))
+            db.execute('UPDATE total SET size = size - ?', old)
+
+    def __iter__(self):
+        rows = self._db().execute('SELECT pickled_key FROM entries WHERE day IS NULL OR day >= ?', (self._cutoff(),)).fetchall()
+        return (pickle.loads(row[0]) for row in rows)
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM entries WHERE day IS NULL OR day >= ?', (self._cutoff(),)).fetchone()[0]
+
+    def _evict(self, db):
+        total = db.execute('SELECT size FROM total').fetchone()[0]
+        while total > self.max_size:
+            rows = db.execute('SELECT key, size FROM entries ORDER BY accessed LIMIT 64').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+                if total <= self.max_size:
+                    break
+            db.execute('UPDATE total SET size = ?', (total,))
+
+    def expire(self):
+        """Delete the entries whose key contains a date older than max_age"""
+        with self._transaction() as db:
+            if db.execute('DELETE FROM entries WHERE day < ?', (self._cutoff(),)).rowcount:
+                db.execute('UPDATE total SET size = (SELECT COALESCE(SUM(size), 0) FROM entries)')
+
+    def dump(self, file_name=None):
+        """Every write is already in the database"""
+        pass
+
+    @staticmethod
+    def load(file_name):
+        return DownloaderCache(file_name=file_name) if os.path.exists(file_name) else None
 
     @staticmethod
     def build(data=None, file_name=None):
-        d = DownloaderCache(data) if data else DownloaderCache()
-        if file_name:
-            d.file_name = file_name
-        d.dump()
-        return d
+        return DownloaderCache(data, file_name)
 
 
 class TracesCache(BaseCache):
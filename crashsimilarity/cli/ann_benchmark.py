@@ -0,0 +1,54 @@
+# CLI INTERFACE THAT COMPARES THE RECALL AND LATENCY OF THE ANN CANDIDATE STAGE WITH THE EXHAUSTIVE SEARCH.
+from crashsimilarity.downloader import SocorroDownloader
+from crashsimilarity.models import doc2vec, word2vec
+import argparse
+import random
+import sys
+import time
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark approximate top similar traces against the exhaustive search')
+    parser.add_argument('--product', required=True, help='Product for which crash data is needed to be downloaded')
+    parser.add_argument('--days', help='Number of days of crash data to train on(Default 7)', default=7, type=int)
+    parser.add_argument('--model', help='Embedding algorithm(Default doc2vec)', default='doc2vec', choices=['doc2vec', 'word2vec'])
+    parser.add_argument('--queries', help='Number of corpus traces used as queries(Default 100)', default=100, type=int)
+    parser.add_argument('--top', help='Number of similar traces per query(Default 10)', default=10, type=int)
+    parser.add_argument('--lists', help='Number of lists of the index(Default square root of the corpus size)', default=None, type=int)
+    parser.add_argument('--probes', help='Numbers of probed lists to evaluate(Default 1 2 4 8 16 32)', default=[1, 2, 4, 8, 16, 32], nargs='+', type=int)
+    return parser.parse_args(args)
+
+
+def run_queries(model, queries, top, ann_probes=None):
+    t = time.time()
+    results = [model.top_similar_traces(query, top, ann_probes=ann_probes) for query in queries]
+    return results, (time.time() - t) / len(queries)
+
+
+def recall(results, expected):
+    """Fraction of the exhaustive top similar traces that are found"""
+    found = total = 0
+    for result, exact in zip(results, expected):
+        exact_ids = set(doc_id for doc_id, _ in exact)
+        found += len(exact_ids & set(doc_id for doc_id, _ in result))
+        total += len(exact_ids)
+    return float(found) / total if total else 1.0
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    paths = SocorroDownloader.get_dump_paths(days=args.days, product=args.product)
+    model = (doc2vec.Doc2Vec if args.model == 'doc2vec' else word2vec.Word2Vec)(paths)
+
+    doc_ids = random.Random(0).sample(range(len(model.get_corpus())), min(args.queries, len(model.get_corpus())))
+    queries = [' | '.join(model.get_trace(doc_id)[0]) for doc_id in doc_ids]
+
+    t = time.time()
+    model.build_ann_index(args.lists)
+    print('index built in {:.2f} s'.format(time.time() - t))
+
+    expected, latency = run_queries(model, queries, args.top)
+    print('exhaustive: {:.2f} ms/query'.format(latency * 1000))
+    for probes in args.probes:
+        results, latency = run_queries(model, queries, args.top, probes)
+        print('probes {:>4}: {:.2f} ms/query, recall@{} {:.3f}'.format(probes, latency * 1000, args.top, recall(results, expected)))
@@ -0,0 +1,75 @@
+# CLI INTERFACE THAT COMPARES THE THROUGHPUT OF THE BATCH FRAME NORMALIZER WITH StackTraceProcessor.preprocess.
+from crashsimilarity.stacktrace import FrameTable, StackTraceProcessor
+import argparse
+import random
+import sys
+import time
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the normalization of a synthetic crash dump')
+    parser.add_argument('--lines', help='Number of proto signatures of the synthetic dump(Default 1000000)', default=1000000, type=int)
+    parser.add_argument('--functions', help='Number of distinct functions(Default 20000)', default=20000, type=int)
+    parser.add_argument('--take', help='Number of top frames kept(Default 10)', default=10, type=int)
+    parser.add_argument('--chunk-size', help='Number of proto signatures normalized at once(Default 10000)', default=10000, type=int)
+    return parser.parse_args(args)
+
+
+def synthetic_proto_signatures(lines, functions=20000, seed=0):
+    """
+    Proto signatures shaped like the Socorro ones: frequent functions are shared by many crashes,
+    some frames are module addresses and some crashes have frames without symbols
+    """
+    rng = random.Random(seed)
+    names = ['{}::{}{}'.format(rng.choice(['js', 'mozilla', 'nsThread', 'js::jit', 'mozilla::dom']), rng.choice(['Get', 'Run', 'Process', 'Mark']), i)
+             for i in range(functions)]
+    modules = ['{}@0x'.format(module) for module in ['ntdll.dll', 'kernel32.dll', 'KERNELBASE.dll', 'libc.so.6', 'CoreFoundation', 'xul.dll']]
+
+    def frame():
+        if rng.random() < 0.15:
+            return '{}{:x}'.format(rng.choice(modules), rng.randrange(1 << 20))
+        return names[min(int(rng.paretovariate(1.2)) - 1, functions - 1) if rng.random() < 0.7 else rng.randrange(functions)]
+
+    return [' | '.join(frame() for _ in range(rng.randint(3, 30))) for _ in range(lines)]
+
+
+def pure_python(proto_signatures, take):
+    return [None if StackTraceProcessor.should_skip(p) else StackTraceProcessor.preprocess(p, take) for p in proto_signatures]
+
+
+def batch(proto_signatures, take, chunk_size):
+    frame_table = FrameTable()
+    results = []
+    for first in range(0, len(proto_signatures), chunk_size):
+        results.append(frame_table.normalize(proto_signatures[first:first + chunk_size], take))
+    return frame_table, results
+
+
+def same_results(expected, frame_table, results):
+    i = 0
+    for ids, offsets, skipped in results:
+        for j in range(len(skipped)):
+            frames = None if skipped[j] else [frame_table.normalized_frames[k] for k in ids[offsets[j]:offsets[j + 1]]]
+            if frames != expected[i]:
+                return False
+            i += 1
+    return i == len(expected)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    t = time.time()
+    proto_signatures = synthetic_proto_signatures(args.lines, args.functions)
+    print('{} proto signatures generated in {:.2f} s'.format(len(proto_signatures), time.time() - t))
+
+    t = time.time()
+    expected = pure_python(proto_signatures, args.take)
+    python_time = time.time() - t
+    print('preprocess: {:.2f} s, {:.0f} lines/s'.format(python_time, len(proto_signatures) / python_time))
+
+    t = time.time()
+    frame_table, results = batch(proto_signatures, args.take, args.chunk_size)
+    batch_time = time.time() - t
+    print('FrameTable ({}): {:.2f} s, {:.0f} lines/s, {} normalized frames'.format(
+        'native' if frame_table._normalizer else 'Python', batch_time, len(proto_signatures) / batch_time, len(frame_table.normalized_frames)))
+    print('speedup: {:.2f}x, same results: {}'.format(python_time / batch_time, same_results(expected, frame_table, results)))
@@ -0,0 +1,39 @@
+# CLI INTERFACE THAT SERVES SIMILARITY QUERIES OVER HTTP WITHOUT RETRAINING THE MODEL FOR EVERY QUERY.
+from crashsimilarity.downloader import SocorroDownloader
+from crashsimilarity.models import doc2vec, word2vec
+from crashsimilarity.server import QueryServer
+import argparse
+import logging
+import sys
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Serve top similar traces and signature similarity queries')
+    parser.add_argument('--product', required=True, help='Product for which crash data is needed to be downloaded')
+    parser.add_argument('--days', help='Number of days of crash data to train on(Default 7)', default=7, type=int)
+    parser.add_argument('--model', help='Embedding algorithm(Default doc2vec)', default='doc2vec', choices=['doc2vec', 'word2vec'])
+    parser.add_argument('--download', help='Download the crash data before loading the model', action='store_true')
+    parser.add_argument('--incremental', help='Update the latest model with the new days of crash data instead of training a new one', action='store_true')
+    parser.add_argument('--download-traces', help='Download the traces of the signatures of every signature query from Socorro, instead of reading them from the crash data', action='store_true')
+    parser.add_argument('--host', help='Address to listen on(Default 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on(Default 8000)', default=8000, type=int)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+
+    if args.download:
+        SocorroDownloader.download_and_save_crashes(days=args.days, product=args.product)
+
+    algo = doc2vec.Doc2Vec if args.model == 'doc2vec' else word2vec.Word2Vec
+
+    def load_model():
+        # Reloading picks up the model trained today by another process, if any.
+        paths = SocorroDownloader.get_dump_paths(days=args.days, product=args.product)
+        return algo(paths, incremental=args.incremental), paths
+
+    server = QueryServer((args.host, args.port), load_model, args.download_traces)
+    logging.info('Serving on {}:{}'.format(args.host, args.port))
+    server.serve_forever()
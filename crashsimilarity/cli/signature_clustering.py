@@ -0,0 +1,40 @@
+# CLI INTERFACE THAT FINDS THE GROUPS OF SIGNATURES WHOSE STACK TRACES ARE SIMILAR, OVER THE WHOLE CORPUS.
+from crashsimilarity.downloader import SocorroDownloader
+from crashsimilarity.models import doc2vec, word2vec
+from crashsimilarity.models.clustering import cluster_signatures
+import argparse
+import json
+import logging
+import sys
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Cluster the signatures of the crashes of the last days')
+    parser.add_argument('--product', required=True, help='Product for which crash data is needed to be downloaded')
+    parser.add_argument('--days', help='Number of days of crash data to cluster(Default 7)', default=7, type=int)
+    parser.add_argument('--model', help='Embedding algorithm(Default doc2vec)', default='doc2vec', choices=['doc2vec', 'word2vec'])
+    parser.add_argument('--k', help='Number of nearest traces searched per trace(Default 10)', default=10, type=int)
+    parser.add_argument('--probes', help='Number of ANN lists searched per trace, 0 for the whole corpus(Default 8)', default=8, type=int)
+    parser.add_argument('--max-distance', help='WMD under which two traces are linked(Default 1.0)', default=1.0, type=float)
+    parser.add_argument('--min-links', help='Number of linked traces for two signatures to be clustered(Default 2)', default=2, type=int)
+    parser.add_argument('--workers', help='Number of processes(Default one per core)', default=None, type=int)
+    parser.add_argument('--checkpoint-dir', help='Directory where the progress is saved, to resume an interrupted job', default=None)
+    parser.add_argument('--output', help='JSON file the clusters and timings are written to(Default standard output)', default=None)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
+
+    paths = SocorroDownloader.get_dump_paths(days=args.days, product=args.product)
+    model = (doc2vec.Doc2Vec if args.model == 'doc2vec' else word2vec.Word2Vec)(paths)
+
+    clusters, graph, timings = cluster_signatures(model, args.k, args.probes or None, args.max_distance, args.min_links,
+                                                  args.workers, args.checkpoint_dir)
+    report = {'traces': len(graph), 'clusters': clusters.clusters, 'timings': timings}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
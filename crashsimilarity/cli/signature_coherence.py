@@ -1,38 +1,53 @@
-# CLI INTERFACE THAT EVALUATES THE SIMILARITY BETWEEN STACK TRACES IN A GIVEN SIGNATURE.
+# CLI INTERFACE THAT EVALUATES THE SIMILARITY BETWEEN STACK TRACES IN A GIVEN SIGNATURE, OR IN EACH OF THE TOP SIGNATURES.
 from crashsimilarity.downloader import SocorroDownloader
-from crashsimilarity import crash_similarity
-import sys
+from crashsimilarity.models import doc2vec, word2vec
+from crashsimilarity.models.coherence import coherence_report, write_report
+from crashsimilarity.stacktrace import StackTracesGetter
 import argparse
+import logging
+import sys
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Test Signature Coherence')
-    parser.add_argument('--signature', required=True, help='Signature')
+    parser.add_argument('--signature', help='Signature, whose top similar and different stack traces are printed')
     parser.add_argument('--product', required=True, help='Product for which crash data is needed to be downloaded')
+    parser.add_argument('--days', help='Number of days of crash data(Default 7)', default=7, type=int)
+    parser.add_argument('--model', help='Embedding algorithm(Default doc2vec)', default='doc2vec', choices=['doc2vec', 'word2vec'])
+    parser.add_argument('--no-download', help='Use the crash data already downloaded instead of downloading it before loading the model', action='store_true')
     parser.add_argument('--top', help='Number of top similar and different stack traces(Default 10)', default=10, type=int)
+    parser.add_argument('--top-signatures', help='Number of signatures with the most crashes evaluated without --signature(Default 300)', default=300, type=int)
+    parser.add_argument('--traces', help='Maximum number of distinct stack traces per signature in the report(Default 100)', default=100, type=int)
+    parser.add_argument('--workers', help='Number of processes evaluating the signatures(Default one per core)', default=None, type=int)
+    parser.add_argument('--output', help='Report file, CSV if it ends with .csv, JSON otherwise(Default coherence.json)', default='coherence.json')
     return parser.parse_args(args)
 
 
 if __name__ == '__main__':
     args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO)
 
     # Downloads some data (e.g. the past 7 days)
-    SocorroDownloader.download_and_save_crashes(days=7, product=args.product)
-    paths = SocorroDownloader.get_dump_paths(days=7, product=args.product)
-
-    # Reads the corpus
-    corpus = crash_similarity.read_corpus(paths)
-
-    # Trains the model on that data
-    model = crash_similarity.train_model(corpus)
-
-    # Evaluates the similarity between the stack traces in a given signature.
-    print(args.signature + ' \n')
-
-    similarities = crash_similarity.signature_similarity(model, paths, args.signature, args.signature)
-    print('Top ' + str(args.top))
-    for similarity in similarities[:args.top]:
-        print(u'%s\n%s\n%s\n' % (similarity[2], similarity[0], similarity[1]))
-    print('Bottom ' + str(args.top))
-    for similarity in similarities[-int(args.top):]:
-        print(u'%s\n%s\n%s\n' % (similarity[2], similarity[0], similarity[1]))
+    if not args.no_download:
+        SocorroDownloader.download_and_save_crashes(days=args.days, product=args.product)
+    paths = SocorroDownloader.get_dump_paths(days=args.days, product=args.product)
+
+    # Loads the model trained today, or trains it once
+    model = (doc2vec.Doc2Vec if args.model == 'doc2vec' else word2vec.Word2Vec)(paths)
+
+    if args.signature:
+        # Evaluates the similarity between the stack traces in a given signature.
+        print(args.signature + ' \n')
+
+        similarities = model.signature_similarity(paths, args.signature, args.signature, args.top, args.top)
+        print('Top ' + str(args.top))
+        for similarity in similarities[:args.top]:
+            print(u'%s\n%s\n%s\n' % (similarity[2], similarity[0], similarity[1]))
+        print('Bottom ' + str(args.top))
+        for similarity in similarities[-int(args.top):]:
+            print(u'%s\n%s\n%s\n' % (similarity[2], similarity[0], similarity[1]))
+    else:
+        signatures = StackTracesGetter.get_top_signatures(paths, args.top_signatures)
+        report = coherence_report(model, paths, signatures, args.workers, args.traces)
+        write_report(report, args.output)
+        print('Coherence of {} signatures written to {}'.format(len(signatures), args.output))
@@ -1,5 +1,5 @@
 from crashsimilarity.downloader import SocorroDownloader
-from crashsimilarity import crash_similarity
+from crashsimilarity.models import doc2vec
 import argparse
 import sys
 
@@ -20,13 +20,11 @@ if __name__ == '__main__':
     paths = SocorroDownloader.get_dump_paths(days=3, product=args.product)
     # paths = ['crashsimilarity_data/firefox-crashes-2016-11-09.json', 'crashsimilarity_data/firefox-crashes-2016-11-08.json', 'crashsimilarity_data/firefox-crashes-2016-11-07.json', 'crashsimilarity_data/firefox-crashes-2016-11-06.json', 'crashsimilarity_data/firefox-crashes-2016-11-05.json', 'crashsimilarity_data/firefox-crashes-2016-11-04.json', 'crashsimilarity_data/firefox-crashes-2016-11-03.json']
 
-    corpus = crash_similarity.read_corpus(paths)
-
-    model = crash_similarity.train_model(corpus)
+    model = doc2vec.Doc2Vec(paths)
 
     print(args.one + ' vs ' + args.two)
     # similarities = crash_similarity.signature_similarity(model, paths,'shutdownhang | js::GCMarker::processMarkStackTop','shutdownhang | js::GCMarker::processMarkStackTop')
-    similarities = crash_similarity.signature_similarity(model, paths, args.one, args.two)
+    similarities = model.signature_similarity(paths, args.one, args.two, args.top, args.top)
     print('Top ' + str(args.top))
     for similarity in similarities[:args.top]:
         print(u'%s\n%s\n%s\n' % (similarity[2], similarity[0], similarity[1]))
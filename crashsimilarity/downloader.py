@@ -1,5 +1,9 @@
-import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from urllib.parse import urlparse
 import logging
 
 import requests
@@ -7,9 +11,44 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3 import Retry
 
 from crashsimilarity import utils
+from crashsimilarity.dump import CrashDump
+
+
+class RateLimiter(object):
+    """
+    Spaces out the requests sent to every host, shared by all the threads of the process
+    Attributes:
+        interval: minimum number of seconds between two requests to the same host, 0 for no limit
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_request = {}
+
+    def wait(self, url):
+        """Block until a request to the host of url can be sent"""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_request.get(host, now))
+            self._next_request[host] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
 
 
 class Downloader(object):
+    """
+    Attributes:
+        rate_limiter: RateLimiter applied to every request of get_with_retries
+    """
+    rate_limiter = RateLimiter(requests_per_second=10)
+    # Maximum number of kept-alive connections per host of the shared session.
+    POOL_SIZE = 16
+
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self, cache=None):
         self._cache = cache
 
@@ -18,12 +57,24 @@ class Downloader(object):
         response.raise_for_status()
         return response.json()
 
+    @staticmethod
+    def session():
+        """requests.Session shared by all the downloaders, whose connections are pooled and kept alive"""
+        with Downloader._session_lock:
+            if Downloader._session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=Downloader.POOL_SIZE,
+                                      max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429]))
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                Downloader._session = s
+            return Downloader._session
+
     @staticmethod
     def get_with_retries(url, params=None, headers=None):
         # can't be tested with requests_mock.Mocker() for unknown reason
-        s = requests.Session()
-        s.mount(url, HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429])))
-        return s.get(url, params=params, headers=headers)
+        Downloader.rate_limiter.wait(url)
+        return Downloader.session().get(url, params=params, headers=headers)
 
 
 class BugzillaDownloader(Downloader):
@@ -47,7 +98,7 @@ class BugzillaDownloader(Downloader):
 
     def download_signatures(self, bug_id):
         key = ('bugzilla_bug', bug_id, utils.utc_today())
-        if self._cache and key in self._cache:
+        if self._cache is not None and key in self._cache:
             logging.debug('get data from cache')
             return self._cache[key]
 
@@ -56,7 +107,7 @@ class BugzillaDownloader(Downloader):
         signatures = self._json_or_raise(response)['bugs'][0]['cf_crash_signature']
         cleaned_signatures = self._clean_signatures(signatures)
 
-        if self._cache:
+        if self._cache is not None:
             self._cache[key] = cleaned_signatures
         return cleaned_signatures
 
@@ -94,7 +145,7 @@ class SocorroDownloader(Downloader):
         from_date = utils.utc_today() - period
 
         key = ('traces_for_signature', signature, utils.utc_today())
-        if self._cache and key in self._cache:
+        if self._cache is not None and key in self._cache:
             logging.debug('get data from cache')
             return self._cache[key]
 
@@ -109,7 +160,7 @@ class SocorroDownloader(Downloader):
         records = self._json_or_raise(response)['facets']['proto_signature']
         traces = set([r['term'] for r in records])
 
-        if self._cache:
+        if self._cache is not None:
             self._cache[key] = traces
         return traces
 
@@ -118,8 +169,28 @@ class SocorroDownloader(Downloader):
         crash = self._json_or_raise(self.get_with_retries(self._PROCESSED_CRASH_URL, params))
         return crash
 
-    def download_day_crashes(self, day, product='Firefox', offset=0, crashes_per_request=1000):
-        """While there can be ~100mb of data this function return generator"""
+    def _download_pages(self, params, offsets, workers):
+        """
+        Download the SuperSearch pages at the given offsets, at most 2 * workers pages at once
+        :return: generator of the responses, in the order of offsets
+        """
+        def download_page(offset):
+            return self._json_or_raise(self.get_with_retries(self._SUPER_SEARCH_URL, dict(params, _results_offset=offset)))
+
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque()
+            for offset in offsets:
+                if len(pending) == 2 * workers:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(download_page, offset))
+            while pending:
+                yield pending.popleft().result()
+
+    def download_day_pages(self, day, product='Firefox', offset=0, crashes_per_request=1000, workers=1):
+        """
+        :param workers: number of pages downloaded concurrently once the first one gave the total number of crashes
+        :return: generator of (offset following the page, crashes of the page)
+        """
         params = {
             'product': product,
             'date': ['>=' + str(day), '<' + str(day + timedelta(1))],
@@ -127,42 +198,85 @@ class SocorroDownloader(Downloader):
             '_results_number': crashes_per_request,
             '_results_offset': offset,
             '_facets_size': 0,
+            # Oldest first, so that the crashes received after a download are after its last offset.
+            '_sort': ['date', 'uuid'],
         }
         logging.info('start downloading crashes for {}'.format(day))
+        offsets = [offset]
+        while offsets:
+            for offset, response in zip(offsets, self._download_pages(params, offsets, workers)):
+                logging.info('offset: {} from: {}'.format(offset, response['total']))
+                crashes = response['hits']
+                yield offset + len(crashes), crashes
+                if len(crashes) < crashes_per_request:
+                    return
+            # The offsets of the next pages are known from the total, past it pages are requested one at a time
+            # until the last one, as crashes can be added while downloading the current day.
+            offset += crashes_per_request
+            offsets = range(offset, max(response['total'], offset + 1), crashes_per_request)
+
+    def download_day_crashes(self, day, product='Firefox', offset=0, crashes_per_request=1000, workers=1):
+        """While there can be ~100mb of data this function return generator"""
         uuids = set()
-        while True:
-            params['_results_offset'] = offset
-            response = self._json_or_raise(self.get_with_retries(self._SUPER_SEARCH_URL, params))
-            logging.info('offset: {} from: {}'.format(offset, response['total']))
-            crashes = response['hits']
-            offset += len(crashes)
+        for _, crashes in self.download_day_pages(day, product, offset, crashes_per_request, workers):
             for crash in crashes:
                 if crash['uuid'] not in uuids:
                     uuids.add(crash['uuid'])
                     yield crash
-            if len(crashes) < crashes_per_request:
-                break
+
+    def download_and_save_day_crashes(self, day, product='Firefox', save_to_dir=_CRASHSIMILARITY_DATA_DIR, workers=1, chunk_size=10000):
+        """
+        Download the crashes of a day into its CrashDump, resuming from the last committed chunk of a previous download;
+        the current day is downloaded again from there, as it may have new crashes, the other complete days are skipped
+        :param chunk_size: minimum number of crashes committed at once
+        """
+        dump = CrashDump(SocorroDownloader.crashes_dump_file_path(day, product, save_to_dir))
+        if dump.manifest['complete'] and day != utils.utc_today():
+            return
+        uuids = dump.resume()
+
+        chunk = []
+        offset = dump.manifest['offset']
+        for offset, crashes in self.download_day_pages(day, product, offset, workers=workers):
+            for crash in crashes:
+                if crash['uuid'] not in uuids:
+                    uuids.add(crash['uuid'])
+                    chunk.append(crash)
+            if len(chunk) >= chunk_size:
+                dump.append(chunk, offset)
+                chunk = []
+        dump.append(chunk, offset)
+        dump.finish()
 
     @staticmethod
-    def download_and_save_crashes(days, product='Firefox', save_to_dir=_CRASHSIMILARITY_DATA_DIR):
+    def download_and_save_crashes(days, product='Firefox', save_to_dir=_CRASHSIMILARITY_DATA_DIR, workers=4, day_workers=2):
+        """
+        :param workers: number of pages downloaded concurrently for every day
+        :param day_workers: number of days downloaded concurrently; every day keeps up to 2 * workers pages pending, so
+                            2 * workers * day_workers should stay within Downloader.POOL_SIZE to keep the connections alive
+        """
         utils.create_dir(save_to_dir)
-        utils.write_json('{}/schema_version'.format(save_to_dir), [1])
+        utils.write_json('{}/schema_version'.format(save_to_dir), [2])
+
+        def download_and_save_day(day):
+            SocorroDownloader().download_and_save_day_crashes(day, product, save_to_dir, workers)
 
-        for i in range(0, days):
-            day = utils.utc_today() - timedelta(i)
-            gen = SocorroDownloader().download_day_crashes(day, product)
-            utils.write_json(SocorroDownloader.crashes_dump_file_path(day, product, save_to_dir), gen)
+        with ThreadPoolExecutor(day_workers) as executor:
+            futures = [executor.submit(download_and_save_day, utils.utc_today() - timedelta(i)) for i in range(0, days)]
+            for future in futures:
+                future.result()
 
     @staticmethod
     def get_dump_paths(days, product='Firefox', data_dir=_CRASHSIMILARITY_DATA_DIR):
+        """Paths of the crash dumps of the last days that were completely downloaded"""
         last_day = utils.utc_today()
         path = SocorroDownloader.crashes_dump_file_path(last_day, product, data_dir)
-        if not os.path.exists(path):
+        if not CrashDump.is_complete(path):
             last_day -= timedelta(1)
         return [f for f in
                 [SocorroDownloader.crashes_dump_file_path(last_day - timedelta(i), product, data_dir) for i in range(0, days)]
-                if os.path.exists(f)]
+                if CrashDump.is_complete(f)]
 
     @staticmethod
     def crashes_dump_file_path(day, product, data_dir):
-        return '{}/{}-crashes-{}.json'.format(data_dir, product.lower(), day)
+        return '{}/{}-crashes-{}.json.gz'.format(data_dir, product.lower(), day)
@@ -0,0 +1,96 @@
+import gzip
+import json
+import os
+import zlib
+
+from crashsimilarity import utils
+
+
+class CrashDump(object):
+    """
+    Crashes of a day stored as JSON lines in an append-only gzip file, one gzip member per chunk,
+    so that the file can be read as a whole by any gzip reader while being written chunk by chunk
+    The manifest next to the file records what was committed:
+        rows: number of crashes in the committed chunks
+        offset: SuperSearch offset the download of the day resumes from
+        size: size in bytes of the committed chunks, anything after them is dropped
+        crc32: checksum of the committed chunks
+        complete: whether the download of the day went to the end
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = self.read_manifest(path)
+
+    @staticmethod
+    def manifest_path(path):
+        return path + '.manifest.json'
+
+    @staticmethod
+    def read_manifest(path):
+        try:
+            with open(CrashDump.manifest_path(path)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'rows': 0, 'offset': 0, 'size': 0, 'crc32': 0, 'complete': False}
+
+    @staticmethod
+    def is_complete(path):
+        return CrashDump.read_manifest(path)['complete']
+
+    def _write_manifest(self):
+        path = self.manifest_path(self.path)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _checksum(f, size, block_size=1 << 20):
+        crc = 0
+        while size > 0:
+            block = f.read(min(block_size, size))
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            size -= len(block)
+        return crc
+
+    def resume(self):
+        """
+        Drop what was written after the last commit, start over if the committed chunks are corrupted
+        :return: the set of uuids of the committed crashes
+        """
+        utils.create_dir(os.path.dirname(self.path) or '.')
+        with open(self.path, 'ab+') as f:
+            f.seek(0)
+            if os.path.getsize(self.path) < self.manifest['size'] or self._checksum(f, self.manifest['size']) != self.manifest['crc32']:
+                self.manifest = {'rows': 0, 'offset': 0, 'size': 0, 'crc32': 0, 'complete': False}
+            f.truncate(self.manifest['size'])
+
+        self.manifest['complete'] = False
+        self._write_manifest()
+        if self.manifest['rows'] == 0:
+            return set()
+        with gzip.open(self.path, 'rt', encoding='utf8') as f:
+            return {json.loads(line)['uuid'] for line in f}
+
+    def append(self, crashes, offset):
+        """
+        Commit a chunk of crashes
+        :param offset: SuperSearch offset following the crashes
+        """
+        data = gzip.compress(''.join(json.dumps(crash) + '\n' for crash in crashes).encode('utf8')) if crashes else b''
+        if data:
+            with open(self.path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self.manifest['rows'] += len(crashes)
+        self.manifest['offset'] = offset
+        self.manifest['size'] += len(data)
+        self.manifest['crc32'] = zlib.crc32(data, self.manifest['crc32'])
+        self._write_manifest()
+
+    def finish(self):
+        self.manifest['complete'] = True
+        self._write_manifest()
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class IVFIndex(object):
+    """
+    Inverted file index over trace vectors, with a spherical k-means coarse quantizer
+    Attributes:
+        centroids: n_lists x dimensions unit vectors, one per list
+        doc_ids: ids of the indexed vectors, grouped by list
+        list_offsets: the vectors of list i are doc_ids[list_offsets[i]:list_offsets[i + 1]]
+    """
+
+    def __init__(self, centroids, doc_ids, list_offsets):
+        self.centroids = centroids
+        self.doc_ids = doc_ids
+        self.list_offsets = list_offsets
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.sqrt(np.sum(vectors ** 2, axis=-1, keepdims=True))
+        return vectors / np.maximum(norms, np.finfo(vectors.dtype).tiny)
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk_size=65536):
+        return np.concatenate([np.argmax(np.dot(vectors[i:i + chunk_size], centroids.T), axis=1)
+                               for i in range(0, len(vectors), chunk_size)])
+
+    @staticmethod
+    def build(vectors, n_lists=None, iterations=10, seed=0):
+        """
+        :param vectors: one vector per document, documents with a zero vector are not indexed
+        :param n_lists: number of lists of the quantizer (Default square root of the number of documents)
+        :param iterations: k-means iterations
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        indexed = np.flatnonzero(np.any(vectors != 0, axis=1))
+        if len(indexed) == 0:
+            return IVFIndex(np.zeros((0, vectors.shape[1]), dtype=np.float32), np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+
+        points = IVFIndex._normalize(vectors[indexed])
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(points)))
+        n_lists = max(1, min(n_lists, len(points)))
+
+        rng = np.random.RandomState(seed)
+        centroids = points[rng.choice(len(points), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = IVFIndex._assign(points, centroids)
+            counts = np.bincount(assignments, minlength=len(centroids))
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(points[np.argsort(assignments, kind='stable')], (np.cumsum(counts) - counts)[~empty], axis=0)
+            # Re-seed empty lists with random points, so that no list is wasted.
+            sums[empty] = points[rng.choice(len(points), int(empty.sum()))]
+            centroids = IVFIndex._normalize(sums)
+
+        assignments = IVFIndex._assign(points, centroids)
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=list_offsets[1:])
+        return IVFIndex(centroids, indexed[order].astype(np.int32), list_offsets)
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def candidates(self, query_vector, n_probe=8):
+        """
+        :param query_vector: vector of the query, in the space of the indexed vectors
+        :param n_probe: number of lists, closest to the query first, whose documents are returned
+        :return: sorted ids of the candidate documents
+        """
+        scores = np.dot(self.centroids, np.asarray(query_vector, dtype=np.float32))
+        probed = np.argsort(-scores, kind='stable')[:n_probe]
+        lists = [self.doc_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed]
+        return np.sort(np.concatenate(lists + [np.zeros(0, dtype=np.int32)]))
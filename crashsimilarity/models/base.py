@@ -1,38 +1,156 @@
 import bisect
+import collections
+import contextlib
+import heapq
+import multiprocessing
+import random
+import re
+import threading
 import time
 import logging
 import os
+import weakref
 
 import gensim
 import numpy as np
 import pyximport
 from pyemd import emd
 from abc import ABCMeta, abstractmethod
+from datetime import datetime
 
 from crashsimilarity import utils
+from crashsimilarity.cache import LRUCache
+from crashsimilarity.models.ann import IVFIndex
+from crashsimilarity.models.corpus import TraceCorpus
+from crashsimilarity.models.pool import WorkerPool, shared_array, task_array
+from crashsimilarity.models.quantization import QuantizedMatrix
+from crashsimilarity.models.stream import StreamingCorpus
 from crashsimilarity.stacktrace import StackTraceProcessor, StackTracesGetter
 
 pyximport.install()
 
+# Number of documents whose word distances are gathered at once by the batched RWMD.
+RWMD_CHUNK_SIZE = 65536
+# Number of candidates handed to a worker at once by the parallel WMD confirmation.
+WMD_CHUNK_SIZE = 16
+# Number of top_similar_traces results kept in memory.
+RESULT_CACHE_SIZE = 1024
+# Bytes of the vocab x 1 word distance columns kept in memory.
+DISTANCE_CACHE_BYTES = 256 * 1024 * 1024
+# Number of most frequent words of the corpus whose pairwise distances are kept in memory.
+FREQUENT_WORDS = 2048
+# Number of traces, closest first by Word Centroid Distance, whose RWMD is computed at once by top_similar_traces.
+WCD_TIER_SIZE = 4096
+# Rounding slack of the float32 Word Centroid Distances.
+WCD_TOLERANCE = 1e-4
+# Slack of the WMD bounds, so that the pairs on the boundary of the top and bottom ones are still computed: the bounds are
+# exact, but pyemd < 1.0 solves the EMD of cosine distances with an absolute error of up to about 6e-6 for traces of
+# 10 frames.
+BOUND_TOLERANCE = 1e-5
+
+
+def _wmd_task(token_ids, offsets, item):
+    all_distances, query_indices, doc_id = item
+    return EmbeddingAlgo._trace_wmd(query_indices, token_ids[offsets[doc_id]:offsets[doc_id + 1]], task_array(all_distances))
+
 
 class EmbeddingAlgo(object):
     """"
     Abstract Base Class for word embedding algorithms
     Attributes:
         fnames: list of file that contains crash data
-        corpus: The processed data
+        corpus: The processed data, compacted into a TraceCorpus once the model is trained
         model: The trained model
     """
     __metaclass__ = ABCMeta
 
-    def __init__(self, path, force_train=False):
+    # top_similar_traces results and vocab x 1 word distance columns, keyed by model version.
+    _results = LRUCache(RESULT_CACHE_SIZE)
+    _distance_columns = LRUCache(DISTANCE_CACHE_BYTES, lambda column: column.nbytes)
+    # (FREQUENT_WORDS most frequent words of the corpus, their pairwise distances), keyed by model version.
+    _frequent_distances = LRUCache(4)
+
+    def __init__(self, path, force_train=False, incremental=False, replay_ratio=0.1, corpus_dir=None, ingest_workers=None,
+                 single_precision=False, quantize=False):
         """
         :param path: files that contain crash data
         :param force_train: if true: a new model is trained, if false: the current_day model is retrieved without training (if found)
+        :param incremental: if true and there is no current_day model, the latest model is updated with the traces of the files
+                            it was not trained on, instead of training a new model on all of them
+        :param replay_ratio: fraction of the traces of the latest model trained again along with the new ones by an incremental update
+        :param corpus_dir: if set, the traces are ingested into a StreamingCorpus in this directory and the model is trained
+                           from the memory-mapped corpus instead of a list in memory; the corpus only keeps the traces of path
+        :param ingest_workers: number of processes the files are read by when the corpus is built in memory (Default one per core)
+        :param single_precision: if true, the word distances are float32 instead of float64, only the cost matrix of every
+                                 WMD problem and the sums of the RWMD and of the WMD bounds are still float64
+        :param quantize: if true, the WCD of the traces is computed from an int8 copy of their mean vectors
         """
         self._fnames = path
-        self._corpus = self._read_corpus()
-        self._model = self._train_model(force_train)
+        self._dtype = np.float32 if single_precision else np.double
+        self._quantize = quantize
+        self._ingest_workers = ingest_workers or multiprocessing.cpu_count()
+        self._ann_index = None
+        self._ann_version = None
+        self._wmd_pool = None
+        self._wmd_pool_key = None
+        self._wmd_pool_finalizer = None
+        self._wmd_pool_lock = threading.Lock()
+        current_date = datetime.now().strftime('%d%b%Y')
+        if not (incremental and not force_train and self._update_model(current_date, replay_ratio)):
+            if corpus_dir:
+                self._corpus = StreamingCorpus.ingest(self._fnames, corpus_dir)
+                self._model = self._train_model(force_train)
+                self._corpus = self._corpus.to_trace_corpus(self._model.wv.vocab)
+            else:
+                duplicates = set()
+                self._corpus = self._read_corpus(duplicates=duplicates)
+                self._model = self._train_model(force_train)
+                self._corpus = TraceCorpus.build(self._corpus, self._model.wv.vocab, self._fnames, duplicates)
+            self._corpus.save(self._corpus_path(current_date))
+        self._vectors = self._load_vectors(current_date)
+        self._centroids, self._centroid_norms, self._quantized_centroids = self._save_centroids(current_date)
+        # Traces considered by top_similar_traces, and how many of them were eliminated by the WCD and the RWMD tiers
+        # or confirmed with the exact WMD, over all the queries.
+        self.tier_counts = collections.Counter()
+        # Cached results are shared by the instances serving the same vectors and corpus, the doc ids of a corpus
+        # depend on the order it was read in, and a new model or corpus is a new version.
+        self._model_version = (os.path.abspath(self._vectors_path(current_date)), os.stat(self._vectors_path(current_date)).st_mtime_ns,
+                               os.stat(self._corpus_path(current_date)).st_mtime_ns, np.dtype(self._dtype).name)
+
+    def __getstate__(self):
+        # The WMD pool of a model stays in the process that started it.
+        state = self.__dict__.copy()
+        state.update(_wmd_pool=None, _wmd_pool_key=None, _wmd_pool_finalizer=None, _wmd_pool_lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._wmd_pool_lock = threading.Lock()
+
+    def close(self):
+        """Stop the workers of the parallel WMD confirmation, they are also stopped once the model is garbage collected"""
+        with self._wmd_pool_lock:
+            self._close_wmd_pool()
+
+    def _close_wmd_pool(self):
+        if self._wmd_pool_finalizer is not None:
+            self._wmd_pool_finalizer()
+        self._wmd_pool = self._wmd_pool_key = self._wmd_pool_finalizer = None
+
+    def _get_wmd_pool(self, workers):
+        """
+        WorkerPool of _wmd_task shared by the queries of the model, started by the first one: the token arrays of the
+        corpus are sent to its workers once, the query distances once per query through shared memory
+        """
+        key = (self._model_version, workers)
+        with self._wmd_pool_lock:
+            if self._wmd_pool_key != key:
+                self._close_wmd_pool()
+                self._wmd_pool = WorkerPool(workers, _wmd_task, self._corpus.token_ids, self._corpus.offsets)
+                # The finalizer doesn't hold the model, so that a model dropped by a QueryServer reload stops its workers.
+                self._wmd_pool_finalizer = weakref.finalize(self, self._wmd_pool.terminate)
+                self._wmd_pool_key = key
+            return self._wmd_pool
 
     def get_model_name(self):
         return self.__class__.__name__
@@ -40,25 +158,211 @@ class EmbeddingAlgo(object):
     def get_model(self):
         return self._model
 
-    def _read_traces(self):
-        return StackTraceProcessor.process(utils.read_files(self._fnames), 10)
+    def get_corpus(self):
+        """:return: the TraceCorpus of the model, whose doc ids are the ones of top_similar_traces"""
+        return self._corpus
+
+    def get_ann_index(self):
+        """:return: the IVFIndex of the traces, None until build_ann_index is called"""
+        return self._ann_index
+
+    def get_model_version(self):
+        """:return: (path of the word vectors, their mtime, mtime of the corpus, dtype of the distances), see __init__"""
+        return self._model_version
+
+    def get_trace(self, doc_id):
+        """
+        :return: (words of the document that are in the vocabulary, signature of the document)
+        """
+        return self._extract_words_from_model(doc_id), self._corpus.signature(doc_id)
+
+    def _word_vectors(self):
+        """
+        L2-normalized word vectors, whose dot products are the cosine similarities
+        The word vectors of Doc2Vec models are normalized too, although gensim's Doc2Vec.init_sims only normalizes the
+        document vectors: the WCD lower bound and the centroids of the ANN index assume unit word vectors
+        """
+        return self._vectors
+
+    def build_ann_index(self, n_lists=None, iterations=10, seed=0):
+        """
+        Index the mean word vector of every trace, so that top_similar_traces can restrict the RWMD
+        to the traces of the lists closest to the query
+        :param n_lists: number of lists of the index (Default square root of the corpus size)
+        :param iterations: k-means iterations used to build the lists
+        """
+        t = time.time()
+        self._ann_index = IVFIndex.build(self._centroids, n_lists, iterations, seed)
+        self._ann_version = (n_lists, iterations, seed)
+        logging.info('ANN index with ' + str(len(self._ann_index)) + ' lists built in ' + str(time.time() - t) + ' s.')
+
+    def _read_traces(self, fnames=None, duplicates=None):
+        return StackTraceProcessor.process_stores(self._fnames if fnames is None else fnames, 10, workers=self._ingest_workers, duplicates=duplicates)
+
+    def _read_corpus(self, fnames=None, first_tag=0, duplicates=None):
+        """:param duplicates: see StackTraceProcessor.process"""
+        return [gensim.models.doc2vec.TaggedDocument(trace, [i, signature]) for i, (trace, signature) in enumerate(self._read_traces(fnames, duplicates), first_tag)]
+
+    def _shuffle_corpus(self):
+        # A StreamingCorpus is shuffled block by block every time it is read.
+        if isinstance(self._corpus, list):
+            random.shuffle(self._corpus)
+
+    def _sentences(self):
+        """Re-iterable over the words of the traces of the training corpus"""
+        if isinstance(self._corpus, StreamingCorpus):
+            return self._corpus.sentences()
+        return [doc.words for doc in self._corpus]
+
+    def _models_dir(self):
+        return 'trained_models/' + self.get_model_name().lower() + '/'
+
+    def _model_path(self, date):
+        return self._models_dir() + 'stack_traces_' + date + '_model.pickle'
+
+    def _corpus_path(self, date):
+        return self._models_dir() + 'stack_traces_' + date + '_corpus.npz'
+
+    def _vectors_path(self, date):
+        return self._models_dir() + 'stack_traces_' + date + '_vectors.npy'
+
+    def _centroids_path(self, date):
+        return self._models_dir() + 'stack_traces_' + date + '_centroids.npy'
+
+    def _quantized_centroids_path(self, date):
+        return self._models_dir() + 'stack_traces_' + date + '_centroids_int8.npy'
+
+    @staticmethod
+    def _normalize(vectors):
+        return (vectors / np.sqrt((vectors ** 2).sum(-1))[..., np.newaxis]).astype(np.float32)
+
+    def _save_model(self, model, date):
+        """
+        Save the model with every array in its own .npy file, so that _load_model can memory-map them,
+        along with its L2-normalized word vectors, so that they are computed once per model instead of once per query
+        """
+        utils.create_dir(self._models_dir())
+        model.save(self._model_path(date), sep_limit=0)
+        np.save(self._vectors_path(date), self._normalize(model.wv.vectors))
+
+    def _load_vectors(self, date):
+        """
+        :return: the L2-normalized word vectors of the model of the given date, memory-mapped read-only
+                 so that the pages are shared by every process serving the model
+        """
+        if not os.path.exists(self._vectors_path(date)):
+            # The model was saved without its normalized vectors.
+            np.save(self._vectors_path(date), self._normalize(self._model.wv.vectors))
+        return np.load(self._vectors_path(date), mmap_mode='r')
+
+    def _save_centroids(self, date):
+        """
+        Save the mean normalized word vector of every trace of the corpus, saved along with it
+        :return: (the float32 traces x dimensions mean vectors, memory-mapped read-only; their squared norms, inf for the
+                 traces without words in the vocabulary; their QuantizedMatrix, whose codes are memory-mapped, if quantize)
+        """
+        centroids = self._corpus.mean_vectors(self._word_vectors())
+        norms = np.einsum('ij,ij->i', centroids, centroids).astype(self._dtype)
+        norms[np.diff(self._corpus.offsets) == 0] = float('inf')
+        self._replace_array(self._centroids_path(date), centroids)
+        quantized = None
+        if self._quantize:
+            quantized = QuantizedMatrix.build(centroids)
+            self._replace_array(self._quantized_centroids_path(date), quantized.codes)
+            quantized.codes = np.load(self._quantized_centroids_path(date), mmap_mode='r')
+        return np.load(self._centroids_path(date), mmap_mode='r'), norms, quantized
+
+    @staticmethod
+    def _replace_array(file_name, array):
+        # The file is replaced instead of rewritten, as other instances may have memory-mapped it.
+        tmp_name = file_name + '.tmp.npy'
+        np.save(tmp_name, array)
+        os.replace(tmp_name, file_name)
 
     @abstractmethod
-    def _read_corpus(self):
+    def _load_model(self, file_name):
+        """Load a model saved by _save_model, its arrays memory-mapped copy-on-write"""
         pass
 
-    @abstractmethod
     def _extract_words_from_model(self, doc_id):
-        pass
+        return self._corpus.words(doc_id, self._model.wv.index2word)
 
-    @abstractmethod
     def _extract_indices_from_model(self, doc_id):
-        pass
+        return self._corpus.indices(doc_id)
 
     @abstractmethod
     def _train_model(self, force_train=False):
         pass
 
+    def _latest_model_date(self, before):
+        """Date string of the most recent model saved along with its corpus before the given date, None if there is none"""
+        if not os.path.isdir(self._models_dir()):
+            return None
+
+        dates = []
+        for name in os.listdir(self._models_dir()):
+            match = re.match(r'stack_traces_(.+)_model\.pickle$', name)
+            if match and match.group(1) != before and os.path.exists(self._corpus_path(match.group(1))):
+                try:
+                    dates.append(datetime.strptime(match.group(1), '%d%b%Y'))
+                except ValueError:
+                    continue
+        dates = [date for date in dates if date < datetime.strptime(before, '%d%b%Y')]
+        return max(dates).strftime('%d%b%Y') if dates else None
+
+    def _update_model(self, current_date, replay_ratio):
+        """
+        Update the latest model with the traces of the files it was not trained on and save it as the current_day model,
+        along with the corpus of the files, without the traces of the files of the latest model that are not among them
+        :return: False if there is nothing to update, in which case the model has to be loaded or trained as usual
+        """
+        if os.path.exists(self._model_path(current_date)):
+            return False
+        latest_date = self._latest_model_date(current_date)
+        if latest_date is None:
+            return False
+
+        model = self._load_model(self._model_path(latest_date))
+        corpus = TraceCorpus.load(self._corpus_path(latest_date))
+        new_fnames = [f for f in self._fnames if f not in corpus.sources]
+        # The traces are not recorded along with their file, and a trace of the window may have been deduplicated
+        # against a trace of a file that left it, so when files left the window the corpus is rebuilt from all of them.
+        rebuild = any(f not in self._fnames for f in corpus.sources)
+        known = set(corpus.hashes.tolist())
+        duplicates = set()
+        if rebuild:
+            documents = self._read_corpus(self._fnames, 0, duplicates)
+        else:
+            documents = self._read_corpus(new_fnames, len(corpus), duplicates)
+        is_new = [StackTraceProcessor.trace_hash(doc.words) not in known for doc in documents]
+        new_documents = [doc for doc, new in zip(documents, is_new) if new]
+
+        if rebuild:
+            kept = [doc.words for doc, new in zip(documents, is_new) if not new]
+            replayed = [kept[i] for i in random.sample(range(len(kept)), int(len(kept) * replay_ratio))]
+        else:
+            replayed = [corpus.words(doc_id, model.wv.index2word) for doc_id in random.sample(range(len(corpus)), int(len(corpus) * replay_ratio))]
+        sentences = [doc.words for doc in new_documents] + replayed
+        random.shuffle(sentences)
+        logging.debug('New traces: ' + str(len(new_documents)) + ', replayed traces: ' + str(len(replayed)))
+
+        t = time.time()
+        logging.info('Updating model...')
+        model.build_vocab(sentences, update=True)
+        model.train(sentences, total_examples=len(sentences), epochs=model.epochs)
+        logging.info('Model updated in ' + str(time.time() - t) + ' s.')
+
+        self._model = model
+        if rebuild:
+            self._corpus = TraceCorpus.build(documents, model.wv.vocab, self._fnames, duplicates)
+        else:
+            # The documents already in the corpus are skipped too, but recorded as duplicates.
+            self._corpus = corpus.extend(documents, model.wv.vocab, new_fnames, duplicates)
+        self._save_model(model, current_date)
+        self._corpus.save(self._corpus_path(current_date))
+        self.delete_old_models(current_date, self._models_dir(), False)
+        return True
+
     @staticmethod
     def delete_old_models(current_date, path, force_train):
         """
@@ -76,55 +380,153 @@ class EmbeddingAlgo(object):
         for model in old_models:
             os.remove(os.path.join(path, model))
 
-    def wmdistance(self, document1, document2, all_distances, distance_metric='cosine'):
-        model = self._model
-        if len(document1) == 0 or len(document2) == 0:
+    @staticmethod
+    def _wmd(query_indices, doc_indices, all_distances):
+        """
+        Word Mover's Distance between a query and a document given as vocabulary indices
+        :param query_indices: distinct vocabulary indices of the query words, in the order of the columns of all_distances
+        :param doc_indices: vocabulary indices of the document words, repeated words included
+        :param all_distances: vocab x query words distance matrix
+        """
+        if len(query_indices) == 0 or len(doc_indices) == 0:
             logging.info(
                 'At least one of the documents had no words that were in the vocabulary. Aborting (returning inf).')
             return float('inf')
 
-        dictionary = gensim.corpora.Dictionary(documents=[document1, document2])
-        vocab_len = len(dictionary)
-
-        # Sets for faster look-up.
-        docset1 = set(document1)
-        docset2 = set(document2)
-
-        distance_matrix = np.zeros((vocab_len, vocab_len), dtype=np.double)
-
-        for i, t1 in dictionary.items():
-            for j, t2 in dictionary.items():
-                if t1 not in docset1 or t2 not in docset2:
-                    continue
+        words = np.unique(np.concatenate((query_indices, doc_indices)))
+        query_pos = np.searchsorted(words, query_indices)
+        doc_pos = np.searchsorted(words, doc_indices)
+        doc_words = np.unique(doc_pos)
 
-                if distance_metric == 'euclidean':
-                    distance_matrix[i, j] = np.sqrt(np.sum((model.wv[t1] - model.wv[t2]) ** 2))
-                elif distance_metric == 'cosine':
-                    distance_matrix[i, j] = all_distances[model.wv.vocab[t2].index, i]
+        distance_matrix = np.zeros((len(words), len(words)), dtype=np.double)
+        distance_matrix[np.ix_(query_pos, doc_words)] = all_distances[words[doc_words]].transpose()
 
         if np.sum(distance_matrix) == 0.0:
             # `emd` gets stuck if the distance matrix contains only zeros.
             logging.info('The distance matrix is all zeros. Aborting (returning inf).')
             return float('inf')
 
-        def nbow(document):
-            d = np.zeros(vocab_len, dtype=np.double)
-            nbow = dictionary.doc2bow(document)  # Word frequencies.
-            doc_len = len(document)
-            for idx, freq in nbow:
-                d[idx] = freq / float(doc_len)  # Normalized word frequencies.
-            return d
-
         # Compute nBOW representation of documents.
-        d1 = nbow(document1)
-        d2 = nbow(document2)
+        d1 = np.bincount(query_pos, minlength=len(words)) / float(len(query_indices))
+        d2 = np.bincount(doc_pos, minlength=len(words)) / float(len(doc_indices))
 
         # Compute WMD.
         return emd(d1, d2, distance_matrix)
 
-    def top_similar_traces(self, stack_trace, top=10):
+    def wmdistances(self, query_indices, all_distances, doc_ids):
+        """
+        Word Mover's Distance between a query and a batch of documents of the corpus, lazily evaluated, see _trace_wmd
+        :param query_indices: distinct vocabulary indices of the query words, in the order of the columns of all_distances
+        :param all_distances: vocab x query words distance matrix
+        :param doc_ids: documents of the corpus to compare with the query
+        """
+        query_indices = np.asarray(query_indices, dtype=np.int32)
+        for doc_id in doc_ids:
+            yield self._trace_wmd(query_indices, self._corpus.indices(doc_id), all_distances)
+
+    def wmdistance(self, document1, document2, all_distances, distance_metric='cosine'):
+        vocab = self._model.wv.vocab
+        indices1 = np.array([vocab[word].index for word in document1], dtype=np.int32)
+        indices2 = np.array([vocab[word].index for word in document2], dtype=np.int32)
+
+        if distance_metric == 'euclidean':
+            # Only the rows of the words of the two documents are needed, so use a local vocabulary.
+            words = np.unique(np.concatenate((indices1, indices2)))
+            vectors = self._word_vectors()
+            all_distances = np.sqrt(np.sum((vectors[words][:, np.newaxis] - vectors[indices1]) ** 2, axis=2))
+            indices1 = np.searchsorted(words, indices1)
+            indices2 = np.searchsorted(words, indices2)
+
+        return self._wmd(indices1, indices2, all_distances)
+
+    def _query_distances(self, query_indices):
+        """
+        vocab x query words cosine distance matrix, assembled from the cached distance column of every word, the
+        distance between a word and itself is 0 like in _word_distances
+        """
+        keys = [(self._model_version, i) for i in query_indices.tolist()]
+        columns = [self._distance_columns.get(key) for key in keys]
+        missing = [j for j, column in enumerate(columns) if column is None]
+        if missing:
+            vectors = self._word_vectors()
+            distances = np.array(1.0 - np.dot(vectors, vectors[query_indices[missing]].transpose()), dtype=self._dtype)
+            for k, j in enumerate(missing):
+                columns[j] = np.ascontiguousarray(distances[:, k])
+                columns[j][query_indices[j]] = 0
+                self._distance_columns[keys[j]] = columns[j]
+        if not columns:
+            return np.zeros((len(self._word_vectors()), 0), dtype=self._dtype)
+        return np.stack(columns, axis=1)
+
+    def wcd_distances(self, query_indices, doc_ids=None):
+        """
+        Word Centroid Distance lower bound between a query and documents of the corpus: the cosine distance between unit
+        vectors is half their squared euclidean distance, so the WMD is at least half the squared euclidean distance
+        between the mean word vectors of the query and of the document
+        :param query_indices: distinct vocabulary indices of the query words
+        :param doc_ids: documents to compare with the query (Default the whole corpus)
+        :return: array of lower bounds in the order of doc_ids, inf for documents without words in the vocabulary
+        """
+        norms = self._centroid_norms if doc_ids is None else self._centroid_norms[doc_ids]
+        if len(query_indices) == 0:
+            return np.full(len(norms), float('inf'), dtype=self._dtype)
+
+        query = np.mean(self._word_vectors()[query_indices], axis=0, dtype=np.float32)
+        if self._quantized_centroids is not None:
+            # The upper bound of the products keeps the WCD a lower bound.
+            products = self._quantized_centroids.dot_upper_bound(query, doc_ids)
+        else:
+            products = np.dot(self._centroids if doc_ids is None else self._centroids[doc_ids], query)
+        wcd = (norms + np.dot(query, query) - 2 * products) / 2
+        return np.maximum(wcd - WCD_TOLERANCE, 0)
+
+    def rwmd_distances(self, all_distances, doc_ids=None):
+        """
+        Relaxed Word Mover's Distance lower bound between a query and documents of the corpus
+        :param all_distances: vocab x query words distance matrix
+        :param doc_ids: documents to compare with the query (Default the whole corpus)
+        :return: float64 array of lower bounds in the order of doc_ids, inf for documents without words in the vocabulary
+        """
+        if doc_ids is None:
+            token_ids, doc_offsets = self._corpus.token_ids, self._corpus.offsets
+        else:
+            token_ids, doc_offsets = self._corpus.gather(doc_ids)
+
+        doc_count = len(doc_offsets) - 1
+        rwmd = np.full(doc_count, float('inf'), dtype=np.double)
+        if all_distances.shape[1] == 0:
+            return rwmd
+
+        for first in range(0, doc_count, RWMD_CHUNK_SIZE):
+            last = min(first + RWMD_CHUNK_SIZE, doc_count)
+            offsets = doc_offsets[first:last + 1]
+            non_empty = offsets[1:] > offsets[:-1]
+            if not non_empty.any():
+                continue
+
+            word_dists = all_distances[token_ids[offsets[0]:offsets[-1]]]
+            # Empty documents own no rows, so the starts of the non-empty ones delimit every segment.
+            starts = offsets[:-1][non_empty] - offsets[0]
+            # Every document word moves to its closest query word with the weight of its nBOW, and every query word to
+            # its closest document word with the uniform weight of the distinct query words. The minimums are exact in
+            # float32 distances, but their sums are accumulated in float64 like the WMD they bound.
+            doc_to_query = np.add.reduceat(np.min(word_dists, axis=1).astype(np.double), starts) / np.diff(offsets)[non_empty]
+            query_to_doc = np.mean(np.minimum.reduceat(word_dists, starts, axis=0), axis=1, dtype=np.double)
+            rwmd[first:last][non_empty] = np.maximum(query_to_doc, doc_to_query)
+
+        return rwmd
+
+    def top_similar_traces(self, stack_trace, top=10, workers=1, ann_probes=None):
+        """
+        :param stack_trace: proto signature of the crash to look up
+        :param top: number of similar traces to return
+        :param workers: number of processes confirming the RWMD candidates with the exact WMD, kept by the model for the
+                        next queries until close
+        :param ann_probes: if set, only the traces of the ann_probes ANN lists closest to the query are candidates;
+                           more probes give a better recall and a slower query (Default every trace is a candidate)
+        :return: list of (doc_id, distance), closest first
+        """
         model = self._model
-        model.init_sims(replace=True)
 
         words_to_test = StackTraceProcessor.preprocess(stack_trace)
         words_to_test_clean = [w for w in np.unique(words_to_test).tolist() if w in model.wv.vocab]
@@ -135,32 +537,122 @@ class EmbeddingAlgo(object):
         sims = model.docvecs.most_similar([inferred_vector], topn=len(model.docvecs))
         '''
 
-        # Cos-similarity
-        if self.get_model_name() == 'Word2Vec':
-            all_distances = np.array(1.0 - np.dot(model.wv.vectors_norm, model.wv.vectors_norm[
-                [model.wv.vocab[word].index for word in words_to_test_clean]].transpose()), dtype=np.double)
-        else:
-            all_distances = np.array(1.0 - np.dot(model.wv.vectors, model.wv.vectors[
-                [model.wv.vocab[word].index for word in words_to_test_clean]].transpose()), dtype=np.double)
+        query_indices = np.array([model.wv.vocab[word].index for word in words_to_test_clean], dtype=np.int32)
+
+        if ann_probes and len(query_indices) != 0 and self._ann_index is None:
+            self.build_ann_index()
+        key = (self._model_version, tuple(query_indices.tolist()), top, ann_probes and (ann_probes, self._ann_version))
+        similarities = self._results.get(key)
+        if similarities is not None:
+            return list(similarities)
 
-        # Relaxed Word Mover's Distance for selecting
         t = time.time()
-        distances = []
-        for doc_id in range(0, len(self._corpus)):
-            doc_words = self._extract_indices_from_model(doc_id)
-            if len(doc_words) != 0:
-                word_dists = all_distances[doc_words]
-                rwmd = max(np.sum(np.min(word_dists, axis=0)), np.sum(np.min(word_dists, axis=1)))
-            else:
-                rwmd = float('inf')
-            distances.append((doc_id, rwmd))
+        similarities = self._top_similar(query_indices, top, workers, ann_probes)
+        logging.info('Query done in ' + str(time.time() - t) + ' s.')
 
-        distances.sort(key=lambda v: v[1])
-        logging.info('First part done in ' + str(time.time() - t) + ' s.')
+        self._results[key] = similarities
+        return list(similarities)
 
+    def nearest_traces(self, doc_id, k=10, ann_probes=None):
+        """
+        :param ann_probes: see top_similar_traces
+        :return: list of (doc_id, distance) of the k traces of the corpus closest to a trace of the corpus, itself excluded
+        """
+        query_indices = np.unique(self._corpus.indices(doc_id))
+        if ann_probes and len(query_indices) != 0 and self._ann_index is None:
+            self.build_ann_index()
+        return [(other, distance) for other, distance in self._top_similar(query_indices, k + 1, ann_probes=ann_probes) if other != doc_id][:k]
+
+    def _top_similar(self, query_indices, top, workers=1, ann_probes=None):
+        """
+        The candidates are ranked by their WCD lower bound, then their RWMD and the exact WMD are computed one tier of
+        WCD_TIER_SIZE candidates at a time, until the WCD of the next tier is over the top confirmed distances
+        :param query_indices: distinct vocabulary indices of the query words
+        :return: list of (doc_id, distance), closest first, see top_similar_traces
+        """
+        # Cos-similarity
+        vectors = self._word_vectors()
+        all_distances = self._query_distances(query_indices)
+
+        candidate_ids = None
+        if ann_probes and len(query_indices) != 0:
+            candidate_ids = self._ann_index.candidates(np.mean(vectors[query_indices], axis=0), ann_probes)
+            logging.debug('ANN candidates: ' + str(len(candidate_ids)))
+
+        # Word Centroid Distance for ranking
         t = time.time()
-        confirmed_distances_ids = []
-        confirmed_distances = []
+        wcd = self.wcd_distances(query_indices, candidate_ids)
+        order = np.argsort(wcd, kind='stable')
+        ranked = order if candidate_ids is None else candidate_ids[order]
+        wcd = wcd[order]
+        logging.debug('WCD done in ' + str(time.time() - t) + ' s.')
+
+        tier_size = max(WCD_TIER_SIZE, top)
+        counts = collections.Counter(queried=len(ranked))
+        similarities = []
+        # The workers confirm candidates ahead of the stopping rule, which is still applied in RWMD order, by batches
+        # submitted as the previous ones are consumed, so a tier that stops early leaves at most two batches behind.
+        # The query distances are copied once to shared memory for the workers.
+        with contextlib.ExitStack() as stack:
+            pool = shared_distances = None
+            if workers > 1:
+                pool = self._get_wmd_pool(workers)
+                shared_distances = stack.enter_context(shared_array(all_distances))
+            for first in range(0, len(ranked), tier_size):
+                if len(similarities) >= top and wcd[first] > similarities[top - 1][1]:
+                    break
+
+                # Relaxed Word Mover's Distance for selecting
+                t = time.time()
+                doc_ids = ranked[first:first + tier_size]
+                rwmd = self.rwmd_distances(all_distances, doc_ids)
+                tier_order = np.argsort(rwmd, kind='stable')
+                doc_ids = doc_ids[tier_order].tolist()
+                distances = zip(doc_ids, rwmd[tier_order].tolist())
+                counts['rwmd'] += len(doc_ids)
+                logging.debug('RWMD of tier ' + str(first // tier_size) + ' done in ' + str(time.time() - t) + ' s.')
+
+                if workers > 1:
+                    wmds = self._pooled_wmds(pool, query_indices, shared_distances, doc_ids, workers * WMD_CHUNK_SIZE)
+                else:
+                    wmds = self.wmdistances(query_indices, all_distances, doc_ids)
+                similarities, confirmed = self._confirm_candidates(distances, wmds, top, similarities)
+                counts['wmd'] += confirmed
+
+        # Every tier count is turned into the number of traces it eliminated.
+        counts['wcd'] = counts['queried'] - counts['rwmd']
+        counts['rwmd'] -= counts['wmd']
+        self.tier_counts.update(counts)
+        logging.debug('Traces eliminated by WCD: ' + str(counts['wcd']) + ', by RWMD: ' + str(counts['rwmd']) + ', WMD computed: ' + str(counts['wmd']))
+        return similarities
+
+    @staticmethod
+    def _pooled_wmds(pool, query_indices, all_distances, doc_ids, batch_size):
+        """
+        WMD of documents computed by a WorkerPool of _wmd_task, one batch of documents ahead of the ones consumed
+        :param all_distances: vocab x query words distance matrix, as given by shared_array
+        :return: iterator over the WMD of the documents, in the same order
+        """
+        pending = collections.deque()
+        for first in range(0, len(doc_ids), batch_size):
+            items = [(all_distances, query_indices, doc_id) for doc_id in doc_ids[first:first + batch_size]]
+            pending.append(pool.imap(items, chunksize=WMD_CHUNK_SIZE))
+            if len(pending) > 1:
+                yield from pending.popleft()
+        while pending:
+            yield from pending.popleft()
+
+    @staticmethod
+    def _confirm_candidates(distances, wmds, top, confirmed=()):
+        """
+        :param distances: (doc_id, rwmd) candidates sorted by their RWMD lower bound
+        :param wmds: iterator over the WMD of the candidates, in the same order
+        :param confirmed: (doc_id, distance) already confirmed, closest first
+        :return: (list of the top (doc_id, distance), closest first; number of WMD used)
+        """
+        confirmed_distances_ids = [doc_id for doc_id, _ in confirmed]
+        confirmed_distances = [distance for _, distance in confirmed]
+        used = 0
 
         for i, (doc_id, rwmd_distance) in enumerate(distances):
             # Stop once we have 'top' confirmed distances and all the rwmd lower bounds are higher than the smallest top confirmed distance.
@@ -169,8 +661,8 @@ class EmbeddingAlgo(object):
                 logging.debug(top)
                 break
 
-            doc_words_clean = self._extract_words_from_model(doc_id)
-            wmd = self.wmdistance(words_to_test_clean, doc_words_clean, all_distances)
+            wmd = next(wmds)
+            used += 1
 
             j = bisect.bisect(confirmed_distances, wmd)
             confirmed_distances.insert(j, wmd)
@@ -178,36 +670,222 @@ class EmbeddingAlgo(object):
 
         similarities = zip(confirmed_distances_ids, confirmed_distances)
 
-        logging.info('Query done in ' + str(time.time() - t) + ' s.')
-
-        return sorted(similarities, key=lambda v: v[1])[:top]
-
-    def signature_similarity(self, paths, signature1, signature2):
+        return sorted(similarities, key=lambda v: v[1])[:top], used
+
+    def _frequent_word_distances(self):
+        """:return: (sorted vocabulary indices of the most frequent words of the corpus, their pairwise cosine distances)"""
+        frequent = self._frequent_distances.get(self._model_version)
+        if frequent is None:
+            counts = np.bincount(self._corpus.token_ids, minlength=len(self._word_vectors()))
+            order = np.argsort(-counts, kind='stable')[:FREQUENT_WORDS]
+            indices = np.sort(order[counts[order] > 0])
+            vectors = self._word_vectors()[indices]
+            frequent = (indices, np.array(1.0 - np.dot(vectors, vectors.transpose()), dtype=self._dtype))
+            self._frequent_distances[self._model_version] = frequent
+        return frequent
+
+    def _word_distances(self, indices):
+        """
+        Pairwise cosine distances between distinct vocabulary indices, the ones between frequent words of the corpus
+        are read from _frequent_word_distances
+        """
+        frequent_indices, frequent_distances = self._frequent_word_distances()
+        positions = np.minimum(np.searchsorted(frequent_indices, indices), max(len(frequent_indices) - 1, 0))
+        frequent = (frequent_indices[positions] == indices) if len(frequent_indices) else np.zeros(len(indices), dtype=bool)
+        distances = np.zeros((len(indices), len(indices)), dtype=self._dtype)
+        distances[np.ix_(frequent, frequent)] = frequent_distances[np.ix_(positions[frequent], positions[frequent])]
+        rare = np.flatnonzero(~frequent)
+        if len(rare):
+            vectors = self._word_vectors()
+            rows = np.array(1.0 - np.dot(vectors[indices[rare]], vectors[indices].transpose()), dtype=self._dtype)
+            distances[rare] = rows
+            distances[:, rare] = rows.transpose()
+        # Rounding leaves tiny distances between a word and itself, which would depend on how they were computed.
+        np.fill_diagonal(distances, 0)
+        return distances
+
+    def signature_similarity(self, paths, signature1, signature2, top=None, bottom=None, download=True):
+        """
+        WMD between the stack traces of two signatures
+        :param top: if set, only the top closest pairs are returned
+        :param bottom: if set, only the bottom farthest pairs are returned; with top or bottom, the pairs whose RWMD
+                       lower bound and flow upper bound show they can't be among them are never computed
+        :param download: if false, only the traces of the crash dump files are compared, none is downloaded
+        :return: list of (trace1, trace2, distance), closest first
+        """
         model = self._model
-        model.init_sims(replace=True)
-        traces1 = StackTracesGetter.get_stack_traces_for_signature(paths, signature1)
-        traces2 = StackTracesGetter.get_stack_traces_for_signature(paths, signature2)
-
-        similarities = []
-        already_processed = set()
+        get_traces = StackTracesGetter.get_stack_traces_for_signature if download else StackTracesGetter.get_local_stack_traces_for_signature
+        traces1 = get_traces(paths, signature1)
+        traces2 = get_traces(paths, signature2)
 
+        vocab = model.wv.vocab
+        docs1 = []
         for doc1 in traces1:
-            words1 = np.unique([word for word in StackTraceProcessor.preprocess(doc1) if word in model.wv.vocab]).tolist()
-
-            if self.get_model_name() == 'Word2Vec':
-                distances = np.array(1.0 - np.dot(model.wv.vectors_norm, model.wv.vectors_norm[
-                    [model.wv.vocab[word].index for word in words1]].transpose()), dtype=np.double)
-            else:
-                distances = np.array(1.0 - np.dot(model.wv.vectors, model.wv.vectors[
-                    [model.wv.vocab[word].index for word in words1]].transpose()), dtype=np.double)
-
-            for doc2 in traces2:
-                words2 = [word for word in StackTraceProcessor.preprocess(doc2) if word in model.wv.vocab]
-
+            words1 = np.unique([word for word in StackTraceProcessor.preprocess(doc1) if word in vocab]).tolist()
+            docs1.append((doc1, words1, np.array([vocab[word].index for word in words1], dtype=np.int32)))
+        docs2 = []
+        for doc2 in traces2:
+            words2 = [word for word in StackTraceProcessor.preprocess(doc2) if word in vocab]
+            docs2.append((doc2, words2, np.array([vocab[word].index for word in words2], dtype=np.int32)))
+
+        pairs = []
+        already_processed = set()
+        for i, (_, words1, _) in enumerate(docs1):
+            for j, (_, words2, _) in enumerate(docs2):
                 if words1 == words2 or frozenset([tuple(words1), tuple(words2)]) in already_processed:
                     continue
                 already_processed.add(frozenset([tuple(words1), tuple(words2)]))
+                pairs.append((i, j))
+
+        # The distances are only needed between the words of the traces, computed once for all the pairs.
+        words = np.unique(np.concatenate([indices for _, _, indices in docs1 + docs2] + [np.zeros(0, dtype=np.int32)]))
+        distances = self._word_distances(words)
+        positions1 = [np.searchsorted(words, indices1) for _, _, indices1 in docs1]
+        positions2 = [np.searchsorted(words, indices2) for _, _, indices2 in docs2]
+        query_distances = [distances[:, query_positions] for query_positions in positions1]
+
+        def wmd(k):
+            i, j = pairs[k]
+            return self._trace_wmd(positions1[i], positions2[j], query_distances[i])
+
+        if top is None and bottom is None:
+            computed = {k: wmd(k) for k in range(len(pairs))}
+            selected = list(range(len(pairs)))
+        else:
+            lower, upper = self._wmd_bounds(distances, positions1, positions2, bool(bottom))
+            first, second = np.array(pairs, dtype=np.int64).reshape(-1, 2).transpose()
+            selected, computed = self._select_pairs(lower[first, second], upper[first, second] if bottom else None, wmd, top, bottom)
+            logging.debug('WMD computed for ' + str(len(computed)) + ' of ' + str(len(pairs)) + ' pairs.')
+
+        return [(docs1[pairs[k][0]][0], docs2[pairs[k][1]][0], computed[k]) for k in sorted(selected, key=lambda k: (computed[k], k))]
+
+    @staticmethod
+    def _trace_wmd(query_positions, doc_positions, query_distances):
+        """
+        _wmd between two traces given as positions in a words x words distance matrix, or as vocabulary indices in a
+        vocab x query words one, 0 when their words are all at distance 0 of each other, like a single word and itself:
+        moving them costs nothing, but _wmd returns inf for an all zeros cost matrix
+        """
+        if len(query_positions) and len(doc_positions) and not query_distances[doc_positions].any():
+            return 0.0
+        return EmbeddingAlgo._wmd(query_positions, doc_positions, query_distances)
 
-                similarities.append((doc1, doc2, self.wmdistance(words1, words2, distances)))
+    @staticmethod
+    def _wmd_bounds(distances, positions1, positions2, upper=True):
+        """
+        Bounds of the WMD between every two documents, given as positions in a words x words distance matrix
+        :param positions1: distinct words of the queries
+        :param positions2: words of the documents, repeated words included
+        :param upper: if false, only the lower bounds are computed
+        :return: (queries x documents RWMD lower bounds, queries x documents upper bounds or None), the upper bounds
+                 are the costs of the cheapest of two flows: the one spreading every query word over all the document
+                 words, and the one keeping the weight of the words shared by both documents in place and spreading the
+                 rest; both bounds are inf when a document has no words
+        """
+        # The bounds are computed in float64 like the WMD itself, so that only the solver error is left to BOUND_TOLERANCE.
+        distances = np.asarray(distances, dtype=np.double)
+
+        def nbow(positions):
+            weights = np.zeros((len(positions), len(distances)), dtype=distances.dtype)
+            for i, doc_positions in enumerate(positions):
+                if len(doc_positions):
+                    weights[i] = np.bincount(doc_positions, minlength=len(distances)) / len(doc_positions)
+            return weights
+
+        def nearest(positions):
+            # The distance matrix is symmetric, so the rows of the words of a document are its columns.
+            rows = np.zeros((len(positions), len(distances)), dtype=distances.dtype)
+            for i, doc_positions in enumerate(positions):
+                if len(doc_positions):
+                    rows[i] = np.min(distances[doc_positions], axis=0)
+            return rows
+
+        def shared_flow(weights1, weights2):
+            costs = np.zeros((len(weights1), len(weights2)), dtype=distances.dtype)
+            for i, query_positions in enumerate(positions1):
+                query_weights = weights1[i, query_positions]
+                kept = np.minimum(query_weights, weights2[:, query_positions])
+                moved = query_weights - kept
+                # The documents keep weights2 - kept, which only differs from weights2 on the query words.
+                spread = np.dot(moved, distances[query_positions])
+                cost = np.einsum('jw,jw->j', spread, weights2) - np.einsum('jw,jw->j', spread[:, query_positions], kept)
+                total = np.sum(moved, axis=1)
+                costs[i] = np.divide(cost, total, out=np.zeros_like(cost), where=total > 0)
+            return costs
+
+        weights1, weights2 = nbow(positions1), nbow(positions2)
+        empty = np.logical_or.outer(np.array([len(p) == 0 for p in positions1], dtype=bool), np.array([len(p) == 0 for p in positions2], dtype=bool))
+        lower = np.maximum(np.dot(nearest(positions1), weights2.transpose()), np.dot(weights1, nearest(positions2).transpose()))
+        lower[empty] = float('inf')
+        if not upper:
+            return lower, None
+
+        upper = np.minimum(np.dot(np.dot(weights1, distances), weights2.transpose()), shared_flow(weights1, weights2))
+        upper[empty] = float('inf')
+        return lower, upper
 
-        return sorted(similarities, key=lambda v: v[2])
+    @staticmethod
+    def _select_pairs(lower, upper, wmd, top=None, bottom=None):
+        """
+        The top pairs with the smallest WMD and the bottom ones with the largest WMD, ties broken like a stable sort of
+        all the pairs: the pairs are computed by increasing lower bound until the next lower bound is over the top
+        largest WMD kept, then by decreasing upper bound until the next upper bound is under the bottom smallest one
+        :param lower, upper: bounds of the WMD of every pair
+        :param wmd: callable returning the WMD of a pair
+        :return: (selected pairs, {pair: WMD} of every computed pair)
+        """
+        computed = {}
+
+        def distance(k):
+            if k not in computed:
+                computed[k] = wmd(k)
+            return computed[k]
+
+        # Max-heap of the closest (distance, pair) kept, as a min-heap of their opposite.
+        closest = []
+        if top:
+            for k in np.argsort(lower, kind='stable').tolist():
+                if len(closest) == top and lower[k] - BOUND_TOLERANCE > -closest[0][0]:
+                    break
+                item = (-distance(k), -k)
+                if len(closest) < top:
+                    heapq.heappush(closest, item)
+                elif item > closest[0]:
+                    heapq.heapreplace(closest, item)
+
+        farthest = []
+        if bottom:
+            for k in np.argsort(-upper, kind='stable').tolist():
+                if len(farthest) == bottom and upper[k] + BOUND_TOLERANCE < farthest[0][0]:
+                    break
+                item = (distance(k), k)
+                if len(farthest) < bottom:
+                    heapq.heappush(farthest, item)
+                elif item > farthest[0]:
+                    heapq.heapreplace(farthest, item)
+
+        return set(-k for _, k in closest) | set(k for _, k in farthest), computed
+
+    def pairwise_trace_distances(self, traces):
+        """
+        WMD between every two of the traces whose words in the vocabulary differ, each pair computed once (i < j); traces
+        with the same words in the same numbers are merged, as the WMD only depends on how many times each word occurs
+        :return: (the first trace of every bag of words, list of (i, j, distance) between them)
+        """
+        vocab = self._model.wv.vocab
+        distinct = {}
+        for trace in traces:
+            words = [word for word in StackTraceProcessor.preprocess(trace) if word in vocab]
+            distinct.setdefault(tuple(sorted(words)), (trace, np.array([vocab[word].index for word in words], dtype=np.int32)))
+        distinct = list(distinct.values())
+
+        words = np.unique(np.concatenate([indices for _, indices in distinct] + [np.zeros(0, dtype=np.int32)]))
+        distances = self._word_distances(words)
+        positions = [np.searchsorted(words, indices) for _, indices in distinct]
+        pairs = []
+        for i in range(len(distinct)):
+            query_positions = np.unique(positions[i])
+            query_distances = distances[:, query_positions]
+            for j in range(i + 1, len(distinct)):
+                pairs.append((i, j, self._trace_wmd(query_positions, positions[j], query_distances)))
+        return [trace for trace, _ in distinct], pairs
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+from crashsimilarity import utils
+from crashsimilarity.models.pool import WorkerPool
+
+
+def _knn_task(model, k, ann_probes, doc_ids):
+    return KNNGraph._nearest(model, doc_ids, k, ann_probes)
+
+
+class KNNGraph(object):
+    """
+    The k traces of the corpus of a model closest to each of its traces, by WMD
+    Attributes:
+        neighbors: traces x k doc ids, closest first, -1 when a trace has less than k neighbors at a finite distance
+        distances: traces x k WMD, inf for the missing neighbors
+    """
+
+    def __init__(self, neighbors, distances):
+        self.neighbors = neighbors
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.neighbors)
+
+    @staticmethod
+    def _nearest(model, doc_ids, k, ann_probes):
+        neighbors = np.full((len(doc_ids), k), -1, dtype=np.int32)
+        distances = np.full((len(doc_ids), k), float('inf'))
+        for i, doc_id in enumerate(doc_ids):
+            found = [(other, distance) for other, distance in model.nearest_traces(doc_id, k, ann_probes) if distance != float('inf')]
+            neighbors[i, :len(found)] = [other for other, _ in found]
+            distances[i, :len(found)] = [distance for _, distance in found]
+        return int(doc_ids[0]), neighbors, distances
+
+    @staticmethod
+    def _fingerprint(model, k, ann_probes):
+        """Identifies the vectors and the corpus of a model, whose doc ids are only stable for the same corpus"""
+        vectors_path, vectors_mtime = model.get_model_version()[:2]
+        corpus = hashlib.blake2b(np.ascontiguousarray(model.get_corpus().hashes).tobytes(), digest_size=16).hexdigest()
+        return {'vectors': [vectors_path, vectors_mtime], 'corpus': corpus, 'k': k, 'ann_probes': ann_probes}
+
+    @staticmethod
+    def _chunk_path(checkpoint_dir, first):
+        return os.path.join(checkpoint_dir, 'knn_{:010d}.npz'.format(first))
+
+    @staticmethod
+    def _open_checkpoint(checkpoint_dir, fingerprint):
+        """:return: the chunks already computed with the same fingerprint, keyed by their first doc id"""
+        state_path = os.path.join(checkpoint_dir, 'state.json')
+        try:
+            with open(state_path) as f:
+                same = json.load(f) == fingerprint
+        except (FileNotFoundError, ValueError):
+            same = False
+        if not same:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            utils.create_dir(checkpoint_dir)
+            with open(state_path, 'w') as f:
+                json.dump(fingerprint, f)
+            return {}
+
+        chunks = {}
+        for name in os.listdir(checkpoint_dir):
+            if name.startswith('knn_') and name.endswith('.npz'):
+                with np.load(os.path.join(checkpoint_dir, name)) as data:
+                    chunks[int(name[4:-4])] = (data['neighbors'], data['distances'])
+        return chunks
+
+    @staticmethod
+    def _save_chunk(checkpoint_dir, first, neighbors, distances):
+        path = KNNGraph._chunk_path(checkpoint_dir, first)
+        # np.savez appends .npz to names without it.
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, neighbors=neighbors, distances=distances)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def build(model, k=10, ann_probes=8, workers=None, checkpoint_dir=None, chunk_size=1000):
+        """
+        Search the nearest traces of every trace of the corpus: the ANN index and the RWMD lower bound prune
+        the candidates, so the exact WMD is only computed for the few that can be among the k nearest
+        :param model: EmbeddingAlgo whose corpus is searched
+        :param ann_probes: number of ANN lists searched per trace, None to search the whole corpus for every trace
+        :param workers: number of processes searching the traces (Default one per core)
+        :param checkpoint_dir: if set, every chunk of traces is saved there once searched, and a build interrupted
+                               with the same model and parameters only searches the missing chunks
+        :param chunk_size: number of traces searched by a worker at once
+        """
+        workers = workers or multiprocessing.cpu_count()
+        if ann_probes and model.get_ann_index() is None:
+            model.build_ann_index()
+
+        chunks = {}
+        if checkpoint_dir:
+            chunks = KNNGraph._open_checkpoint(checkpoint_dir, KNNGraph._fingerprint(model, k, ann_probes))
+        corpus_size = len(model.get_corpus())
+        todo = [np.arange(first, min(first + chunk_size, corpus_size), dtype=np.int64)
+                for first in range(0, corpus_size, chunk_size) if first not in chunks]
+        logging.info('Searching the nearest traces of ' + str(sum(map(len, todo))) + ' traces, ' + str(len(chunks)) + ' chunks already done.')
+
+        def searched():
+            if workers > 1 and len(todo) > 1:
+                with WorkerPool(workers, _knn_task, model, k, ann_probes) as pool:
+                    yield from pool.imap_unordered(todo)
+            else:
+                for doc_ids in todo:
+                    yield KNNGraph._nearest(model, doc_ids, k, ann_probes)
+
+        for first, neighbors, distances in searched():
+            chunks[first] = (neighbors, distances)
+            if checkpoint_dir:
+                KNNGraph._save_chunk(checkpoint_dir, first, neighbors, distances)
+
+        firsts = sorted(chunks)
+        return KNNGraph(np.concatenate([chunks[first][0] for first in firsts] + [np.zeros((0, k), dtype=np.int32)]),
+                        np.concatenate([chunks[first][1] for first in firsts] + [np.zeros((0, k))]))
+
+
+class SignatureClusters(object):
+    """
+    Groups of signatures whose traces are near each other in a KNNGraph
+    Attributes:
+        clusters: list of {'signatures': sorted signatures, 'traces': number of traces, 'links': number of kNN edges and
+                  shared traces between different signatures of the cluster}, with at least two signatures, largest first
+    """
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+
+    @staticmethod
+    def _find(parents, i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    @staticmethod
+    def build(graph, signatures, max_distance, min_links=2, shared=()):
+        """
+        Two signatures are linked by at least min_links edges of the graph, between traces of each of them closer than
+        max_distance, or traces of both of them; the clusters are the connected components of the linked signatures
+        :param signatures: signature of every trace of the graph
+        :param shared: (doc id, other signature) of the traces of the graph that were also read with another signature,
+                       see TraceCorpus.shared_traces: the graph only has the trace once, so every one counts as a link
+        """
+        signature_ids = {}
+        trace_signatures = np.array([signature_ids.setdefault(signature, len(signature_ids)) for signature in signatures], dtype=np.int64)
+        shared_doc_ids = np.array([doc_id for doc_id, _ in shared], dtype=np.int64)
+        shared_signatures = np.array([signature_ids.setdefault(signature, len(signature_ids)) for _, signature in shared], dtype=np.int64)
+        rows, columns = np.nonzero((graph.neighbors >= 0) & (graph.distances <= max_distance))
+        pairs = np.stack((np.concatenate((trace_signatures[rows], trace_signatures[shared_doc_ids])),
+                          np.concatenate((trace_signatures[graph.neighbors[rows, columns]], shared_signatures))), axis=1)
+        pairs = np.sort(pairs[pairs[:, 0] != pairs[:, 1]], axis=1)
+        edges, counts = np.unique(pairs, axis=0, return_counts=True) if len(pairs) else (np.zeros((0, 2), dtype=np.int64), np.zeros(0))
+
+        parents = list(range(len(signature_ids)))
+        for a, b in edges[counts >= min_links].tolist():
+            parents[SignatureClusters._find(parents, a)] = SignatureClusters._find(parents, b)
+        roots = np.array([SignatureClusters._find(parents, i) for i in range(len(signature_ids))], dtype=np.int64)
+
+        names = list(signature_ids)
+        inside = roots[edges[:, 0]] == roots[edges[:, 1]]
+        links = np.bincount(roots[edges[inside, 0]], weights=counts[inside], minlength=len(names))
+        traces = np.bincount(roots[trace_signatures], minlength=len(names))
+        clusters = []
+        for root in np.unique(roots).tolist():
+            members = sorted(names[i] for i in np.flatnonzero(roots == root).tolist())
+            if len(members) > 1:
+                clusters.append({'signatures': members, 'traces': int(traces[root]), 'links': int(links[root])})
+        return SignatureClusters(sorted(clusters, key=lambda cluster: (-len(cluster['signatures']), -cluster['traces'])))
+
+
+def cluster_signatures(model, k=10, ann_probes=8, max_distance=1.0, min_links=2, workers=None, checkpoint_dir=None):
+    """
+    Batch job finding the groups of signatures of the corpus of a model whose traces are near each other
+    :return: (SignatureClusters, KNNGraph, seconds spent in every stage)
+    """
+    timings = {}
+    t = time.time()
+    if ann_probes and model.get_ann_index() is None:
+        model.build_ann_index()
+    timings['index'] = time.time() - t
+
+    t = time.time()
+    graph = KNNGraph.build(model, k, ann_probes, workers, checkpoint_dir)
+    timings['knn'] = time.time() - t
+
+    t = time.time()
+    corpus = model.get_corpus()
+    signatures = [corpus.signature(doc_id) for doc_id in range(len(corpus))]
+    # The corpus keeps a trace read with several signatures once, with the first of them.
+    doc_ids, signature_ids = corpus.shared_traces()
+    shared = [(doc_id, corpus.signatures[signature_id]) for doc_id, signature_id in zip(doc_ids.tolist(), signature_ids.tolist())]
+    clusters = SignatureClusters.build(graph, signatures, max_distance, min_links, shared)
+    timings['cluster'] = time.time() - t
+
+    for stage, seconds in timings.items():
+        logging.info('Stage ' + stage + ' done in ' + str(seconds) + ' s.')
+    return clusters, graph, timings
@@ -0,0 +1,69 @@
+import csv
+import json
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+
+from crashsimilarity.models.pool import WorkerPool
+from crashsimilarity.stacktrace import StackTracesGetter
+
+REPORT_FIELDS = ['signature', 'traces', 'distinct_traces', 'pairs', 'mean', 'median', 'min', 'max', 'seconds']
+
+
+def _coherence_task(model, signature_traces):
+    return signature_coherence(model, *signature_traces)
+
+
+def signature_coherence(model, signature, traces):
+    """
+    Statistics of the WMD between the traces of a signature, the lower the more coherent the signature
+    :return: dict with the REPORT_FIELDS, the statistics are None when no two traces have a finite distance
+    """
+    t = time.time()
+    distinct, pairs = model.pairwise_trace_distances(traces)
+    distances = np.array([distance for _, _, distance in pairs], dtype=np.double)
+    distances = distances[np.isfinite(distances)]
+    row = {'signature': signature, 'traces': len(traces), 'distinct_traces': len(distinct), 'pairs': len(pairs)}
+    for name, statistic in [('mean', np.mean), ('median', np.median), ('min', np.min), ('max', np.max)]:
+        row[name] = float(statistic(distances)) if len(distances) else None
+    row['seconds'] = time.time() - t
+    return row
+
+
+def coherence_report(model, paths, signatures, workers=None, traces_num=100):
+    """
+    Coherence of many signatures with a model loaded once, their traces read from the trace stores of the crash dump files
+    :param workers: number of processes the signatures are spread across (Default one per core)
+    :param traces_num: maximum number of distinct traces per signature, the most frequent ones
+    :return: {'signatures': signature_coherence of every signature, in order, 'timings': seconds spent in every stage}
+    """
+    workers = workers or multiprocessing.cpu_count()
+    timings = {}
+    t = time.time()
+    work = [(signature, StackTracesGetter.get_local_stack_traces_for_signature(paths, signature, traces_num)) for signature in signatures]
+    timings['traces'] = time.time() - t
+
+    t = time.time()
+    if workers > 1 and len(work) > 1:
+        with WorkerPool(workers, _coherence_task, model) as pool:
+            rows = pool.map(work)
+    else:
+        rows = [signature_coherence(model, signature, traces) for signature, traces in work]
+    timings['coherence'] = time.time() - t
+
+    for stage, seconds in timings.items():
+        logging.info('Stage ' + stage + ' done in ' + str(seconds) + ' s.')
+    return {'signatures': rows, 'timings': timings}
+
+
+def write_report(report, file_name):
+    """Write a coherence_report as CSV if the file name ends with .csv, as JSON otherwise"""
+    with open(file_name, 'w', newline='') as f:
+        if file_name.endswith('.csv'):
+            writer = csv.DictWriter(f, REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(report['signatures'])
+        else:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,154 @@
+import numpy as np
+
+from crashsimilarity.stacktrace import StackTraceProcessor
+
+
+class TraceCorpus(object):
+    """
+    Compact store of the corpus a model was trained on, built once after training
+    Attributes:
+        token_ids: vocabulary indices of the words of all traces, concatenated
+        offsets: the words of trace i are token_ids[offsets[i]:offsets[i + 1]]
+        signature_ids: index in signatures of the signature of every trace
+        signatures: the distinct signatures of the corpus, the ones only read with duplicates of its traces included
+        hashes: StackTraceProcessor.trace_hash of every trace, computed before dropping words
+        sources: the crash dump files the traces were read from
+        duplicate_hashes, duplicate_signature_ids: trace_hash and signature id of the distinct traces that were skipped
+                                                   as duplicates, see shared_traces
+    """
+
+    def __init__(self, token_ids, offsets, signature_ids, signatures, hashes, sources, duplicate_hashes, duplicate_signature_ids):
+        self.token_ids = token_ids
+        self.offsets = offsets
+        self.signature_ids = signature_ids
+        self.signatures = signatures
+        self.hashes = hashes
+        self.sources = sources
+        self.duplicate_hashes = duplicate_hashes
+        self.duplicate_signature_ids = duplicate_signature_ids
+
+    @staticmethod
+    def build(documents, vocab, sources=(), duplicates=()):
+        """
+        :param documents: TaggedDocuments whose tags are [position, signature]
+        :param vocab: the vocabulary of the trained model, words outside of it are dropped
+        :param sources: the crash dump files the documents were read from
+        :param duplicates: see extend
+        """
+        empty = TraceCorpus(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), [], np.zeros(0, dtype=np.uint64), [],
+                            np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32))
+        return empty.extend(documents, vocab, sources, duplicates)
+
+    def extend(self, documents, vocab, sources=(), duplicates=()):
+        """
+        :param documents: TaggedDocuments whose tags are [position, signature], the ones already in the corpus are skipped
+        :param vocab: the vocabulary of the model, words outside of it are dropped
+        :param sources: the crash dump files the documents were read from
+        :param duplicates: (trace_hash, signature) of the traces skipped while reading the documents, see StackTraceProcessor.process
+        :return: a new TraceCorpus with the documents appended
+        """
+        token_ids = []
+        offsets = []
+        signature_ids = []
+        signatures = {signature: i for i, signature in enumerate(self.signatures)}
+        hashes = []
+        known = set(self.hashes.tolist())
+        duplicates = set(duplicates)
+        for doc in documents:
+            trace_hash = StackTraceProcessor.trace_hash(doc.words)
+            if trace_hash in known:
+                duplicates.add((trace_hash, doc.tags[1]))
+                continue
+            known.add(trace_hash)
+            token_ids.extend(vocab[word].index for word in doc.words if word in vocab)
+            offsets.append(len(token_ids))
+            signature_ids.append(signatures.setdefault(doc.tags[1], len(signatures)))
+            hashes.append(trace_hash)
+        duplicates = [(trace_hash, signatures.setdefault(signature, len(signatures))) for trace_hash, signature in sorted(duplicates)]
+        duplicates = np.unique(np.concatenate((np.stack((self.duplicate_hashes, self.duplicate_signature_ids.astype(np.uint64)), axis=1),
+                                               np.array(duplicates, dtype=np.uint64).reshape(-1, 2))), axis=0)
+
+        return TraceCorpus(np.concatenate((self.token_ids, np.array(token_ids, dtype=np.int32))),
+                           np.concatenate((self.offsets, self.offsets[-1] + np.array(offsets, dtype=np.int64))),
+                           np.concatenate((self.signature_ids, np.array(signature_ids, dtype=np.int32))),
+                           list(signatures),
+                           np.concatenate((self.hashes, np.array(hashes, dtype=np.uint64))),
+                           self.sources + [source for source in sources if source not in self.sources],
+                           duplicates[:, 0], duplicates[:, 1].astype(np.int32))
+
+    def save(self, file_name):
+        np.savez(file_name, token_ids=self.token_ids, offsets=self.offsets, signature_ids=self.signature_ids,
+                 signatures=np.array(self.signatures, dtype=str), hashes=self.hashes, sources=np.array(self.sources, dtype=str),
+                 duplicate_hashes=self.duplicate_hashes, duplicate_signature_ids=self.duplicate_signature_ids)
+
+    @staticmethod
+    def load(file_name):
+        try:
+            with np.load(file_name) as data:
+                # Corpora saved before the duplicates were recorded have none.
+                duplicate_hashes = data['duplicate_hashes'] if 'duplicate_hashes' in data else np.zeros(0, dtype=np.uint64)
+                duplicate_signature_ids = data['duplicate_signature_ids'] if 'duplicate_signature_ids' in data else np.zeros(0, dtype=np.int32)
+                return TraceCorpus(data['token_ids'], data['offsets'], data['signature_ids'], data['signatures'].tolist(),
+                                   data['hashes'], data['sources'].tolist(), duplicate_hashes, duplicate_signature_ids)
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def indices(self, doc_id):
+        return self.token_ids[self.offsets[doc_id]:self.offsets[doc_id + 1]]
+
+    def words(self, doc_id, index2word):
+        return [index2word[i] for i in self.indices(doc_id)]
+
+    def signature(self, doc_id):
+        return self.signatures[self.signature_ids[doc_id]]
+
+    def shared_traces(self):
+        """
+        Traces that were also read with another signature than the one they are kept with, the corpus only keeps
+        the first signature of every trace
+        :return: (doc ids, signature ids of the other signatures), one pair per trace and signature
+        """
+        if len(self.hashes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        order = np.argsort(self.hashes, kind='stable')
+        positions = np.minimum(np.searchsorted(self.hashes, self.duplicate_hashes, sorter=order), len(order) - 1)
+        doc_ids = order[positions]
+        shared = (self.hashes[doc_ids] == self.duplicate_hashes) & (self.signature_ids[doc_ids] != self.duplicate_signature_ids)
+        pairs = np.unique(np.stack((doc_ids[shared], self.duplicate_signature_ids[shared].astype(np.int64)), axis=1), axis=0)
+        return pairs[:, 0], pairs[:, 1].astype(np.int32)
+
+    def gather(self, doc_ids):
+        """
+        :return: (token_ids, offsets) of the given documents, in the same layout as the whole corpus
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        starts = self.offsets[doc_ids]
+        lengths = self.offsets[doc_ids + 1] - starts
+        offsets = np.zeros(len(doc_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return self.token_ids[positions], offsets
+
+    def mean_vectors(self, vectors, chunk_size=65536):
+        """
+        :param vectors: vocab x dimensions word vectors
+        :param chunk_size: number of traces whose word vectors are gathered at once
+        :return: mean of the word vectors of every trace, zero for traces without words in the vocabulary
+        """
+        means = np.zeros((len(self), vectors.shape[1]), dtype=vectors.dtype)
+        for first in range(0, len(self), chunk_size):
+            last = min(first + chunk_size, len(self))
+            offsets = self.offsets[first:last + 1]
+            lengths = np.diff(offsets)
+            non_empty = lengths > 0
+            if not non_empty.any():
+                continue
+
+            # Empty traces own no tokens, so the starts of the non-empty ones delimit every segment.
+            starts = offsets[:-1][non_empty] - offsets[0]
+            sums = np.add.reduceat(vectors[self.token_ids[offsets[0]:offsets[-1]]], starts, axis=0)
+            means[first:last][non_empty] = sums / lengths[non_empty, np.newaxis]
+        return means
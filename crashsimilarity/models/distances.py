@@ -1,3 +1,14 @@
+import numpy as np
+import pyximport
+
+try:
+    pyximport.install()
+    from crashsimilarity.models.structural import edit_distances as native_edit_distances
+except ImportError:
+    # Without a compiler, the batched edit distances are computed in Python.
+    native_edit_distances = None
+
+
 def structural_word_distance(w1, w2):
     parts1 = w1.split('::')
     parts2 = w2.split('::')
@@ -31,3 +42,102 @@ def edit_distance(s1, s2, ins_cost=lambda a, b: 1, del_cost=lambda a, b: 1, subs
 
 def edit_distance_structural(trace1, trace2):
     return edit_distance(trace1, trace2, structural_word_distance, structural_word_distance, structural_word_distance)
+
+
+def intern_traces(traces):
+    """
+    :return: (frame ids of all the traces, concatenated; offsets, the frames of trace i are ids[offsets[i]:offsets[i + 1]];
+             the distinct frames, in the order of their ids)
+    """
+    frame_ids = {}
+    ids = [frame_ids.setdefault(frame, len(frame_ids)) for trace in traces for frame in trace]
+    offsets = np.zeros(len(traces) + 1, dtype=np.int64)
+    np.cumsum([len(trace) for trace in traces], out=offsets[1:])
+    return np.array(ids, dtype=np.int32), offsets, list(frame_ids)
+
+
+def structural_costs(frames, chunk_size=1 << 24):
+    """
+    structural_word_distance between every two frames, comparing their '::' components interned once
+    :param chunk_size: number of components compared at once
+    """
+    parts = [frame.split('::') for frame in frames]
+    lengths = np.array([len(p) for p in parts], dtype=np.int64)
+    components = {}
+    table = np.full((len(frames), lengths.max() if len(frames) else 0), -1, dtype=np.int64)
+    for i, p in enumerate(parts):
+        table[i, :len(p)] = [components.setdefault(component, len(components)) for component in p]
+
+    costs = np.zeros((len(frames), len(frames)), dtype=np.double)
+    rows = max(1, chunk_size // max(table.size, 1))
+    for first in range(0, len(frames), rows):
+        last = min(first + rows, len(frames))
+        # Length of the common prefix of components, which padding can't extend past the shorter frame.
+        prefix = np.cumprod(table[first:last, np.newaxis] == table[np.newaxis], axis=2).sum(axis=2)
+        prefix = np.minimum(prefix, np.minimum.outer(lengths[first:last], lengths))
+        costs[first:last] = 1 - prefix / np.maximum.outer(lengths[first:last], lengths)
+    return costs
+
+
+def _edit_distances_python(ids, offsets, firsts, seconds, costs, max_distance):
+    """Same as structural.edit_distances, without building the extension"""
+    distances = np.empty(len(firsts), dtype=np.double)
+    for pair, (a, b) in enumerate(zip(firsts.tolist(), seconds.tolist())):
+        s1 = ids[offsets[a]:offsets[a + 1]].tolist()
+        s2 = ids[offsets[b]:offsets[b + 1]].tolist()
+        if len(s1) < len(s2):
+            s1, s2 = s2, s1
+        if len(s2) == 0:
+            distances[pair] = len(s1) if len(s1) <= max_distance else float('inf')
+            continue
+
+        deletions = [costs[s2[j], s2[j - 1]] for j in range(len(s2))]
+        previous_row = list(range(len(s2) + 1))
+        for i, c1 in enumerate(s1):
+            row_costs = costs[c1, s2].tolist()
+            current_row = [i + 1]
+            for j in range(len(s2)):
+                current_row.append(min(previous_row[j + 1] + row_costs[j], current_row[j] + deletions[j], previous_row[j] + row_costs[j]))
+            if min(current_row) > max_distance:
+                break
+            previous_row = current_row
+        else:
+            distances[pair] = previous_row[-1] if previous_row[-1] <= max_distance else float('inf')
+            continue
+        distances[pair] = float('inf')
+    return distances
+
+
+def _edit_distances(traces, firsts, seconds, max_distance):
+    ids, offsets, frames = intern_traces(traces)
+    costs = structural_costs(frames)
+    max_distance = float('inf') if max_distance is None else float(max_distance)
+    if native_edit_distances is None:
+        return _edit_distances_python(ids, offsets, firsts, seconds, costs, max_distance)
+    return native_edit_distances(ids, offsets, firsts, seconds, costs, max_distance)
+
+
+def edit_distances_structural(trace, traces, max_distance=None):
+    """
+    edit_distance_structural between a trace and every trace of traces, on frames interned and compared once
+    :param max_distance: if set, the distances over it are inf, and computed only until they exceed it
+    """
+    firsts = np.zeros(len(traces), dtype=np.int64)
+    seconds = np.arange(1, len(traces) + 1, dtype=np.int64)
+    return _edit_distances([trace] + list(traces), firsts, seconds, max_distance)
+
+
+def pairwise_edit_distances_structural(traces, max_distance=None):
+    """
+    Matrix of edit_distance_structural(traces[i], traces[j]), see edit_distances_structural
+    edit_distance_structural only depends on the order of two traces of the same length, so the other pairs are computed once
+    """
+    lengths = np.array([len(trace) for trace in traces])
+    firsts, seconds = np.triu_indices(len(traces), 1)
+    same_length = lengths[firsts] == lengths[seconds]
+    firsts, seconds = np.concatenate((firsts, seconds[same_length])), np.concatenate((seconds, firsts[same_length]))
+    distances = np.zeros((len(traces), len(traces)), dtype=np.double)
+    distances[firsts, seconds] = _edit_distances(traces, firsts.astype(np.int64), seconds.astype(np.int64), max_distance)
+    symmetric = np.triu(np.ones_like(distances, dtype=bool), 1) & ~(lengths[:, np.newaxis] == lengths)
+    distances.T[symmetric] = distances[symmetric]
+    return distances
@@ -1,34 +1,32 @@
 import multiprocessing
 import os
-import random
 import time
 import logging
 
 import gensim
 from datetime import datetime
 
-from crashsimilarity import utils
 from crashsimilarity.models.base import EmbeddingAlgo
 
 
 class Doc2Vec(EmbeddingAlgo):
-    def _read_corpus(self):
-        return [gensim.models.doc2vec.TaggedDocument(trace, [i, signature]) for i, (trace, signature) in enumerate(self._read_traces())]
+    def _load_model(self, file_name):
+        return gensim.models.Doc2Vec.load(file_name, mmap='c')
 
-    def _extract_words_from_model(self, doc_id):
-        return [w for w in self._corpus[doc_id].words if w in self._model.wv.vocab]
-
-    def _extract_indices_from_model(self, doc_id):
-        return [self._model.wv.vocab[word].index for word in self._corpus[doc_id].words if word in self._model.wv.vocab]
+    def _update_model(self, current_date, replay_ratio):
+        # gensim does not grow the document vectors when the vocabulary of a Doc2Vec model is updated,
+        # so the new traces couldn't be tagged.
+        logging.warning('Doc2Vec models can not be updated incrementally, training a new model.')
+        return False
 
     def _train_model(self, force_train=False):
         current_date = datetime.now().strftime('%d%b%Y')
-        self.delete_old_models(current_date, 'trained_models/doc2vec/', force_train)
+        self.delete_old_models(current_date, self._models_dir(), force_train)
 
-        if os.path.exists('trained_models/doc2vec/stack_traces_' + current_date + '_model.pickle'):
-            return gensim.models.Doc2Vec.load('trained_models/doc2vec/stack_traces_' + current_date + '_model.pickle')
+        if os.path.exists(self._model_path(current_date)):
+            return self._load_model(self._model_path(current_date))
 
-        random.shuffle(self._corpus)
+        self._shuffle_corpus()
 
         logging.debug('CORPUS LENGTH: ' + str(len(self._corpus)))
         logging.debug(self._corpus[0])
@@ -47,7 +45,6 @@ class Doc2Vec(EmbeddingAlgo):
         model.train(self._corpus, total_examples=model.corpus_count, epochs=model.epochs)
         logging.info('Model trained in ' + str(time.time() - t) + ' s.')
 
-        utils.create_dir('trained_models/doc2vec')
-        model.save('trained_models/doc2vec/stack_traces_' + current_date + '_model.pickle')
+        self._save_model(model, current_date)
 
         return model
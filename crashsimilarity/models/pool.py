@@ -0,0 +1,130 @@
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, the NumPy arrays of the state are pickled along with the rest of it.
+    shared_memory = None
+
+# Function and state of the tasks of the worker, set once by _init_worker.
+_worker_state = None
+# Shared memory blocks attached by the worker, which own the buffers of its state arrays.
+_worker_blocks = []
+# (shared memory block, array) of the last SharedArray sent to the worker with a task.
+_task_array = None
+
+
+class SharedArray(object):
+    """Handle of a NumPy array copied to a shared memory block, pickled as the name of the block, shape and dtype"""
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @staticmethod
+    def share(array):
+        """:return: (the SharedMemory block the array was copied to, its SharedArray handle)"""
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        return block, SharedArray(block.name, array.shape, array.dtype)
+
+    def attach(self):
+        block = shared_memory.SharedMemory(self.name)
+        _worker_blocks.append(block)
+        return np.ndarray(self.shape, self.dtype, buffer=block.buf)
+
+
+@contextmanager
+def shared_array(array):
+    """
+    SharedArray handle of a copy of the array, for the tasks of a WorkerPool to read it with task_array instead of
+    pickling it; the block is released on exit. Without shared memory (Python < 3.8), the array itself.
+    """
+    if shared_memory is None:
+        yield array
+        return
+    block, handle = SharedArray.share(array)
+    try:
+        yield handle
+    finally:
+        block.close()
+        block.unlink()
+
+
+def task_array(value):
+    """
+    Array of a SharedArray sent with a task, attached once by the worker until a task sends another one; any other
+    value is returned as is
+    """
+    global _task_array
+    if not isinstance(value, SharedArray):
+        return value
+    if _task_array is None or _task_array[0].name != value.name:
+        if _task_array is not None:
+            # The array has to be dropped before its block can be closed.
+            block, _task_array = _task_array[0], None
+            block.close()
+        block = shared_memory.SharedMemory(value.name)
+        _task_array = (block, np.ndarray(value.shape, value.dtype, buffer=block.buf))
+    return _task_array[1]
+
+
+def _init_worker(function, state):
+    global _worker_state
+    _worker_state = (function, [value.attach() if isinstance(value, SharedArray) else value for value in state])
+
+
+def _run_task(item):
+    function, state = _worker_state
+    return function(*state, item)
+
+
+class WorkerPool(object):
+    """
+    Pool of processes running function(*state, item) for every item mapped, the state is sent to every worker once
+    instead of with every task: forked workers inherit it without copying, otherwise it is pickled once per worker,
+    except its NumPy arrays, which are copied once to shared memory blocks mapped by all the workers (Python 3.8+)
+    """
+
+    def __init__(self, workers, function, *state, start_method=None):
+        """
+        :param function: module level function, so that it can be pickled
+        :param start_method: multiprocessing start method of the workers (Default the one of the platform)
+        """
+        context = multiprocessing.get_context(start_method)
+        self._blocks = []
+        if context.get_start_method() != 'fork' and shared_memory is not None:
+            state = list(state)
+            for i, value in enumerate(state):
+                if isinstance(value, np.ndarray):
+                    block, state[i] = SharedArray.share(value)
+                    self._blocks.append(block)
+        self._pool = context.Pool(workers, initializer=_init_worker, initargs=(function, tuple(state)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.terminate()
+
+    def terminate(self):
+        """Stop the workers, the tasks they did not finish are dropped"""
+        self._pool.terminate()
+        self._pool.join()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def map(self, items, chunksize=1):
+        return self._pool.map(_run_task, items, chunksize)
+
+    def imap(self, items, chunksize=1):
+        return self._pool.imap(_run_task, items, chunksize)
+
+    def imap_unordered(self, items, chunksize=1):
+        return self._pool.imap_unordered(_run_task, items, chunksize)
@@ -0,0 +1,64 @@
+import numpy as np
+import pyximport
+
+try:
+    pyximport.install()
+    from crashsimilarity.models.quantized_dot import dot_int8 as native_dot_int8
+except ImportError:
+    # Without a compiler, the products are computed by NumPy in chunks.
+    native_dot_int8 = None
+
+
+def _dot_int8(codes, query, chunk_size=65536):
+    if native_dot_int8:
+        return native_dot_int8(np.ascontiguousarray(codes), np.ascontiguousarray(query))
+    return np.concatenate([np.dot(codes[i:i + chunk_size].astype(np.int32), query.astype(np.int32))
+                           for i in range(0, len(codes), chunk_size)] + [np.zeros(0, dtype=np.int32)])
+
+
+class QuantizedMatrix(object):
+    """
+    int8 scalar quantization of the rows of a float32 matrix, read with a quarter of the memory bandwidth by its products
+    Attributes:
+        codes: rows x columns int8 codes, row i is codes[i] * scales[i] within scales[i] / 2
+        scales: scale of every row
+        l1_norms: L1 norm of the codes of every row
+    """
+
+    def __init__(self, codes, scales, l1_norms):
+        self.codes = codes
+        self.scales = scales
+        self.l1_norms = l1_norms
+
+    @staticmethod
+    def _quantize(vectors):
+        """:return: (int8 codes, scales) of the rows of vectors"""
+        scales = np.maximum(np.max(np.abs(vectors), axis=-1), np.finfo(np.float32).tiny).astype(np.float32) / 127
+        return np.round(vectors / scales[..., np.newaxis]).astype(np.int8), scales
+
+    @staticmethod
+    def build(matrix, chunk_size=65536):
+        codes = np.zeros(matrix.shape, dtype=np.int8)
+        scales = np.zeros(len(matrix), dtype=np.float32)
+        for first in range(0, len(matrix), chunk_size):
+            codes[first:first + chunk_size], scales[first:first + chunk_size] = QuantizedMatrix._quantize(np.asarray(matrix[first:first + chunk_size], dtype=np.float32))
+        return QuantizedMatrix(codes, scales, np.sum(np.abs(codes, dtype=np.int32), axis=1).astype(np.float32))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def dot_upper_bound(self, query, rows=None):
+        """
+        The query is quantized too, and the rounding errors of both are bounded, so that the result is never under
+        the exact product
+        :param query: float vector
+        :param rows: rows multiplied by the query (Default all of them)
+        :return: float32 upper bound of the product of every row of the original matrix with the query
+        """
+        codes, scales, l1_norms = (self.codes, self.scales, self.l1_norms) if rows is None else (self.codes[rows], self.scales[rows], self.l1_norms[rows])
+        query = np.asarray(query, dtype=np.float32)
+        query_codes, query_scale = self._quantize(query)
+        products = _dot_int8(codes, query_codes).astype(np.float32)
+        # |c.q - s * sq * (codes.query_codes)| <= s / 2 * |q|_1 + s * sq / 2 * |codes|_1
+        errors = scales / 2 * (np.sum(np.abs(query)) + query_scale * l1_norms)
+        return scales * query_scale * products + errors
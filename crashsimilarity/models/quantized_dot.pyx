@@ -0,0 +1,20 @@
+# distutils: extra_compile_args = -O3
+# cython: language_level=3, boundscheck=False, wraparound=False
+import numpy as np
+
+
+def dot_int8(const signed char[:, ::1] codes, const signed char[::1] query):
+    """
+    Product of int8 rows with an int8 vector, accumulated in int32 so that the compiler vectorizes the inner loop
+    :return: int32 product of every row with the query
+    """
+    cdef Py_ssize_t i, j, n = codes.shape[0], d = codes.shape[1]
+    result = np.empty(n, dtype=np.int32)
+    cdef int[::1] products = result
+    cdef int acc
+    for i in range(n):
+        acc = 0
+        for j in range(d):
+            acc = acc + codes[i, j] * query[j]
+        products[i] = acc
+    return result
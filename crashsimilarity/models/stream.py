@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import gensim
+import numpy as np
+
+from crashsimilarity import utils
+from crashsimilarity.models.corpus import TraceCorpus
+from crashsimilarity.stacktrace import StackTraceProcessor
+
+
+class HashSet(object):
+    """
+    Set of 64-bit trace hashes kept in a sorted array, 8 bytes per hash;
+    the hashes added since the last flush are kept in a regular set
+    """
+
+    def __init__(self, hashes=()):
+        self._sorted = np.unique(np.asarray(hashes, dtype=np.uint64))
+        self._recent = set()
+
+    def __contains__(self, trace_hash):
+        if trace_hash in self._recent:
+            return True
+        i = np.searchsorted(self._sorted, np.uint64(trace_hash))
+        return i < len(self._sorted) and int(self._sorted[i]) == trace_hash
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, trace_hash):
+        self._recent.add(trace_hash)
+
+    def flush(self):
+        if self._recent:
+            recent = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            self._sorted = np.union1d(self._sorted, recent)
+            self._recent = set()
+
+
+class _Words(object):
+    def __init__(self, corpus):
+        self._corpus = corpus
+
+    def __iter__(self):
+        for doc in self._corpus:
+            yield doc.words
+
+
+class StreamingCorpus(object):
+    """
+    Deduplicated traces stored on disk and memory-mapped, re-iterable as TaggedDocuments for gensim training
+    The directory contains:
+        frames.jsonl, signatures.jsonl: string tables, one JSON string per line
+        tokens.bin: frame ids of all the traces (int32)
+        offsets.bin: end offset in tokens.bin of every trace (int64)
+        signature_ids.bin: signature id of every trace (int32)
+        hashes.bin: StackTraceProcessor.trace_hash of every trace (uint64)
+        duplicate_hashes.bin, duplicate_signature_ids.bin: trace_hash and signature id of the traces skipped as duplicates,
+                                                           once per file (uint64, int32), see TraceCorpus.shared_traces
+        state.json: the ingested crash dump files and the sizes of the files above once the last one was ingested
+    Attributes:
+        block_size: number of consecutive traces read at once, every read shuffles the blocks and the traces inside them
+    """
+    _ARRAYS = [('tokens', np.int32), ('offsets', np.int64), ('signature_ids', np.int32), ('hashes', np.uint64),
+               ('duplicate_hashes', np.uint64), ('duplicate_signature_ids', np.int32)]
+    _TABLES = ['frames', 'signatures']
+
+    def __init__(self, directory, block_size=4096, seed=None):
+        self.directory = directory
+        self.block_size = block_size
+        self._random = random.Random(seed)
+        self.sources = self._load_state(directory)['files']
+        self.frames = self._read_table(directory, 'frames')
+        self.signatures = self._read_table(directory, 'signatures')
+        for name, dtype in self._ARRAYS:
+            setattr(self, name, self._map(directory, name, dtype))
+
+    @staticmethod
+    def _path(directory, name):
+        extension = '.jsonl' if name in StreamingCorpus._TABLES else '.bin'
+        return os.path.join(directory, name + extension)
+
+    @staticmethod
+    def _load_state(directory):
+        try:
+            with open(os.path.join(directory, 'state.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            names = [name for name, _ in StreamingCorpus._ARRAYS] + StreamingCorpus._TABLES
+            return {'files': [], 'sizes': {name: 0 for name in names}}
+
+    @staticmethod
+    def _save_state(directory, state):
+        path = os.path.join(directory, 'state.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _read_table(directory, name):
+        with open(StreamingCorpus._path(directory, name), encoding='utf8') as f:
+            return [json.loads(line) for line in f]
+
+    @staticmethod
+    def _map(directory, name, dtype):
+        path = StreamingCorpus._path(directory, name)
+        # Corpora ingested before the duplicates were recorded have no files for them.
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @staticmethod
+    def ingest(fnames, directory, take_top_funcs=10, block_size=4096, seed=None):
+        """
+        Append the deduplicated traces of the files that were not ingested yet to the corpus stored in directory
+        Every file is committed once it is completely ingested, so an interrupted ingestion resumes after the last committed file
+        If the corpus contains files that are not among fnames anymore, it is rebuilt from fnames, so that it only ever
+        contains the traces of the given window of files
+        :return: the StreamingCorpus
+        """
+        if set(StreamingCorpus._load_state(directory)['files']) - set(fnames):
+            StreamingCorpus._rebuild(fnames, directory, take_top_funcs)
+        else:
+            StreamingCorpus._append(fnames, directory, take_top_funcs)
+        return StreamingCorpus(directory, block_size, seed)
+
+    @staticmethod
+    def _rebuild(fnames, directory, take_top_funcs):
+        """
+        Ingest the files into a new directory swapped in place of the old one: a trace of the window may have been
+        deduplicated against a trace of a file that is dropped, so the traces can't be kept file by file
+        The files of the old corpus are unlinked, not truncated, so the processes that memory-mapped them can still read them
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        logging.info('Rebuilding the corpus of ' + directory + ' from ' + str(len(fnames)) + ' files.')
+        tmp_dir = tempfile.mkdtemp(dir=parent)
+        try:
+            StreamingCorpus._append(fnames, tmp_dir, take_top_funcs)
+            old_dir = tempfile.mkdtemp(dir=parent)
+            # An interruption between the two renames leaves no corpus, which is ingested from scratch the next time.
+            os.replace(directory, os.path.join(old_dir, 'corpus'))
+            os.replace(tmp_dir, directory)
+            shutil.rmtree(old_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def _append(fnames, directory, take_top_funcs):
+        utils.create_dir(directory)
+        state = StreamingCorpus._load_state(directory)
+        names = [name for name, _ in StreamingCorpus._ARRAYS] + StreamingCorpus._TABLES
+        # Drop what was written after the last commit.
+        for name in names:
+            with open(StreamingCorpus._path(directory, name), 'ab') as f:
+                f.truncate(state['sizes'].get(name, 0))
+
+        frames = {frame: i for i, frame in enumerate(StreamingCorpus._read_table(directory, 'frames'))}
+        signatures = {signature: i for i, signature in enumerate(StreamingCorpus._read_table(directory, 'signatures'))}
+        seen = HashSet(np.fromfile(StreamingCorpus._path(directory, 'hashes'), dtype=np.uint64))
+        token_count = state['sizes']['tokens'] // np.dtype(np.int32).itemsize
+
+        files = {name: open(StreamingCorpus._path(directory, name), 'ab') for name in names}
+        try:
+            for fname in fnames:
+                if fname in state['files']:
+                    continue
+
+                t = time.time()
+                trace_count = 0
+                duplicates = set()
+                for processed, signature in StackTraceProcessor.process_stores([fname], take_top_funcs, seen, duplicates=duplicates):
+                    frame_ids = []
+                    for frame in processed:
+                        if frame not in frames:
+                            frames[frame] = len(frames)
+                            files['frames'].write((json.dumps(frame) + '\n').encode('utf8'))
+                        frame_ids.append(frames[frame])
+                    if signature not in signatures:
+                        signatures[signature] = len(signatures)
+                        files['signatures'].write((json.dumps(signature) + '\n').encode('utf8'))
+
+                    token_count += len(frame_ids)
+                    files['tokens'].write(np.array(frame_ids, dtype=np.int32).tobytes())
+                    files['offsets'].write(np.array([token_count], dtype=np.int64).tobytes())
+                    files['signature_ids'].write(np.array([signatures[signature]], dtype=np.int32).tobytes())
+                    files['hashes'].write(np.array([StackTraceProcessor.trace_hash(processed)], dtype=np.uint64).tobytes())
+                    trace_count += 1
+                for trace_hash, signature in sorted(duplicates):
+                    if signature not in signatures:
+                        signatures[signature] = len(signatures)
+                        files['signatures'].write((json.dumps(signature) + '\n').encode('utf8'))
+                    files['duplicate_hashes'].write(np.array([trace_hash], dtype=np.uint64).tobytes())
+                    files['duplicate_signature_ids'].write(np.array([signatures[signature]], dtype=np.int32).tobytes())
+                seen.flush()
+
+                for f in files.values():
+                    f.flush()
+                    os.fsync(f.fileno())
+                state['files'].append(fname)
+                state['sizes'] = {name: os.path.getsize(StreamingCorpus._path(directory, name)) for name in names}
+                StreamingCorpus._save_state(directory, state)
+                logging.info('Ingested ' + str(trace_count) + ' new traces from ' + fname + ' in ' + str(time.time() - t) + ' s.')
+        finally:
+            for f in files.values():
+                f.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _start(self, doc_id):
+        return int(self.offsets[doc_id - 1]) if doc_id else 0
+
+    def __getitem__(self, doc_id):
+        words = [self.frames[i] for i in self.tokens[self._start(doc_id):self.offsets[doc_id]]]
+        return gensim.models.doc2vec.TaggedDocument(words, [doc_id, self.signatures[self.signature_ids[doc_id]]])
+
+    def __iter__(self):
+        blocks = list(range(0, len(self), self.block_size))
+        self._random.shuffle(blocks)
+        for first in blocks:
+            last = min(first + self.block_size, len(self))
+            start = self._start(first)
+            tokens = self.tokens[start:self.offsets[last - 1]].tolist()
+            ends = (self.offsets[first:last] - start).tolist()
+            signature_ids = self.signature_ids[first:last].tolist()
+
+            positions = list(range(last - first))
+            self._random.shuffle(positions)
+            for i in positions:
+                words = [self.frames[frame_id] for frame_id in tokens[ends[i - 1] if i else 0:ends[i]]]
+                yield gensim.models.doc2vec.TaggedDocument(words, [first + i, self.signatures[signature_ids[i]]])
+
+    def sentences(self):
+        """Re-iterable over the words of the traces, for Word2Vec"""
+        return _Words(self)
+
+    def to_trace_corpus(self, vocab):
+        """
+        :param vocab: the vocabulary of the trained model, words outside of it are dropped
+        :return: the TraceCorpus of the traces, in their order on disk
+        """
+        frame_indices = np.array([vocab[frame].index if frame in vocab else -1 for frame in self.frames], dtype=np.int32)
+        token_ids = frame_indices[self.tokens]
+        kept = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum(token_ids >= 0, out=kept[1:])
+        offsets = kept[np.concatenate(([0], self.offsets))]
+        duplicates = np.unique(np.stack((self.duplicate_hashes, self.duplicate_signature_ids.astype(np.uint64)), axis=1), axis=0)
+        return TraceCorpus(token_ids[token_ids >= 0], offsets, np.array(self.signature_ids), list(self.signatures),
+                           np.array(self.hashes), list(self.sources), duplicates[:, 0], duplicates[:, 1].astype(np.int32))
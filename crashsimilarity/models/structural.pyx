@@ -0,0 +1,87 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+from libc.math cimport INFINITY
+
+import numpy as np
+
+
+def edit_distances(const int[::1] ids, const long long[::1] offsets, const long long[::1] firsts, const long long[::1] seconds,
+                   const double[:, ::1] costs, double max_distance):
+    """
+    edit_distance_structural between pairs of interned traces, see distances.edit_distances_structural
+    :param ids: frame ids of all the traces, concatenated, the frames of trace i are ids[offsets[i]:offsets[i + 1]]
+    :param firsts, seconds: traces of every pair
+    :param costs: structural distance between every two frames
+    :param max_distance: distances over it are inf, and the cells of the DP over it are never computed
+    """
+    cdef Py_ssize_t pair, i, j, n, m, lo, hi, start, a, b, last
+    cdef double insertion, deletion, substitution, value, cost
+    result = np.empty(len(firsts), dtype=np.double)
+    cdef double[::1] distances = result
+    cdef int longest = 0
+    for i in range(len(offsets) - 1):
+        longest = max(longest, offsets[i + 1] - offsets[i])
+    cdef double[::1] previous = np.empty(longest + 1, dtype=np.double)
+    cdef double[::1] current = np.empty(longest + 1, dtype=np.double)
+    cdef double[::1] deletions = np.empty(longest + 1, dtype=np.double)
+    cdef double[::1] swap
+
+    for pair in range(len(firsts)):
+        a, b = firsts[pair], seconds[pair]
+        if offsets[a + 1] - offsets[a] < offsets[b + 1] - offsets[b]:
+            a, b = b, a
+        n = offsets[a + 1] - offsets[a]
+        m = offsets[b + 1] - offsets[b]
+        if m == 0:
+            distances[pair] = n if n <= max_distance else INFINITY
+            continue
+
+        for j in range(m):
+            # The deletion cost of edit_distance compares a frame with the previous one, the last one for the first.
+            deletions[j] = costs[ids[offsets[b] + j], ids[offsets[b] + (j - 1 if j else m - 1)]]
+        for j in range(m + 1):
+            previous[j] = j if j <= max_distance else INFINITY
+        # Columns of the previous row that can be under max_distance.
+        lo = 0
+        hi = m if max_distance >= m else <Py_ssize_t> max_distance
+
+        for i in range(n):
+            current[0] = i + 1 if i + 1 <= max_distance else INFINITY
+            start = 0 if current[0] != INFINITY else max(lo - 1, 0)
+            for j in range(1, start + 1):
+                current[j] = INFINITY
+            last = -1
+            if current[0] != INFINITY:
+                last = 0
+            j = start
+            while j < m:
+                if j > hi and current[j] == INFINITY:
+                    break
+                cost = costs[ids[offsets[a] + i], ids[offsets[b] + j]]
+                insertion = previous[j + 1] + cost
+                deletion = current[j] + deletions[j]
+                substitution = previous[j] + cost
+                value = min(insertion, deletion, substitution)
+                if value > max_distance:
+                    value = INFINITY
+                else:
+                    if last == -1:
+                        lo = j + 1
+                    last = j + 1
+                current[j + 1] = value
+                j += 1
+            for j in range(j + 1, m + 1):
+                current[j] = INFINITY
+            if last == -1:
+                break
+            if current[0] != INFINITY:
+                lo = 0
+            hi = last
+            swap = previous
+            previous = current
+            current = swap
+        else:
+            distances[pair] = previous[m]
+            continue
+        distances[pair] = INFINITY
+
+    return result
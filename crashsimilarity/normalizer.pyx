@@ -0,0 +1,129 @@
+# distutils: language = c++
+# cython: language_level=3, boundscheck=False, wraparound=False
+from cython.operator cimport dereference
+from libc.string cimport memcmp
+from libcpp.string cimport string
+from libcpp.unordered_map cimport unordered_map
+from libcpp.vector cimport vector
+
+import numpy as np
+
+
+cdef extern from "Python.h":
+    const char* PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t* size) except NULL
+    # str.isascii is Python 3.7+.
+    Py_UCS4 PyUnicode_MAX_CHAR_VALUE(object unicode)
+
+
+cdef inline bint is_space(unsigned char c):
+    # The ASCII characters removed by str.strip.
+    return c == 32 or 9 <= c <= 13 or 28 <= c <= 31
+
+
+cdef bint contains(const unsigned char* s, Py_ssize_t n, const char* pattern, Py_ssize_t m):
+    cdef Py_ssize_t k
+    for k in range(n - m + 1):
+        if s[k] == pattern[0] and memcmp(s + k, pattern, m) == 0:
+            return True
+    return False
+
+
+cdef class FrameNormalizer:
+    """
+    Native StackTraceProcessor.should_skip and StackTraceProcessor.preprocess over batches of proto signatures,
+    mapping the normalized frames to ids without creating a Python object for the frames that were already seen
+    """
+    cdef unordered_map[string, int] _ids
+    cdef object _normalized_id
+    cdef object _fallback
+
+    def __init__(self, normalized_id, fallback):
+        """
+        :param normalized_id: callable returning the id of a normalized frame
+        :param fallback: callable returning (whether to skip, normalized frames) of a proto signature and a number of
+                         top frames, for the proto signatures that are not ASCII
+        """
+        self._normalized_id = normalized_id
+        self._fallback = fallback
+
+    cdef int _frame_id(self, const unsigned char* s, Py_ssize_t start, Py_ssize_t end, string& buffer) except -1:
+        cdef Py_ssize_t k, first, last, size
+        cdef unsigned char c
+        cdef unordered_map[string, int].iterator it
+        buffer.clear()
+        for k in range(start, end):
+            c = s[k]
+            if c == 10:
+                continue
+            if 65 <= c <= 90:
+                c += 32
+            buffer.push_back(c)
+            size = buffer.size()
+            if size >= 3 and buffer[size - 3] == 64 and buffer[size - 2] == 48 and buffer[size - 1] == 120:
+                break
+
+        first, last = 0, buffer.size()
+        while first < last and is_space(buffer[first]):
+            first += 1
+        while last > first and is_space(buffer[last - 1]):
+            last -= 1
+        cdef string frame = buffer.substr(first, last - first)
+
+        it = self._ids.find(frame)
+        if it != self._ids.end():
+            return dereference(it).second
+        frame_id = self._normalized_id(frame.decode('ascii'))
+        self._ids[frame] = frame_id
+        return frame_id
+
+    def normalize(self, list proto_signatures, int take):
+        """
+        :param take: number of top frames kept, 0 for all of them
+        :return: (normalized frame ids of all the proto signatures, concatenated; number of frames of every proto signature;
+                 whether every proto signature is skipped)
+        """
+        cdef vector[int] ids
+        cdef vector[long long] lengths
+        cdef string buffer
+        cdef const unsigned char* s
+        cdef Py_ssize_t n, start, end, frames
+        skipped = np.zeros(len(proto_signatures), dtype=bool)
+        cdef unsigned char[::1] skipped_view = skipped.view(np.uint8)
+
+        for i, proto_signature in enumerate(proto_signatures):
+            if PyUnicode_MAX_CHAR_VALUE(proto_signature) > 127:
+                skip, normalized = self._fallback(proto_signature, take)
+                skipped_view[i] = skip
+                for frame in normalized:
+                    ids.push_back(self._normalized_id(frame))
+                lengths.push_back(len(normalized))
+                continue
+
+            s = <const unsigned char*> PyUnicode_AsUTF8AndSize(proto_signature, &n)
+            skipped_view[i] = contains(s, n, b'xul.dll@', 8) or contains(s, n, b'XUL@', 4) or contains(s, n, b'libxul.so@', 10)
+            start = 0
+            frames = 0
+            while take == 0 or frames < take:
+                # The frames are separated like str.split(' | ') does.
+                end = start
+                while end + 2 < n and not (s[end] == 32 and s[end + 1] == 124 and s[end + 2] == 32):
+                    end += 1
+                if end + 2 >= n:
+                    end = n
+                ids.push_back(self._frame_id(s, start, end, buffer))
+                frames += 1
+                if end == n:
+                    break
+                start = end + 3
+            lengths.push_back(frames)
+
+        result_ids = np.zeros(ids.size(), dtype=np.int32)
+        result_lengths = np.zeros(lengths.size(), dtype=np.int64)
+        cdef int[::1] ids_view = result_ids
+        cdef long long[::1] lengths_view = result_lengths
+        cdef size_t k
+        for k in range(ids.size()):
+            ids_view[k] = ids[k]
+        for k in range(lengths.size()):
+            lengths_view[k] = lengths[k]
+        return result_ids, result_lengths, skipped
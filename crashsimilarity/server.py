@@ -0,0 +1,125 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of a QueryServer:
+        GET /status
+        POST /top_similar_traces {"stack_trace": ..., "top": 10}
+        POST /signature_similarity {"signature1": ..., "signature2": ..., "top": 10}
+        POST /signature_coherence {"signature": ..., "top": 10}
+        POST /reload
+    """
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self._send(404, {'error': 'unknown endpoint {}'.format(self.path)})
+        self._send(200, self.server.status())
+
+    def do_POST(self):
+        routes = {
+            '/top_similar_traces': self._top_similar_traces,
+            '/signature_similarity': self._signature_similarity,
+            '/signature_coherence': self._signature_coherence,
+            '/reload': self._reload,
+        }
+        if self.path not in routes:
+            return self._send(404, {'error': 'unknown endpoint {}'.format(self.path)})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length).decode('utf8')) if length else {}
+            response = routes[self.path](params)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {'error': 'bad request: {!r}'.format(e)})
+        except Exception as e:
+            logging.exception('query failed')
+            return self._send(500, {'error': repr(e)})
+        self._send(200, response)
+
+    def _top_similar_traces(self, params):
+        model, _ = self.server.snapshot()
+        similarities = model.top_similar_traces(params['stack_trace'], int(params.get('top', 10)))
+        results = []
+        for doc_id, distance in similarities:
+            words, signature = model.get_trace(doc_id)
+            results.append({'doc_id': doc_id, 'distance': distance, 'signature': signature, 'trace': words})
+        return results
+
+    def _signature_similarity(self, params):
+        model, paths = self.server.snapshot()
+        top = int(params.get('top', 10))
+        return self._top_bottom(model.signature_similarity(paths, params['signature1'], params['signature2'], top, top,
+                                                           download=self.server.download_traces), top)
+
+    def _signature_coherence(self, params):
+        model, paths = self.server.snapshot()
+        top = int(params.get('top', 10))
+        return self._top_bottom(model.signature_similarity(paths, params['signature'], params['signature'], top, top,
+                                                           download=self.server.download_traces), top)
+
+    def _reload(self, params):
+        self.server.reload()
+        return self.server.status()
+
+    @staticmethod
+    def _top_bottom(similarities, top):
+        def to_json(similarity):
+            return {'trace1': similarity[0], 'trace2': similarity[1], 'distance': similarity[2]}
+        return {'top': [to_json(s) for s in similarities[:top]],
+                'bottom': [to_json(s) for s in similarities[-top:]]}
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    """
+    Long running HTTP server answering similarity queries with a model loaded once
+    Attributes:
+        load_model: callable returning (model, paths of the crash dumps it was trained on),
+                    called at startup and by every reload
+        download_traces: if true, the traces of the signatures are downloaded from Socorro by every signature query,
+                         otherwise they are read from the trace stores of the crash dumps
+    """
+    daemon_threads = True
+
+    def __init__(self, address, load_model, download_traces=False):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self._load_model = load_model
+        self.download_traces = download_traces
+        self._lock = threading.Lock()
+        self._model = None
+        self._paths = None
+        self._loaded_at = None
+        self.reload()
+
+    def reload(self):
+        """Load a new model and swap it in, queries keep being served by the old one in the meantime"""
+        t = time.time()
+        model, paths = self._load_model()
+        with self._lock:
+            self._model, self._paths = model, paths
+            self._loaded_at = time.time()
+        logging.info('Model loaded in ' + str(time.time() - t) + ' s.')
+
+    def snapshot(self):
+        with self._lock:
+            return self._model, self._paths
+
+    def status(self):
+        model, paths = self.snapshot()
+        return {'model': model.get_model_name(), 'paths': paths, 'loaded_at': self._loaded_at}
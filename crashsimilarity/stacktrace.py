@@ -1,6 +1,22 @@
+import collections
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
 
-from crashsimilarity import downloader, utils
+import numpy as np
+import pyximport
+
+from crashsimilarity import downloader
+from crashsimilarity.store import TraceStore
+
+try:
+    pyximport.install()
+    from crashsimilarity.normalizer import FrameNormalizer
+except ImportError:
+    # Without a compiler, the proto signatures are normalized in Python.
+    FrameNormalizer = None
 
 
 class StackTracesGetter(object):
@@ -8,45 +24,227 @@ class StackTracesGetter(object):
     def get_stack_traces_for_signature(fnames, signature, traces_num=100):
         traces = downloader.SocorroDownloader().download_stack_traces_for_signature(signature, traces_num)
 
-        for line in utils.read_files(fnames):
-            data = json.loads(line)
-            if data['signature'] == signature:
-                traces.add(data['proto_signature'])
+        for fname in fnames:
+            store = TraceStore.open(fname)
+            for row in store.rows_with_signature(signature):
+                traces.add(store.proto_signature(row))
 
         return list(traces)
 
+    @staticmethod
+    def get_local_stack_traces_for_signature(fnames, signature, traces_num=100):
+        """Distinct stack traces of the crashes with the given signature in the crash dump files, most frequent first"""
+        counts = collections.Counter()
+        for fname in fnames:
+            store = TraceStore.open(fname)
+            counts.update(store.proto_signature(row) for row in store.rows_with_signature(signature).tolist())
+        return [trace for trace, _ in counts.most_common(traces_num)]
+
+    @staticmethod
+    def get_top_signatures(fnames, top=None):
+        """Signatures of the crash dump files, with the most crashes first"""
+        counts = collections.Counter()
+        for fname in fnames:
+            store = TraceStore.open(fname)
+            signature_ids, crashes = np.unique(store.signature_ids, return_counts=True)
+            counts.update({store.signature_table[i]: n for i, n in zip(signature_ids.tolist(), crashes.tolist())})
+        return [signature for signature, _ in counts.most_common(top)]
+
     @staticmethod
     def get_stack_trace_for_uuid(uuid):
         data = downloader.SocorroDownloader().download_crash(uuid)
         return data['proto_signature']
 
 
+class FrameTable(object):
+    """
+    Interned frames of proto signatures
+    Batches of proto signatures are normalized by the native FrameNormalizer when it can be built, so that only the
+    frames that were never seen are decoded and normalized in Python
+    Attributes:
+        raw_frames: the distinct raw frames interned by intern, in the order of their ids
+        normalized_frames: the distinct frames normalized by StackTraceProcessor.clean, in the order of their ids
+    """
+    _SKIPPED = ['xul.dll@', 'XUL@', 'libxul.so@']
+
+    def __init__(self):
+        self.raw_frames = []
+        self.normalized_frames = []
+        self._raw_ids = {}
+        self._raw_to_normalized = []
+        self._normalized_ids = {}
+        self._normalizer = FrameNormalizer(self._normalized_id, self._preprocess) if FrameNormalizer else None
+
+    def _normalized_id(self, normalized):
+        if normalized not in self._normalized_ids:
+            self._normalized_ids[normalized] = len(self.normalized_frames)
+            self.normalized_frames.append(normalized)
+        return self._normalized_ids[normalized]
+
+    @staticmethod
+    def _preprocess(proto_signature, take):
+        return StackTraceProcessor.should_skip(proto_signature), StackTraceProcessor.preprocess(proto_signature, take)
+
+    def intern(self, proto_signatures):
+        """
+        :return: (raw frame ids of all the proto signatures, concatenated; number of frames of every proto signature)
+        """
+        raw_ids = self._raw_ids
+        raw_frames = self.raw_frames
+        first_new = len(raw_frames)
+        ids = []
+        lengths = []
+        for proto_signature in proto_signatures:
+            frames = proto_signature.split(' | ')
+            for frame in frames:
+                if frame not in raw_ids:
+                    raw_ids[frame] = len(raw_frames)
+                    raw_frames.append(frame)
+            ids.extend(map(raw_ids.__getitem__, frames))
+            lengths.append(len(frames))
+        self._raw_to_normalized.extend(self._normalized_id(StackTraceProcessor.clean(frame)) for frame in raw_frames[first_new:])
+        return np.array(ids, dtype=np.int32), np.array(lengths, dtype=np.int64)
+
+    def normalized_ids(self, raw_ids):
+        """:return: the normalized frame ids of interned raw frames"""
+        return np.array(self._raw_to_normalized, dtype=np.int32)[raw_ids]
+
+    def normalize(self, proto_signatures, take=None):
+        """
+        Batch version of StackTraceProcessor.should_skip and StackTraceProcessor.preprocess
+        :param take: number of top frames kept (Default all of them)
+        :return: (normalized frame ids of all the proto signatures, concatenated; offsets, the frames of proto signature i
+                 are ids[offsets[i]:offsets[i + 1]]; whether every proto signature is skipped)
+        """
+        if self._normalizer:
+            ids, lengths, skipped = self._normalizer.normalize(list(proto_signatures), take or 0)
+        else:
+            ids = []
+            lengths = []
+            skipped = []
+            for proto_signature in proto_signatures:
+                skip, frames = self._preprocess(proto_signature, take)
+                ids.extend(map(self._normalized_id, frames))
+                lengths.append(len(frames))
+                skipped.append(skip)
+            ids = np.array(ids, dtype=np.int32)
+            skipped = np.array(skipped, dtype=bool)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return ids, offsets, skipped
+
+
 class StackTraceProcessor(object):
     @staticmethod
     def should_skip(stack_trace):
         """Exclude stack traces without symbols"""
-        return any(call in stack_trace for call in ['xul.dll@', 'XUL@', 'libxul.so@'])
+        return any(call in stack_trace for call in FrameTable._SKIPPED)
 
     @staticmethod
-    def preprocess(stack_trace, take=None):
-        def clean(func):
-            func = func.lower().replace('\n', '')
-            return func[:func.index('@0x') + 3] if '@0x' in func else func
+    def clean(func):
+        func = func.lower().replace('\n', '')
+        return (func[:func.index('@0x') + 3] if '@0x' in func else func).strip()
 
-        traces = [clean(f).strip() for f in stack_trace.split(' | ')]
+    @staticmethod
+    def preprocess(stack_trace, take=None):
+        traces = [StackTraceProcessor.clean(f) for f in stack_trace.split(' | ')]
         if take:
             traces = traces[:take]
         return traces
 
     @staticmethod
-    def process(stream, take_top_funcs=None):
-        already_selected = set()
-        for line in stream:
-            data = json.loads(line)
-            if StackTraceProcessor.should_skip(data['proto_signature']):
-                continue
-            processed = StackTraceProcessor.preprocess(data['proto_signature'], take_top_funcs)
-            if frozenset(processed) not in already_selected:
-                # TODO: named tuple?
-                already_selected.add(frozenset(processed))
-                yield (processed, data['signature'].lower())
+    def trace_hash(processed):
+        """Stable 64-bit hash of the set of functions of a processed stack trace"""
+        digest = hashlib.blake2b('\n'.join(sorted(set(processed))).encode('utf8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    @staticmethod
+    def process(stream, take_top_funcs=None, already_selected=None, chunk_size=10000, duplicates=None):
+        """
+        :param already_selected: trace_hash of the traces to skip, updated with the ones yielded (Default a new set)
+        :param chunk_size: number of lines normalized at once by a FrameTable
+        :param duplicates: if set, updated with the (trace_hash, signature) of the traces skipped as already selected,
+                           so that the signatures sharing a trace with the one it was yielded with are still known
+        """
+        if already_selected is None:
+            already_selected = set()
+        stream = iter(stream)
+        frame_table = FrameTable()
+        frames = frame_table.normalized_frames
+        for chunk in iter(lambda: list(itertools.islice(stream, chunk_size)), []):
+            crashes = [json.loads(line) for line in chunk]
+            ids, offsets, skipped = frame_table.normalize([data['proto_signature'] for data in crashes], take_top_funcs)
+            ids = ids.tolist()
+            offsets = offsets.tolist()
+            for i in np.flatnonzero(~skipped).tolist():
+                processed = [frames[j] for j in ids[offsets[i]:offsets[i + 1]]]
+                trace_hash = StackTraceProcessor.trace_hash(processed)
+                if trace_hash not in already_selected:
+                    # TODO: named tuple?
+                    already_selected.add(trace_hash)
+                    yield (processed, crashes[i]['signature'].lower())
+                elif duplicates is not None:
+                    duplicates.add((trace_hash, crashes[i]['signature'].lower()))
+
+    @staticmethod
+    def _store_traces(fname, take_top_funcs=None):
+        """
+        Parse, normalize and hash the crashes of a crash dump file, through its TraceStore
+        :return: (rows of the crashes that aren't skipped and whose trace_hash wasn't seen in a previous row of the file;
+                  their trace_hash; trace_hash and signature id of the distinct duplicates of the rows, as an n x 2 array)
+        """
+        store = TraceStore.open(fname)
+        # No skipped pattern spans several frames.
+        cleaned = [store.normalized_table[i] for i in store.normalized_ids.tolist()]
+        skipped_frames = np.array([StackTraceProcessor.should_skip(frame) for frame in store.frame_table], dtype=bool)
+        frames = store.frames
+        starts = store.offsets[:-1].tolist()
+        ends = store.offsets[1:].tolist()
+        # Every crash has at least one frame, so the starts delimit every segment.
+        skipped = np.logical_or.reduceat(skipped_frames[frames], starts) if len(frames) else np.zeros(0, dtype=bool)
+        signature_ids = store.signature_ids
+        rows = []
+        hashes = []
+        seen = set()
+        duplicates = set()
+        for row in np.flatnonzero(~skipped).tolist():
+            ids = frames[starts[row]:ends[row]][:take_top_funcs or None].tolist()
+            trace_hash = StackTraceProcessor.trace_hash([cleaned[i] for i in ids])
+            if trace_hash not in seen:
+                seen.add(trace_hash)
+                rows.append(row)
+                hashes.append(trace_hash)
+            else:
+                duplicates.add((trace_hash, int(signature_ids[row])))
+        return np.array(rows, dtype=np.int64), np.array(hashes, dtype=np.uint64), np.array(sorted(duplicates), dtype=np.uint64).reshape(-1, 2)
+
+    @staticmethod
+    def process_stores(fnames, take_top_funcs=None, already_selected=None, workers=1, duplicates=None):
+        """
+        Same as process over the lines of the crash dump files, read from their TraceStore
+        :param already_selected: trace_hash of the traces to skip, updated with the ones yielded (Default a new set)
+        :param workers: number of processes the files are sharded across, to convert and hash them; the traces are
+                        still yielded in the order of the files, deduplicated across all of them
+        :param duplicates: see process
+        """
+        if already_selected is None:
+            already_selected = set()
+        store_traces = functools.partial(StackTraceProcessor._store_traces, take_top_funcs=take_top_funcs)
+        workers = min(workers, len(fnames))
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        try:
+            for fname, (rows, hashes, file_duplicates) in zip(fnames, pool.imap(store_traces, fnames) if pool else map(store_traces, fnames)):
+                store = TraceStore.open(fname)
+                signatures = [signature.lower() for signature in store.signature_table]
+                for row, trace_hash in zip(rows.tolist(), hashes.tolist()):
+                    if trace_hash not in already_selected:
+                        already_selected.add(trace_hash)
+                        ids = store.normalized_ids[store.frame_ids(row)[:take_top_funcs or None]].tolist()
+                        yield ([store.normalized_table[i] for i in ids], signatures[store.signature_ids[row]])
+                    elif duplicates is not None:
+                        duplicates.add((trace_hash, signatures[store.signature_ids[row]]))
+                if duplicates is not None:
+                    duplicates.update((trace_hash, signatures[signature_id]) for trace_hash, signature_id in file_duplicates.tolist())
+        finally:
+            if pool:
+                pool.terminate()
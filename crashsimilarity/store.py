@@ -0,0 +1,218 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from crashsimilarity import utils
+
+# Number of stores kept open by TraceStore.open, the least recently opened ones are unmapped first.
+OPENED_STORES = 64
+
+
+class TraceStore(object):
+    """
+    Columnar copy of a crash dump file, converted once and memory-mapped, so that reading the crashes
+    again doesn't decode any JSON
+    The path next to the dump is a symlink to the directory of the latest conversion, which contains:
+        frames.npy: ids in the frames string table of the frames of all the crashes, concatenated (int32)
+        offsets.npy: the frames of crash i are frames[offsets[i]:offsets[i + 1]] (int64)
+        signature_ids.npy: id in the signatures string table of the signature of every crash (int32)
+        uuids.npy: uuid of every crash (bytes)
+        normalized_ids.npy: id in the normalized frames string table of every frame of the frames string table (int32)
+        signature_rows.npy, signature_offsets.npy: inverted index, the crashes with signature i are
+                                                   signature_rows[signature_offsets[i]:signature_offsets[i + 1]]
+        frame_rows.npy, frame_offsets.npy: inverted index, the crashes with normalized frame i are
+                                           frame_rows[frame_offsets[i]:frame_offsets[i + 1]]
+        strings.json: the frames, normalized frames and signatures string tables, and the size and modification time
+                      of the dump it was converted from, a dump that changed since then is converted again
+    Frames are the raw frames of the proto signatures, normalized frames went through StackTraceProcessor.clean
+    Every day has its own dump, so adding a day of crashes only converts and indexes that day
+    """
+    _ARRAYS = ['frames', 'offsets', 'signature_ids', 'uuids', 'normalized_ids',
+               'signature_rows', 'signature_offsets', 'frame_rows', 'frame_offsets']
+    # Stores opened by this process, with the source they were converted from, least recently opened first.
+    _opened = collections.OrderedDict()
+    _opened_lock = threading.Lock()
+
+    def __init__(self, frames, offsets, signature_ids, uuids, normalized_ids, signature_rows, signature_offsets, frame_rows, frame_offsets,
+                 frame_table, normalized_table, signature_table):
+        self.frames = frames
+        self.offsets = offsets
+        self.signature_ids = signature_ids
+        self.uuids = uuids
+        self.normalized_ids = normalized_ids
+        self.signature_rows = signature_rows
+        self.signature_offsets = signature_offsets
+        self.frame_rows = frame_rows
+        self.frame_offsets = frame_offsets
+        self.frame_table = frame_table
+        self.normalized_table = normalized_table
+        self.signature_table = signature_table
+        self._signature_ids = {signature: i for i, signature in enumerate(signature_table)}
+        self._normalized_ids = {frame: i for i, frame in enumerate(normalized_table)}
+
+    @staticmethod
+    def path(dump_path):
+        return dump_path + '.store'
+
+    @staticmethod
+    def _source(dump_path):
+        stat = os.stat(dump_path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    @staticmethod
+    def _invert(keys, rows, key_count):
+        """
+        :param rows: row of every key, in increasing order
+        :return: (distinct rows of every key in increasing order, grouped by key; offsets of the groups)
+        """
+        stride = int(rows[-1]) + 1 if len(rows) else 1
+        pairs = np.unique(keys.astype(np.int64) * stride + rows)
+        offsets = np.zeros(key_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // stride, minlength=key_count), out=offsets[1:])
+        return pairs % stride, offsets
+
+    @staticmethod
+    def convert(dump_path, chunk_size=10000):
+        """Read a crash dump file once and index it, without writing the store"""
+        # stacktrace reads the crash dumps through their stores.
+        from crashsimilarity.stacktrace import FrameTable
+
+        frame_table = FrameTable()
+        frames = []
+        lengths = []
+        signature_ids = []
+        uuids = []
+        signature_table = {}
+        lines = utils.read_files([dump_path])
+        for chunk in iter(lambda: list(itertools.islice(lines, chunk_size)), []):
+            crashes = [json.loads(line) for line in chunk]
+            chunk_frames, chunk_lengths = frame_table.intern([data['proto_signature'] for data in crashes])
+            frames.append(chunk_frames)
+            lengths.append(chunk_lengths)
+            signature_ids.extend(signature_table.setdefault(data['signature'], len(signature_table)) for data in crashes)
+            uuids.extend(data['uuid'] for data in crashes)
+
+        frames = np.concatenate(frames + [np.zeros(0, dtype=np.int32)])
+        offsets = np.zeros(len(signature_ids) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lengths + [np.zeros(0, dtype=np.int64)]), out=offsets[1:])
+        signature_ids = np.array(signature_ids, dtype=np.int32)
+        normalized_ids = frame_table.normalized_ids(np.arange(len(frame_table.raw_frames)))
+        rows = np.arange(len(signature_ids), dtype=np.int64)
+        signature_rows, signature_offsets = TraceStore._invert(signature_ids, rows, len(signature_table))
+        frame_rows, frame_offsets = TraceStore._invert(normalized_ids[frames], np.repeat(rows, np.diff(offsets)), len(frame_table.normalized_frames))
+        return TraceStore(frames, offsets, signature_ids, np.array(uuids, dtype=bytes), normalized_ids, signature_rows, signature_offsets,
+                          frame_rows, frame_offsets, frame_table.raw_frames, frame_table.normalized_frames, list(signature_table))
+
+    def save(self, directory, source):
+        """
+        Write the store to a new directory next to the given path, then replace the symlink at the path with one to
+        the new directory: readers see either the previous store or the new one, and concurrent conversions of the
+        same dump each write their own directory
+        """
+        parent = os.path.dirname(os.path.abspath(directory))
+        version_directory = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=parent)
+        try:
+            for name in self._ARRAYS:
+                np.save(os.path.join(version_directory, name + '.npy'), getattr(self, name))
+            with open(os.path.join(version_directory, 'strings.json'), 'w') as f:
+                json.dump({'frames': self.frame_table, 'normalized_frames': self.normalized_table, 'signatures': self.signature_table,
+                           'source': source}, f)
+            link = version_directory + '.link'
+            os.symlink(os.path.basename(version_directory), link)
+            previous = os.path.realpath(directory) if os.path.islink(directory) else None
+            if os.path.isdir(directory) and not os.path.islink(directory):
+                # A store saved as a directory, before the stores were versioned.
+                shutil.rmtree(directory)
+            os.replace(link, directory)
+        except BaseException:
+            shutil.rmtree(version_directory, ignore_errors=True)
+            raise
+        if previous and previous != version_directory:
+            # The processes that memory-mapped the previous store can still read its unlinked files.
+            shutil.rmtree(previous, ignore_errors=True)
+
+    @staticmethod
+    def load(directory):
+        """:return: (the TraceStore, the source it was converted from)"""
+        # Every file is read from the same version, even if the store is replaced in the meantime.
+        directory = os.path.realpath(directory)
+        with open(os.path.join(directory, 'strings.json')) as f:
+            strings = json.load(f)
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in TraceStore._ARRAYS]
+        return TraceStore(*arrays, strings['frames'], strings['normalized_frames'], strings['signatures']), strings['source']
+
+    @staticmethod
+    def open(dump_path):
+        """
+        :return: the TraceStore of a crash dump file, converted first if it is missing or the dump changed since;
+                 if it can't be written, the conversion is only kept in memory
+        """
+        source = TraceStore._source(dump_path)
+        with TraceStore._opened_lock:
+            if dump_path in TraceStore._opened and TraceStore._opened[dump_path][1] == source:
+                TraceStore._opened.move_to_end(dump_path)
+                return TraceStore._opened[dump_path][0]
+        try:
+            store, store_source = TraceStore.load(TraceStore.path(dump_path))
+            if store_source == source:
+                TraceStore._remember(dump_path, store, source)
+                return store
+        except (FileNotFoundError, KeyError, ValueError):
+            pass
+
+        t = time.time()
+        store = TraceStore.convert(dump_path)
+        try:
+            store.save(TraceStore.path(dump_path), source)
+        except OSError as e:
+            logging.warning('Can not save the trace store of ' + dump_path + ': ' + str(e))
+            return store
+        logging.info('Converted ' + dump_path + ' in ' + str(time.time() - t) + ' s.')
+        store = TraceStore.load(TraceStore.path(dump_path))[0]
+        TraceStore._remember(dump_path, store, source)
+        return store
+
+    @staticmethod
+    def _remember(dump_path, store, source):
+        with TraceStore._opened_lock:
+            TraceStore._opened[dump_path] = (store, source)
+            TraceStore._opened.move_to_end(dump_path)
+            while len(TraceStore._opened) > OPENED_STORES:
+                TraceStore._opened.popitem(last=False)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def frame_ids(self, row):
+        return self.frames[self.offsets[row]:self.offsets[row + 1]]
+
+    def proto_signature(self, row):
+        return ' | '.join(self.frame_table[i] for i in self.frame_ids(row))
+
+    def signature(self, row):
+        return self.signature_table[self.signature_ids[row]]
+
+    def uuid(self, row):
+        return self.uuids[row].decode('utf8')
+
+    def rows_with_signature(self, signature):
+        """Rows of the crashes with the given signature, in increasing order"""
+        if signature not in self._signature_ids:
+            return np.zeros(0, dtype=np.int64)
+        i = self._signature_ids[signature]
+        return self.signature_rows[self.signature_offsets[i]:self.signature_offsets[i + 1]]
+
+    def rows_with_frame(self, frame):
+        """Rows of the crashes with the given frame, normalized by StackTraceProcessor.clean, in increasing order"""
+        if frame not in self._normalized_ids:
+            return np.zeros(0, dtype=np.int64)
+        i = self._normalized_ids[frame]
+        return self.frame_rows[self.frame_offsets[i]:self.frame_offsets[i + 1]]
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from crashsimilarity.models.ann import IVFIndex
+
+
+class IVFIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        centers = np.eye(4, 8, dtype=np.float32)
+        self.vectors = np.concatenate([center + rng.normal(scale=0.05, size=(25, 8)) for center in centers]).astype(np.float32)
+        self.vectors[10] = 0
+
+    def test_build(self):
+        index = IVFIndex.build(self.vectors, n_lists=4)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.list_offsets[-1], 99)
+        # the zero vector is not indexed
+        self.assertNotIn(10, index.doc_ids.tolist())
+        self.assertEqual(sorted(index.doc_ids.tolist()), [i for i in range(100) if i != 10])
+        np.testing.assert_allclose(np.linalg.norm(index.centroids, axis=1), 1, rtol=1e-5)
+
+    def test_candidates(self):
+        index = IVFIndex.build(self.vectors, n_lists=4)
+        candidates = index.candidates(np.eye(1, 8, 2, dtype=np.float32)[0], n_probe=1)
+        self.assertEqual(candidates.tolist(), list(range(50, 75)))
+        all_candidates = index.candidates(self.vectors[0], n_probe=4)
+        self.assertEqual(all_candidates.tolist(), index.doc_ids[np.argsort(index.doc_ids)].tolist())
+
+    def test_default_lists(self):
+        self.assertEqual(len(IVFIndex.build(self.vectors)), 9)
+
+    def test_empty(self):
+        index = IVFIndex.build(np.zeros((3, 8), dtype=np.float32))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.candidates(np.ones(8)).tolist(), [])
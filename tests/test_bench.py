@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from crashsimilarity import bench
+from crashsimilarity.stacktrace import StackTraceProcessor
+from crashsimilarity.store import TraceStore
+
+
+class BenchTest(unittest.TestCase):
+    def test_synthetic_crashes(self):
+        crashes = bench.synthetic_crashes(2000, seed=1)
+        self.assertEqual(len(crashes), 2000)
+        self.assertEqual(crashes, bench.synthetic_crashes(2000, seed=1))
+        self.assertNotEqual(crashes, bench.synthetic_crashes(2000, seed=2))
+        self.assertEqual(len(set(crash['uuid'] for crash in crashes)), 2000)
+        for crash in crashes:
+            self.assertTrue(crash['signature'].endswith(crash['proto_signature'].split(' | ')[0]))
+        self.assertTrue(any(StackTraceProcessor.should_skip(crash['proto_signature']) for crash in crashes))
+        self.assertTrue(any('@0x' in crash['proto_signature'] for crash in crashes))
+        # the crashes of a signature share most of their frames, but are not all the same
+        signature = crashes[0]['signature']
+        traces = set(crash['proto_signature'] for crash in crashes if crash['signature'] == signature)
+        self.assertGreater(len(traces), 1)
+
+    def test_write_dumps(self):
+        crashes = bench.synthetic_crashes(100)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = bench.write_dumps(crashes, tmp_dir, days=3)
+            self.assertEqual(len(paths), 3)
+            stores = [TraceStore.open(path) for path in paths]
+            self.assertEqual(sum(map(len, stores)), 100)
+            self.assertEqual(stores[1].proto_signature(0), crashes[1]['proto_signature'])
+
+    def test_compare(self):
+        baseline = {'sizes': {'1000': {'rwmd': {'seconds_per_query': 0.01, 'queries': 5}, 'caches': {'lru_get_seconds_per_op': 1e-6}}}}
+        report = {'sizes': {'1000': {'rwmd': {'seconds_per_query': 0.02, 'queries': 10}, 'caches': {'lru_get_seconds_per_op': 1e-5}},
+                            '10000': {'rwmd': {'seconds_per_query': 1.0}}}}
+        self.assertEqual(bench.compare(baseline, report), [('1000.rwmd.seconds_per_query', 0.01, 0.02)])
+        self.assertEqual(bench.compare(baseline, report, threshold=3), [])
+
+    def test_run(self):
+        cwd = os.getcwd()
+        report = bench.run([300], 'word2vec', ['ingestion', 'training', 'rwmd', 'top_similar_traces', 'signature_similarity', 'caches'], queries=3)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(report['meta']['model'], 'word2vec')
+        results = report['sizes']['300']
+        self.assertEqual(sorted(results), ['caches', 'ingestion', 'rwmd', 'signature_similarity', 'top_similar_traces', 'training'])
+        self.assertGreater(results['signature_similarity']['pairs'], 0)
+        self.assertEqual(results['ingestion']['crashes'], 300)
+        self.assertEqual(results['training']['traces'], results['ingestion']['traces'])
+        self.assertEqual(results['top_similar_traces']['queries'], 3)
+        self.assertEqual(bench.compare(report, report), [])
@@ -1,6 +1,10 @@
+import multiprocessing
 import os
+import pickle
 import unittest
+from datetime import timedelta
 
+from crashsimilarity import utils
 from crashsimilarity.cache import TracesCache, DownloaderCache
 from tests.test_utils import StackTraceProcessorTest
 
@@ -39,20 +43,32 @@ class TestTracesCache(CacheTest):
         self.assertIsNone(from_disk)
 
 
+def write_entries(args):
+    file_name, worker = args
+    cache = DownloaderCache(file_name=file_name)
+    for i in range(50):
+        cache[('worker', worker, i)] = [worker] * i
+
+
 class TestDownloaderCache(CacheTest):
-    default_cache_file_name = 'downloader_cache.pickle'
+    default_cache_file_name = 'downloader_cache.sqlite'
+    other_file_name = 'other.sqlite'
+
+    def setUp(self):
+        for file_name in [self.default_cache_file_name, self.other_file_name]:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(file_name + suffix):
+                    os.remove(file_name + suffix)
 
     def test_build(self):
         cache = DownloaderCache.build()
-        self.assertDictEqual(cache, dict())
+        self.assertEqual(dict(cache), dict())
         self.assertEqual(cache.name, 'downloader')
         self.assertEqual(cache.file_name, self.default_cache_file_name)
-        cache = DownloaderCache()
-        self.assertDictEqual(cache, dict())
-        cache = DownloaderCache({'foo': 1, 42: 'bar'})
-        self.assertDictEqual(cache, {'foo': 1, 42: 'bar'})
+        self.assertEqual(dict(DownloaderCache()), {})
+        self.assertEqual(dict(DownloaderCache({'foo': 1, 42: 'bar'}, file_name=self.other_file_name)), {'foo': 1, 42: 'bar'})
         cache = DownloaderCache.build({'foo': 1, 42: 'bar'}, file_name=self.other_file_name)
-        self.assertDictEqual(cache, {'foo': 1, 42: 'bar'})
+        self.assertEqual(dict(cache), {'foo': 1, 42: 'bar'})
         self.assertEqual(cache.file_name, self.other_file_name)
 
     def test_save_on_update(self):
@@ -60,13 +76,50 @@ class TestDownloaderCache(CacheTest):
         cache['foo'] = 1
         from_disk = DownloaderCache.load(cache.file_name)
         self.assertEqual(from_disk, cache)
-        cache['bar'] = 2
-        self.assertNotEqual(from_disk, cache)
-        from_disk = DownloaderCache.load(cache.file_name)
-        self.assertEqual(from_disk, cache)
+        cache[('bar', utils.utc_today())] = {'a', 'b'}
+        self.assertEqual(from_disk[('bar', utils.utc_today())], {'a', 'b'})
+        del cache['foo']
+        self.assertNotIn('foo', from_disk)
+        self.assertEqual(len(from_disk), 1)
+        self.assertIsNone(DownloaderCache.load(self.other_file_name))
 
     def test_try_load_or_build(self):
-        cache = DownloaderCache().try_load_or_build(self.default_cache_file_name, {'foo': 1, 42: 'bar'})
-        self.assertDictEqual(cache, {'foo': 1, 42: 'bar'})
+        cache = DownloaderCache().try_load_or_build(self.other_file_name, {'foo': 1, 42: 'bar'})
+        self.assertEqual(dict(cache), {'foo': 1, 42: 'bar'})
+        self.assertEqual(cache.file_name, self.other_file_name)
         from_disk = DownloaderCache.load(cache.file_name)
         self.assertEqual(from_disk, cache)
+        # an existing cache is loaded even when it is empty
+        cache = DownloaderCache().try_load_or_build(data={'foo': 1})
+        self.assertEqual(dict(cache), {})
+        self.assertEqual(cache.file_name, self.default_cache_file_name)
+
+    def test_expire(self):
+        cache = DownloaderCache(max_age=timedelta(days=1))
+        today = utils.utc_today()
+        cache[('traces', 'sig', today)] = 1
+        cache[('traces', 'sig', today - timedelta(days=1))] = 2
+        cache[('traces', 'sig', today - timedelta(days=2))] = 3
+        cache['no date'] = 4
+        self.assertNotIn(('traces', 'sig', today - timedelta(days=2)), cache)
+        self.assertEqual(len(cache), 3)
+        cache.expire()
+        self.assertEqual(sorted(DownloaderCache.load(cache.file_name).values()), [1, 2, 4])
+
+    def test_evict_least_recently_used(self):
+        value_size = len(pickle.dumps('x' * 100))
+        cache = DownloaderCache(max_size=3 * value_size)
+        for key in ['a', 'b', 'c']:
+            cache[key] = 'x' * 100
+        cache['a']
+        cache['d'] = 'x' * 100
+        self.assertEqual(sorted(cache), ['a', 'c', 'd'])
+        cache['e'] = 'x' * 200
+        self.assertEqual(sorted(cache), ['d', 'e'])
+
+    def test_concurrent_processes(self):
+        cache = DownloaderCache()
+        with multiprocessing.Pool(4) as pool:
+            pool.map(write_entries, [(cache.file_name, worker) for worker in range(4)])
+        self.assertEqual(len(cache), 200)
+        self.assertEqual(cache[('worker', 3, 7)], [3] * 7)
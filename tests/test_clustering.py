@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from crashsimilarity.models.clustering import KNNGraph, SignatureClusters
+from crashsimilarity.models.corpus import TraceCorpus
+from crashsimilarity.stacktrace import StackTraceProcessor
+
+Document = namedtuple('Document', 'words tags')
+Vocab = namedtuple('Vocab', 'index')
+
+
+class SignatureClustersTest(unittest.TestCase):
+    def test_build(self):
+        signatures = ['a', 'a', 'b', 'b', 'c', 'd', 'd', 'e']
+        neighbors = np.array([[1, 2], [2, 0], [0, 3], [1, 0], [5, -1], [4, 6], [4, 5], [0, -1]], dtype=np.int32)
+        distances = np.array([[0.1, 0.2], [0.1, 0.3], [0.2, 0.3], [0.1, 0.4], [0.5, np.inf], [0.5, 0.6], [0.2, 0.9], [2.0, np.inf]])
+        graph = KNNGraph(neighbors, distances)
+
+        clusters = SignatureClusters.build(graph, signatures, max_distance=1.0, min_links=2).clusters
+        self.assertEqual(clusters, [{'signatures': ['a', 'b'], 'traces': 4, 'links': 5},
+                                    {'signatures': ['c', 'd'], 'traces': 3, 'links': 3}])
+        # the edges of e are too long, and c and d have a single short enough link
+        clusters = SignatureClusters.build(graph, signatures, max_distance=0.45, min_links=2).clusters
+        self.assertEqual([cluster['signatures'] for cluster in clusters], [['a', 'b']])
+        clusters = SignatureClusters.build(graph, signatures, max_distance=3.0, min_links=1).clusters
+        self.assertEqual([cluster['signatures'] for cluster in clusters], [['a', 'b', 'e'], ['c', 'd']])
+
+    def test_build_without_links(self):
+        graph = KNNGraph(np.full((2, 3), -1, dtype=np.int32), np.full((2, 3), np.inf))
+        self.assertEqual(SignatureClusters.build(graph, ['a', 'b'], 1.0).clusters, [])
+
+    def test_build_with_shared_traces(self):
+        graph = KNNGraph(np.full((3, 2), -1, dtype=np.int32), np.full((3, 2), np.inf))
+        shared = [(0, 'b'), (1, 'b'), (2, 'c')]
+        clusters = SignatureClusters.build(graph, ['a', 'a', 'b'], 1.0, min_links=2, shared=shared).clusters
+        self.assertEqual(clusters, [{'signatures': ['a', 'b'], 'traces': 3, 'links': 2}])
+        clusters = SignatureClusters.build(graph, ['a', 'a', 'b'], 1.0, min_links=1, shared=shared).clusters
+        self.assertEqual([cluster['signatures'] for cluster in clusters], [['a', 'b', 'c']])
+
+    def test_signatures_sharing_a_trace(self):
+        crashes = [('js::GC | js::Mark', 'GCSignature'), ('js::GC | js::Mark', 'MarkSignature'), ('js::Mark | js::GC | js::Mark', 'MarkSignature'),
+                   ('mozalloc_abort | Other', 'OtherSignature')]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'day.json')
+            with open(path, 'w') as f:
+                for uuid, (proto_signature, signature) in enumerate(crashes):
+                    f.write(json.dumps({'proto_signature': proto_signature, 'uuid': str(uuid), 'signature': signature}) + '\n')
+            duplicates = set()
+            traces = list(StackTraceProcessor.process_stores([path], 10, duplicates=duplicates))
+        # the corpus keeps the shared trace once, with its first signature
+        self.assertEqual([signature for _, signature in traces], ['gcsignature', 'othersignature'])
+        vocab = {word: Vocab(i) for i, word in enumerate(sorted(set(word for trace, _ in traces for word in trace)))}
+        corpus = TraceCorpus.build([Document(trace, [i, signature]) for i, (trace, signature) in enumerate(traces)], vocab, [path], duplicates)
+        doc_ids, signature_ids = corpus.shared_traces()
+        shared = [(doc_id, corpus.signatures[signature_id]) for doc_id, signature_id in zip(doc_ids.tolist(), signature_ids.tolist())]
+        self.assertEqual(shared, [(0, 'marksignature')])
+
+        # without any kNN edge, the shared trace still links the two signatures
+        graph = KNNGraph(np.full((len(corpus), 1), -1, dtype=np.int32), np.full((len(corpus), 1), np.inf))
+        signatures = [corpus.signature(doc_id) for doc_id in range(len(corpus))]
+        self.assertEqual(SignatureClusters.build(graph, signatures, 1.0, min_links=1).clusters, [])
+        clusters = SignatureClusters.build(graph, signatures, 1.0, min_links=1, shared=shared).clusters
+        self.assertEqual(clusters, [{'signatures': ['gcsignature', 'marksignature'], 'traces': 1, 'links': 1}])
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from crashsimilarity.models.corpus import TraceCorpus
+from crashsimilarity.stacktrace import StackTraceProcessor
+
+Document = namedtuple('Document', 'words tags')
+Vocab = namedtuple('Vocab', 'index')
+
+
+class TraceCorpusTest(unittest.TestCase):
+    index2word = ['a', 'b', 'c']
+    vocab = {'a': Vocab(0), 'b': Vocab(1), 'c': Vocab(2)}
+    documents = [Document(['a', 'b', 'oov'], [0, 'sig1']),
+                 Document(['oov'], [1, 'sig2']),
+                 Document(['c', 'a', 'c'], [2, 'sig1'])]
+
+    def test_build(self):
+        corpus = TraceCorpus.build(self.documents, self.vocab)
+        self.assertEqual(len(corpus), 3)
+        self.assertEqual(corpus.token_ids.dtype, np.int32)
+        self.assertEqual(corpus.signature_ids.dtype, np.int32)
+        self.assertEqual(corpus.token_ids.tolist(), [0, 1, 2, 0, 2])
+        self.assertEqual(corpus.offsets.tolist(), [0, 2, 2, 5])
+        self.assertEqual(corpus.signatures, ['sig1', 'sig2'])
+        self.assertEqual(corpus.hashes.tolist(), [StackTraceProcessor.trace_hash(doc.words) for doc in self.documents])
+
+    def test_extend(self):
+        corpus = TraceCorpus.build(self.documents[:2], self.vocab, ['day1.json'])
+        extended = corpus.extend([Document(['b', 'oov', 'a'], [3, 'sig3']), self.documents[2]], self.vocab, ['day1.json', 'day2.json'])
+        self.assertEqual(len(corpus), 2)
+        # the first document has the same functions as the first one of the corpus
+        self.assertEqual(len(extended), 3)
+        self.assertEqual(extended.token_ids.tolist(), [0, 1, 2, 0, 2])
+        self.assertEqual(extended.offsets.tolist(), [0, 2, 2, 5])
+        self.assertEqual(extended.signatures, ['sig1', 'sig2', 'sig3'])
+        self.assertEqual(extended.sources, ['day1.json', 'day2.json'])
+        self.assertEqual(extended.hashes.tolist(), TraceCorpus.build(self.documents, self.vocab).hashes.tolist())
+        # the skipped document is recorded as a trace of the first document shared with sig3
+        self.assertEqual([ids.tolist() for ids in extended.shared_traces()], [[0], [2]])
+
+    def test_shared_traces(self):
+        duplicates = {(StackTraceProcessor.trace_hash(['oov']), 'sig3'), (StackTraceProcessor.trace_hash(['oov']), 'sig2'),
+                      (StackTraceProcessor.trace_hash(['a', 'c']), 'sig1'), (StackTraceProcessor.trace_hash(['unknown']), 'sig4')}
+        corpus = TraceCorpus.build(self.documents, self.vocab, duplicates=duplicates)
+        self.assertEqual(corpus.signatures, ['sig1', 'sig2', 'sig3', 'sig4'])
+        # the duplicates of the same signature and of traces outside of the corpus are not shared
+        self.assertEqual([ids.tolist() for ids in corpus.shared_traces()], [[1], [2]])
+        self.assertEqual([ids.tolist() for ids in TraceCorpus.build([], self.vocab, duplicates=duplicates).shared_traces()], [[], []])
+
+        extended = corpus.extend([Document(['c', 'a'], [3, 'sig2'])], self.vocab, duplicates=duplicates)
+        self.assertEqual([ids.tolist() for ids in extended.shared_traces()], [[1, 2], [2, 1]])
+
+    def test_save_load(self):
+        duplicates = [(StackTraceProcessor.trace_hash(['oov']), 'sig3')]
+        corpus = TraceCorpus.build(self.documents, self.vocab, ['day1.json'], duplicates)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'corpus.npz')
+            corpus.save(file_name)
+            from_disk = TraceCorpus.load(file_name)
+            self.assertIsNone(TraceCorpus.load(os.path.join(tmp_dir, 'other.npz')))
+
+            # corpora saved without their duplicates have none
+            legacy_name = os.path.join(tmp_dir, 'legacy.npz')
+            np.savez(legacy_name, token_ids=corpus.token_ids, offsets=corpus.offsets, signature_ids=corpus.signature_ids,
+                     signatures=np.array(corpus.signatures, dtype=str), hashes=corpus.hashes, sources=np.array(corpus.sources, dtype=str))
+            self.assertEqual([ids.tolist() for ids in TraceCorpus.load(legacy_name).shared_traces()], [[], []])
+        for name in ['token_ids', 'offsets', 'signature_ids', 'hashes', 'duplicate_hashes', 'duplicate_signature_ids']:
+            self.assertEqual(getattr(from_disk, name).tolist(), getattr(corpus, name).tolist())
+            self.assertEqual(getattr(from_disk, name).dtype, getattr(corpus, name).dtype)
+        self.assertEqual(from_disk.signatures, ['sig1', 'sig2', 'sig3'])
+        self.assertEqual(from_disk.sources, ['day1.json'])
+
+    def test_accessors(self):
+        corpus = TraceCorpus.build(self.documents, self.vocab)
+        self.assertEqual(corpus.indices(0).tolist(), [0, 1])
+        self.assertEqual(corpus.words(1, self.index2word), [])
+        self.assertEqual(corpus.words(2, self.index2word), ['c', 'a', 'c'])
+        self.assertEqual([corpus.signature(i) for i in range(3)], ['sig1', 'sig2', 'sig1'])
+
+    def test_gather(self):
+        corpus = TraceCorpus.build(self.documents, self.vocab)
+        token_ids, offsets = corpus.gather([2, 1, 0])
+        self.assertEqual(token_ids.tolist(), [2, 0, 2, 0, 1])
+        self.assertEqual(offsets.tolist(), [0, 3, 3, 5])
+
+    def test_mean_vectors(self):
+        corpus = TraceCorpus.build(self.documents, self.vocab)
+        vectors = np.array([[1, 0], [0, 1], [4, 4]], dtype=np.float32)
+        np.testing.assert_allclose(corpus.mean_vectors(vectors), [[0.5, 0.5], [0, 0], [3, 8 / 3.]], rtol=1e-6)
+        np.testing.assert_allclose(corpus.mean_vectors(vectors, chunk_size=1), corpus.mean_vectors(vectors))
@@ -1,6 +1,10 @@
 import unittest
 
-from crashsimilarity.models.distances import structural_word_distance, edit_distance, edit_distance_structural
+import numpy as np
+
+from crashsimilarity.models import distances
+from crashsimilarity.models.distances import structural_word_distance, edit_distance, edit_distance_structural, \
+    edit_distances_structural, pairwise_edit_distances_structural, structural_costs
 
 
 class DistancesTest(unittest.TestCase):
@@ -57,3 +61,32 @@ class DistancesTest(unittest.TestCase):
         self.assertLess(dist12, dist13)
         self.assertLess(dist12, dist32)
         self.assertEqual(dist12, dist21)
+
+    def test_structural_costs(self):
+        frames = ['a::b', 'a', 'b', 'a::b::c', 'a::b::c::d', '', 'a::b::d']
+        costs = structural_costs(frames)
+        for i, w1 in enumerate(frames):
+            for j, w2 in enumerate(frames):
+                self.assertEqual(costs[i, j], structural_word_distance(w1, w2))
+
+    def batched_structural_distances(self):
+        traces = [['a::b::c', 'a::b::d', 'x::y'], ['a::b::d', 'a::b::e', 'x::y'], ['qqq', 'ww', 'xx::y'], [],
+                  ['a::b::c', 'x::y'], ['x::y', 'a::b::d', 'a::b::c'], ['a::b', 'a::b', 'a::b', 'q']]
+        expected = np.array([[edit_distance_structural(t1, t2) for t2 in traces] for t1 in traces])
+        np.testing.assert_array_equal(pairwise_edit_distances_structural(traces), expected)
+        np.testing.assert_array_equal(edit_distances_structural(traces[0], traces), expected[0])
+        for max_distance in [0, 0.5, 1, 2]:
+            within = np.where(expected <= max_distance, expected, np.inf)
+            np.testing.assert_array_equal(pairwise_edit_distances_structural(traces, max_distance), within)
+            np.testing.assert_array_equal(edit_distances_structural(traces[4], traces, max_distance), within[4])
+
+    def test_batched_structural_distances(self):
+        self.batched_structural_distances()
+
+    def test_batched_structural_distances_without_native_kernel(self):
+        native = distances.native_edit_distances
+        distances.native_edit_distances = None
+        try:
+            self.batched_structural_distances()
+        finally:
+            distances.native_edit_distances = native
@@ -1,12 +1,78 @@
+import json
+import tempfile
+import threading
+import time
 import unittest
 from datetime import timedelta
+from functools import partialmethod
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
 import requests
 import requests_mock
 from itertools import islice
 
 from crashsimilarity import utils
-from crashsimilarity.downloader import BugzillaDownloader, SocorroDownloader, Downloader
+from crashsimilarity.downloader import BugzillaDownloader, SocorroDownloader, Downloader, RateLimiter
+from crashsimilarity.dump import CrashDump
+
+
+class StubSuperSearch(ThreadingMixIn, HTTPServer):
+    """Local SuperSearch serving `crashes_per_day` crashes for every day, slowly enough to observe concurrent requests"""
+    daemon_threads = True
+
+    def __init__(self, crashes_per_day, fail_after=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubSuperSearchHandler)
+        self.crashes_per_day = crashes_per_day
+        self.fail_after = fail_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.running = 0
+        self.max_running = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/api/SuperSearch'.format(self.server_address[1])
+
+
+class StubSuperSearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.running += 1
+            self.server.max_running = max(self.server.max_running, self.server.running)
+            failing = self.server.fail_after is not None and self.server.requests > self.server.fail_after
+        time.sleep(0.05)
+        if failing:
+            with self.server.lock:
+                self.server.running -= 1
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        params = parse_qs(urlparse(self.path).query)
+        day = params['date'][0][2:]
+        offset = int(params['_results_offset'][0])
+        number = int(params['_results_number'][0])
+        hits = [{'uuid': '{}-{}'.format(day, i), 'signature': 'sig{}'.format(i % 7), 'proto_signature': 'fun{} | fun'.format(i)}
+                for i in range(offset, min(offset + number, self.server.crashes_per_day))]
+        body = json.dumps({'hits': hits, 'total': self.server.crashes_per_day, 'facets': {}, 'errors': []}).encode('utf8')
+
+        with self.server.lock:
+            self.server.running -= 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
 
 class DownloaderTest(unittest.TestCase):
@@ -115,6 +181,75 @@ class DownloaderTest(unittest.TestCase):
                 self.assertIsInstance(ctx.exception, requests.exceptions.HTTPError)
                 self.assertIn(404, ctx.exception)
 
+    def test_download_day_crashes_concurrently(self):
+        server = StubSuperSearch(crashes_per_day=95)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with mock.patch.object(SocorroDownloader, '_SUPER_SEARCH_URL', server.url), \
+                    mock.patch.object(Downloader, 'rate_limiter', RateLimiter()):
+                day = utils.utc_today()
+                crashes = list(SocorroDownloader().download_day_crashes(day, crashes_per_request=10, workers=4))
+                self.assertEqual([crash['uuid'] for crash in crashes], ['{}-{}'.format(day, i) for i in range(95)])
+                self.assertEqual(server.requests, 10)
+                self.assertGreater(server.max_running, 1)
+                self.assertLessEqual(server.max_running, 4)
+
+                server.max_running = 0
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    # A single page per day, so the days are the only requests running concurrently.
+                    SocorroDownloader.download_and_save_crashes(3, 'Firefox', tmp_dir, workers=3, day_workers=2)
+                    self.assertGreater(server.max_running, 1)
+                    self.assertLessEqual(server.max_running, 2)
+                    for i in range(3):
+                        day = utils.utc_today() - timedelta(i)
+                        path = SocorroDownloader.crashes_dump_file_path(day, 'Firefox', tmp_dir)
+                        self.assertEqual([json.loads(line)['uuid'] for line in utils.read_files([path])], ['{}-{}'.format(day, i) for i in range(95)])
+                    self.assertEqual(len(SocorroDownloader.get_dump_paths(3, 'Firefox', tmp_dir)), 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_resume_interrupted_download(self):
+        day = utils.utc_today() - timedelta(1)
+        uuids = ['{}-{}'.format(day, i) for i in range(95)]
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(Downloader, 'rate_limiter', RateLimiter()):
+            path = SocorroDownloader.crashes_dump_file_path(day, 'Firefox', tmp_dir)
+            for fail_after, requests_made in [(5, None), (None, 6), (None, 0)]:
+                server = StubSuperSearch(crashes_per_day=95, fail_after=fail_after)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                try:
+                    with mock.patch.object(SocorroDownloader, '_SUPER_SEARCH_URL', server.url):
+                        try:
+                            # 10 crashes per page, committed every 2 pages
+                            with mock.patch.object(SocorroDownloader, 'download_day_pages', partialmethod(SocorroDownloader.download_day_pages, crashes_per_request=10)):
+                                SocorroDownloader().download_and_save_day_crashes(day, 'Firefox', tmp_dir, chunk_size=20)
+                        except requests.exceptions.HTTPError:
+                            self.assertEqual(fail_after, 5)
+                            self.assertFalse(CrashDump.is_complete(path))
+                            self.assertEqual(CrashDump.read_manifest(path)['offset'], 40)
+                            self.assertEqual(SocorroDownloader.get_dump_paths(2, 'Firefox', tmp_dir), [])
+                    if requests_made is not None:
+                        # resumed from the last committed offset, complete days are not downloaded again
+                        self.assertEqual(server.requests, requests_made)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+
+            self.assertTrue(CrashDump.is_complete(path))
+            self.assertEqual([json.loads(line)['uuid'] for line in utils.read_files([path])], uuids)
+            self.assertEqual(SocorroDownloader.get_dump_paths(2, 'Firefox', tmp_dir), [path])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(requests_per_second=20)
+        t = time.monotonic()
+        for _ in range(5):
+            limiter.wait('http://a.example/api')
+        limiter.wait('http://b.example/api')
+        # 4 intervals between the requests to a.example, none before the first request to b.example
+        self.assertGreaterEqual(time.monotonic() - t, 0.2)
+        self.assertLess(time.monotonic() - t, 0.4)
+        self.assertEqual(RateLimiter().interval, 0)
+
     def test_downloader_404(self):
         downloader = SocorroDownloader()
         with self.assertRaises(Exception) as ctx:
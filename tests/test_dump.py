@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+
+from crashsimilarity import utils
+from crashsimilarity.dump import CrashDump
+
+
+class CrashDumpTest(unittest.TestCase):
+    crashes = [{'uuid': str(i), 'signature': 'sig', 'proto_signature': 'a | b{}'.format(i)} for i in range(10)]
+
+    def test_append_and_read(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'firefox-crashes-2018-01-01.json.gz')
+            dump = CrashDump(path)
+            self.assertEqual(dump.resume(), set())
+            dump.append(self.crashes[:4], 4)
+            dump.append([], 5)
+            dump.append(self.crashes[4:], 11)
+            self.assertFalse(CrashDump.is_complete(path))
+            dump.finish()
+
+            manifest = CrashDump.read_manifest(path)
+            self.assertTrue(manifest['complete'])
+            self.assertEqual(manifest['rows'], 10)
+            self.assertEqual(manifest['offset'], 11)
+            self.assertEqual(manifest['size'], os.path.getsize(path))
+            self.assertEqual([json.loads(line) for line in utils.read_files([path])], self.crashes)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'firefox-crashes-2018-01-01.json.gz')
+            dump = CrashDump(path)
+            dump.resume()
+            dump.append(self.crashes[:4], 4)
+            # interrupted while writing the next chunk
+            with open(path, 'ab') as f:
+                f.write(b'\x1f\x8b partial chunk')
+
+            dump = CrashDump(path)
+            self.assertEqual(dump.resume(), {'0', '1', '2', '3'})
+            self.assertEqual(dump.manifest['offset'], 4)
+            dump.append(self.crashes[4:], 10)
+            dump.finish()
+            self.assertEqual([json.loads(line) for line in utils.read_files([path])], self.crashes)
+
+    def test_resume_corrupted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'firefox-crashes-2018-01-01.json.gz')
+            dump = CrashDump(path)
+            dump.resume()
+            dump.append(self.crashes, 10)
+            dump.finish()
+            with open(path, 'r+b') as f:
+                f.seek(20)
+                f.write(b'corrupted')
+
+            dump = CrashDump(path)
+            self.assertEqual(dump.resume(), set())
+            self.assertEqual(dump.manifest['offset'], 0)
+            self.assertEqual(os.path.getsize(path), 0)
+            self.assertFalse(CrashDump.is_complete(path))
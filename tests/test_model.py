@@ -1,9 +1,20 @@
+import json
+import os
+import pickle
+import tempfile
 import unittest
 import multiprocessing
+from unittest import mock
+from datetime import datetime, timedelta
+
 import numpy as np
+from pyemd import emd
 
-from crashsimilarity.stacktrace import StackTraceProcessor
-from crashsimilarity.models import doc2vec, word2vec
+from crashsimilarity.stacktrace import StackTraceProcessor, StackTracesGetter
+from crashsimilarity.models import base, doc2vec, word2vec
+from crashsimilarity.models.clustering import KNNGraph, cluster_signatures
+from crashsimilarity.models.coherence import REPORT_FIELDS, coherence_report, write_report
+from crashsimilarity.models.pool import WorkerPool, shared_array
 
 
 class CrashSimilarityTest(unittest.TestCase):
@@ -158,6 +169,477 @@ class CrashSimilarityTest(unittest.TestCase):
         self.wmdistance_euclidean_zero_distance(self.doc2vec_model, self.doc2vec_trained_model)
         self.wmdistance_euclidean_zero_distance(self.word2vec_model, self.word2vec_trained_model)
 
+    def rwmd_distances(self, model, trained_model):
+        doc = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        words = [w for w in np.unique(StackTraceProcessor.preprocess(doc)).tolist() if w in trained_model.wv.vocab]
+        vectors = model._word_vectors()
+        all_distances = np.array(1.0 - np.dot(vectors, vectors[[trained_model.wv.vocab[word].index for word in words]].transpose()), dtype=np.double)
+
+        rwmd = model.rwmd_distances(all_distances)
+        self.assertEqual(len(rwmd), len(model._corpus))
+        wmds = list(model.wmdistances([trained_model.wv.vocab[word].index for word in words], all_distances, range(len(model._corpus))))
+        for doc_id in range(len(model._corpus)):
+            doc_words = model._extract_indices_from_model(doc_id)
+            if len(doc_words) == 0:
+                self.assertEqual(rwmd[doc_id], float('inf'))
+                continue
+            word_dists = all_distances[doc_words]
+            expected = max(np.mean(np.min(word_dists, axis=0)), np.mean(np.min(word_dists, axis=1)))
+            self.assertAlmostEqual(rwmd[doc_id], expected)
+            # the RWMD is a lower bound of the WMD
+            self.assertLessEqual(rwmd[doc_id], wmds[doc_id] + base.BOUND_TOLERANCE)
+
+    def test_rwmd_distances(self):
+        self.rwmd_distances(self.doc2vec_model, self.doc2vec_trained_model)
+        self.rwmd_distances(self.word2vec_model, self.word2vec_trained_model)
+
+    def wmdistances(self, model, trained_model):
+        doc = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        words = [w for w in np.unique(StackTraceProcessor.preprocess(doc)).tolist() if w in trained_model.wv.vocab]
+        query_indices = [trained_model.wv.vocab[word].index for word in words]
+        vectors = model._word_vectors()
+        all_distances = np.array(1.0 - np.dot(vectors, vectors[query_indices].transpose()), dtype=np.double)
+        all_distances[query_indices, np.arange(len(query_indices))] = 0
+        np.testing.assert_allclose(model._query_distances(np.array(query_indices, dtype=np.int32)), all_distances, atol=1e-6)
+
+        doc_ids = list(range(0, len(model._corpus), 7))
+        distances = list(model.wmdistances(query_indices, all_distances, doc_ids))
+        self.assertEqual(len(distances), len(doc_ids))
+        for doc_id, distance in zip(doc_ids, distances):
+            expected = self.reference_wmd(trained_model, vectors, words, model._extract_words_from_model(doc_id))
+            self.assertAlmostEqual(distance, expected, places=5)
+
+        # a single word is at distance 0 of a trace of that word only, on both the serial and the parallel path
+        query_indices = np.array(query_indices[:1], dtype=np.int32)
+        all_distances = model._query_distances(query_indices)
+        self.assertEqual(all_distances[query_indices[0], 0], 0)
+        self.assertEqual(model._trace_wmd(query_indices, np.repeat(query_indices, 2), all_distances), 0.0)
+        self.assertEqual(base._wmd_task(np.repeat(query_indices, 2), np.array([0, 2]), (query_indices, all_distances, 0)), 0.0)
+
+    @staticmethod
+    def reference_wmd(trained_model, vectors, document1, document2):
+        """WMD with the cost matrix built word by word from the normalized vectors, independently of _wmd"""
+        if len(document1) == 0 or len(document2) == 0:
+            return float('inf')
+        dictionary = sorted(set(document1) | set(document2))
+        distance_matrix = np.zeros((len(dictionary), len(dictionary)), dtype=np.double)
+        for i, word1 in enumerate(dictionary):
+            for j, word2 in enumerate(dictionary):
+                if word1 in document1 and word2 in document2 and word1 != word2:
+                    distance_matrix[i, j] = 1.0 - np.dot(vectors[trained_model.wv.vocab[word1].index], vectors[trained_model.wv.vocab[word2].index])
+        if np.sum(distance_matrix) == 0.0:
+            # moving words at distance 0 of each other costs nothing
+            return 0.0
+        d1 = np.array([document1.count(word) for word in dictionary], dtype=np.double) / len(document1)
+        d2 = np.array([document2.count(word) for word in dictionary], dtype=np.double) / len(document2)
+        return emd(d1, d2, distance_matrix)
+
+    def test_wmdistances(self):
+        self.wmdistances(self.doc2vec_model, self.doc2vec_trained_model)
+        self.wmdistances(self.word2vec_model, self.word2vec_trained_model)
+
+    def top_similar_traces_parallel(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        expected = model.top_similar_traces(stack_trace, 5)
+        self.assertEqual(len(expected), 5)
+        self.assertEqual(model.top_similar_traces(stack_trace, 5, workers=2), expected)
+
+    def test_top_similar_traces_parallel(self):
+        self.top_similar_traces_parallel(self.doc2vec_model)
+        self.top_similar_traces_parallel(self.word2vec_model)
+
+    def top_similar_traces_ann(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        model.build_ann_index(n_lists=4)
+        # probing every list is equivalent to the exhaustive search
+        self.assertEqual(model.top_similar_traces(stack_trace, 5, ann_probes=4), model.top_similar_traces(stack_trace, 5))
+        self.assertLessEqual(len(model.top_similar_traces(stack_trace, 5, ann_probes=1)), 5)
+
+    def test_top_similar_traces_ann(self):
+        self.top_similar_traces_ann(self.doc2vec_model)
+        self.top_similar_traces_ann(self.word2vec_model)
+
+    def wcd_distances(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice"
+        vocab = model.get_model().wv.vocab
+        query_indices = np.array([vocab[w].index for w in np.unique(StackTraceProcessor.preprocess(stack_trace)).tolist() if w in vocab], dtype=np.int32)
+        all_distances = model._query_distances(query_indices)
+        self.assertEqual(model._centroids.dtype, np.float32)
+        self.assertIsInstance(model._centroids, np.memmap)
+
+        wcd = model.wcd_distances(query_indices)
+        self.assertEqual(len(wcd), len(model._corpus))
+        np.testing.assert_allclose(model.wcd_distances(query_indices, np.arange(10, 20)), wcd[10:20], rtol=1e-6)
+        wmds = list(model.wmdistances(query_indices, all_distances, range(len(model._corpus))))
+        for doc_id, wmd in enumerate(wmds):
+            if len(model._corpus.indices(doc_id)) == 0:
+                self.assertEqual(wcd[doc_id], float('inf'))
+            else:
+                self.assertLessEqual(wcd[doc_id], wmd)
+
+    def test_wcd_distances(self):
+        self.wcd_distances(self.doc2vec_model)
+        self.wcd_distances(self.word2vec_model)
+
+    def top_similar_traces_tiers(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        vocab = model.get_model().wv.vocab
+        query_indices = np.array([vocab[w].index for w in np.unique(StackTraceProcessor.preprocess(stack_trace)).tolist() if w in vocab], dtype=np.int32)
+        expected = model._top_similar(query_indices, 5)
+        model.tier_counts.clear()
+        with mock.patch.object(base, 'WCD_TIER_SIZE', 10):
+            self.assertEqual(model._top_similar(query_indices, 5), expected)
+            self.assertEqual(model._top_similar(query_indices, 5, workers=2), expected)
+        counts = model.tier_counts
+        self.assertEqual(counts['queried'], 2 * len(model._corpus))
+        self.assertEqual(counts['wcd'] + counts['rwmd'] + counts['wmd'], counts['queried'])
+        self.assertGreater(counts['wcd'], 0)
+        self.assertGreaterEqual(counts['wmd'], 10)
+
+        # the tiers are an exact pruning of the exhaustive WMD search
+        all_distances = model._query_distances(query_indices)
+        wmds = list(model.wmdistances(query_indices, all_distances, range(len(model._corpus))))
+        np.testing.assert_allclose([distance for _, distance in expected], sorted(wmds)[:5])
+
+    def test_top_similar_traces_tiers(self):
+        self.top_similar_traces_tiers(self.doc2vec_model)
+        self.top_similar_traces_tiers(self.word2vec_model)
+
+    def wmd_pool(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice"
+        vocab = model.get_model().wv.vocab
+        query_indices = np.array([vocab[w].index for w in np.unique(StackTraceProcessor.preprocess(stack_trace)).tolist() if w in vocab], dtype=np.int32)
+        expected = model._top_similar(query_indices, 5)
+        try:
+            # the pool is started by the first parallel query and serves the next ones
+            self.assertEqual(model._top_similar(query_indices, 5, workers=2), expected)
+            pool = model._wmd_pool
+            self.assertIsNotNone(pool)
+            self.assertEqual(model._top_similar(query_indices[:2], 5, workers=2), model._top_similar(query_indices[:2], 5))
+            self.assertIs(model._wmd_pool, pool)
+            # the processes the model is sent to don't get its pool
+            self.assertIsNone(pickle.loads(pickle.dumps(model))._wmd_pool)
+            # a pool of another size replaces it
+            self.assertEqual(model._top_similar(query_indices, 5, workers=3), expected)
+            self.assertIsNot(model._wmd_pool, pool)
+        finally:
+            model.close()
+        self.assertIsNone(model._wmd_pool)
+
+    def test_pooled_wmds_large_vocabulary(self):
+        rng = np.random.RandomState(0)
+        vectors = rng.randn(200000, 16).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+        query_indices = np.unique(rng.randint(0, len(vectors), 10)).astype(np.int32)
+        # documents of random words, of some words of the query, of the words of the query, and without words
+        docs = [rng.randint(0, len(vectors), rng.randint(1, 12)) for _ in range(100)]
+        docs += [np.concatenate((rng.choice(query_indices, 3), rng.randint(0, len(vectors), 3))) for _ in range(20)]
+        docs += [query_indices.copy(), np.zeros(0, dtype=np.int32)]
+        token_ids = np.concatenate(docs).astype(np.int32)
+        offsets = np.concatenate(([0], np.cumsum([len(doc) for doc in docs]))).astype(np.int64)
+        all_distances = np.array(1.0 - np.dot(vectors, vectors[query_indices].transpose()), dtype=np.double)
+        all_distances[query_indices, np.arange(len(query_indices))] = 0
+
+        expected = [base.EmbeddingAlgo._trace_wmd(query_indices, doc.astype(np.int32), all_distances) for doc in docs]
+        self.assertAlmostEqual(expected[-2], 0.0)
+        self.assertEqual(expected[-1], float('inf'))
+        for start_method in ['fork', 'spawn']:
+            with WorkerPool(2, base._wmd_task, token_ids, offsets, start_method=start_method) as pool, shared_array(all_distances) as shared:
+                wmds = list(base.EmbeddingAlgo._pooled_wmds(pool, query_indices, shared, list(range(len(docs))), 2 * base.WMD_CHUNK_SIZE))
+            self.assertEqual(wmds, expected)
+
+    def test_wmd_pool(self):
+        self.wmd_pool(self.doc2vec_model)
+        self.wmd_pool(self.word2vec_model)
+
+    def top_similar_traces_parallel_tiers(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        vocab = model.get_model().wv.vocab
+        query_indices = np.array([vocab[w].index for w in np.unique(StackTraceProcessor.preprocess(stack_trace)).tolist() if w in vocab], dtype=np.int32)
+        expected = model._top_similar(query_indices, 5)
+
+        # the doc ids handed to the workers and the WMD consumed, tier by tier
+        submitted = []
+        used = []
+        imap = WorkerPool.imap
+        confirm_candidates = base.EmbeddingAlgo._confirm_candidates
+
+        def counted_imap(pool, items, chunksize=1):
+            submitted[-1] += len(items)
+            return imap(pool, items, chunksize)
+
+        def counted_confirm_candidates(*args):
+            similarities, confirmed = confirm_candidates(*args)
+            used.append(confirmed)
+            submitted.append(0)
+            return similarities, confirmed
+
+        submitted.append(0)
+        # tiers of only the top 5 candidates, so that the top is never confirmed by the first tier alone
+        with mock.patch.object(base, 'WCD_TIER_SIZE', 5), mock.patch.object(base, 'WMD_CHUNK_SIZE', 2), \
+                mock.patch.object(WorkerPool, 'imap', autospec=True, side_effect=counted_imap), \
+                mock.patch.object(base.EmbeddingAlgo, '_confirm_candidates', side_effect=counted_confirm_candidates):
+            self.assertEqual(model._top_similar(query_indices, 5, workers=2), expected)
+        self.assertGreater(len([tier_used for tier_used in used if tier_used]), 1)
+        # every tier computes at most two batches of 2 workers x 2 documents more than the WMD it consumes
+        for tier_submitted, tier_used in zip(submitted, used):
+            self.assertGreaterEqual(tier_submitted, tier_used)
+            self.assertLessEqual(tier_submitted, tier_used + 2 * 2 * 2)
+        self.assertLess(sum(submitted), min(5 * len(used), len(model._corpus)))
+
+    def test_top_similar_traces_parallel_tiers(self):
+        self.top_similar_traces_parallel_tiers(self.doc2vec_model)
+        self.top_similar_traces_parallel_tiers(self.word2vec_model)
+
+    def test_single_precision_quantized(self):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice | js::gc::GCRuntime::gcCycle | js::gc::GCRuntime::collect"
+        # Both load the model trained by setUpClass, so their corpus is read in the same order.
+        exact = word2vec.Word2Vec(self.paths)
+        model = word2vec.Word2Vec(self.paths, single_precision=True, quantize=True)
+        self.assertNotEqual(model._model_version, exact._model_version)
+        self.assertIsInstance(model._quantized_centroids.codes, np.memmap)
+        vocab = model.get_model().wv.vocab
+        query_indices = np.array([vocab[w].index for w in np.unique(StackTraceProcessor.preprocess(stack_trace)).tolist() if w in vocab], dtype=np.int32)
+        all_distances = model._query_distances(query_indices)
+        self.assertEqual(all_distances.dtype, np.float32)
+        self.assertEqual(model._word_distances(query_indices).dtype, np.float32)
+        rwmd = model.rwmd_distances(all_distances)
+        self.assertEqual(rwmd.dtype, np.float64)
+
+        wcd = model.wcd_distances(query_indices)
+        self.assertEqual(wcd.dtype, np.float32)
+        self.assertTrue(np.all(wcd <= exact.wcd_distances(query_indices) + 1e-6))
+        for doc_id, wmd in enumerate(model.wmdistances(query_indices, all_distances, range(len(model._corpus)))):
+            self.assertLessEqual(wcd[doc_id], wmd + base.BOUND_TOLERANCE)
+            self.assertLessEqual(rwmd[doc_id], wmd + base.BOUND_TOLERANCE)
+
+        expected = exact.top_similar_traces(stack_trace, 5)
+        similarities = model.top_similar_traces(stack_trace, 5)
+        self.assertEqual([doc_id for doc_id, _ in similarities], [doc_id for doc_id, _ in expected])
+        np.testing.assert_allclose([d for _, d in similarities], [d for _, d in expected], rtol=1e-6)
+
+    def test_single_precision_near_ties(self):
+        model = word2vec.Word2Vec(self.paths, single_precision=True)
+        vocab = model.get_model().wv.vocab
+        frames = [model.get_model().wv.index2word[i] for i in range(0, len(vocab), max(len(vocab) // 8, 1))][:8]
+        # a single word trace has the same WMD and RWMD to every trace, and reordered frames give tied pairs
+        traces1 = frames[:4]
+        traces2 = [' | '.join(frames[i:i + 3]) for i in range(5)] + [' | '.join(reversed(frames[i:i + 3])) for i in range(5)]
+
+        words = np.unique([vocab[frame].index for frame in frames])
+        distances = model._word_distances(words)
+        self.assertEqual(distances.dtype, np.float32)
+        positions1 = [np.searchsorted(words, [vocab[frame].index]) for frame in traces1]
+        positions2 = [np.searchsorted(words, [vocab[frame].index for frame in trace.split(' | ')]) for trace in traces2]
+        lower, upper = model._wmd_bounds(distances, positions1, positions2)
+        for i, query_positions in enumerate(positions1):
+            for j, doc_positions in enumerate(positions2):
+                distance = model._wmd(query_positions, doc_positions, distances[:, query_positions])
+                if np.isfinite(distance):
+                    self.assertLessEqual(lower[i, j], distance + base.BOUND_TOLERANCE)
+                    self.assertGreaterEqual(upper[i, j], distance - base.BOUND_TOLERANCE)
+
+        with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces1, traces2]):
+            similarities = model.signature_similarity(self.paths, 'signature1', 'signature2')
+        for top, bottom in [(1, 1), (3, 3), (5, None), (None, 7)]:
+            with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces1, traces2]):
+                selected = model.signature_similarity(self.paths, 'signature1', 'signature2', top, bottom)
+            expected = [similarity for k, similarity in enumerate(similarities) if k < (top or 0) or k >= len(similarities) - (bottom or 0)]
+            self.assertEqual(selected, expected)
+
+    def query_cache(self, model):
+        stack_trace = "js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack | js::gc::GCRuntime::incrementalCollectSlice"
+        model._results.clear()
+        model._distance_columns.clear()
+        expected = model.top_similar_traces(stack_trace, 5)
+        hits = model._results.hits
+        self.assertEqual(model.top_similar_traces(stack_trace, 5), expected)
+        # the query is keyed on its normalized frames
+        self.assertEqual(model.top_similar_traces(stack_trace.upper() + ' | js::GCMarker::drainMarkStack', 5), expected)
+        self.assertEqual(model._results.hits, hits + 2)
+        self.assertEqual(len(model.top_similar_traces(stack_trace, 3)), 3)
+        self.assertEqual(model._results.hits, hits + 2)
+
+        # the distance columns of the words of the query are computed once
+        columns = len(model._distance_columns)
+        self.assertGreater(columns, 0)
+        model.top_similar_traces('js::GCMarker::processMarkStackTop', 5)
+        self.assertEqual(len(model._distance_columns), columns)
+        model._results.clear()
+        self.assertEqual(model.top_similar_traces(stack_trace, 5), expected)
+
+    def test_query_cache(self):
+        self.query_cache(self.doc2vec_model)
+        self.query_cache(self.word2vec_model)
+        self.assertNotEqual(self.doc2vec_model._model_version, self.word2vec_model._model_version)
+
+    def word_distances(self, model):
+        vectors = model._word_vectors()
+        indices = np.unique(model._corpus.token_ids)[::3]
+        expected = 1.0 - np.dot(vectors[indices], vectors[indices].transpose())
+        np.fill_diagonal(expected, 0)
+        model._frequent_distances.clear()
+        with mock.patch.object(base, 'FREQUENT_WORDS', 10):
+            np.testing.assert_allclose(model._word_distances(indices), expected, atol=1e-6)
+            self.assertEqual(len(model._frequent_word_distances()[0]), 10)
+        model._frequent_distances.clear()
+
+    def test_word_distances(self):
+        self.word_distances(self.doc2vec_model)
+        self.word_distances(self.word2vec_model)
+
+    def signature_similarity_union(self, model):
+        traces = list(set(json.loads(line)['proto_signature'] for line in open(self.paths[0])))[:30]
+        with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces[:15], traces[10:30]]):
+            similarities = model.signature_similarity(self.paths, 'signature1', 'signature2')
+        self.assertGreater(len(similarities), 0)
+
+        vocab = model.get_model().wv.vocab
+        vectors = model._word_vectors()
+        for doc1, doc2, distance in similarities:
+            indices1 = np.array([vocab[w].index for w in np.unique([w for w in StackTraceProcessor.preprocess(doc1) if w in vocab])], dtype=np.int32)
+            indices2 = np.array([vocab[w].index for w in StackTraceProcessor.preprocess(doc2) if w in vocab], dtype=np.int32)
+            all_distances = np.array(1.0 - np.dot(vectors, vectors[indices1].transpose()), dtype=np.double)
+            all_distances[indices1, np.arange(len(indices1))] = 0
+            if len(indices1) and len(indices2) and not all_distances[indices2].any():
+                # moving words at distance 0 of each other costs nothing
+                self.assertEqual(distance, 0.0)
+            else:
+                self.assertAlmostEqual(distance, model._wmd(indices1, indices2, all_distances), places=5)
+
+    def test_signature_similarity_union(self):
+        self.signature_similarity_union(self.doc2vec_model)
+        self.signature_similarity_union(self.word2vec_model)
+
+    def signature_similarity_same_words(self, model):
+        trace = 'js::GCMarker::processMarkStackTop'
+        traces = [trace, trace + ' | ' + trace, 'js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack']
+        for top, bottom in [(None, None), (1, 1)]:
+            with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces, traces]):
+                similarities = model.signature_similarity(self.paths, 'signature', 'signature', top, bottom)
+            # the traces with the same words are the most similar ones, not the most dissimilar ones
+            self.assertEqual(similarities[0], (trace, trace + ' | ' + trace, 0.0))
+            self.assertNotEqual(similarities[-1][2], 0.0)
+
+    def test_signature_similarity_same_words(self):
+        self.signature_similarity_same_words(self.doc2vec_model)
+        self.signature_similarity_same_words(self.word2vec_model)
+
+    def wmd_bounds(self, model):
+        traces = list(set(json.loads(line)['proto_signature'] for line in open(self.paths[0])))[:40]
+        vocab = model.get_model().wv.vocab
+        indices = [np.array([vocab[w].index for w in StackTraceProcessor.preprocess(trace) if w in vocab], dtype=np.int32) for trace in traces]
+        words = np.unique(np.concatenate(indices))
+        distances = model._word_distances(words)
+        positions1 = [np.unique(np.searchsorted(words, i)) for i in indices[:20]]
+        # a trace with the words of a query costs nothing to move, its upper bound is 0 and not inf
+        query = next(i for i, query_positions in enumerate(positions1) if len(query_positions))
+        positions2 = [np.searchsorted(words, i) for i in indices[20:]] + [positions1[query]]
+        lower, upper = model._wmd_bounds(distances, positions1, positions2)
+        for i, query_positions in enumerate(positions1):
+            for j, doc_positions in enumerate(positions2):
+                distance = model._trace_wmd(query_positions, doc_positions, distances[:, query_positions])
+                self.assertLessEqual(lower[i, j], distance + base.BOUND_TOLERANCE)
+                self.assertGreaterEqual(upper[i, j], distance - base.BOUND_TOLERANCE)
+        self.assertAlmostEqual(upper[query, -1], 0.0)
+
+    def test_wmd_bounds(self):
+        self.wmd_bounds(self.doc2vec_model)
+        self.wmd_bounds(self.word2vec_model)
+
+    def signature_similarity_top_bottom(self, model):
+        traces = list(set(json.loads(line)['proto_signature'] for line in open(self.paths[0])))[:60]
+        with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces[:30], traces[20:60]]):
+            similarities = model.signature_similarity(self.paths, 'signature1', 'signature2')
+        for top, bottom in [(3, 3), (1, None), (None, 5), (0, 2), (len(similarities), 1)]:
+            with mock.patch.object(StackTracesGetter, 'get_stack_traces_for_signature', side_effect=[traces[:30], traces[20:60]]), \
+                    mock.patch.object(model, '_wmd', wraps=model._wmd) as wmd:
+                selected = model.signature_similarity(self.paths, 'signature1', 'signature2', top, bottom)
+            expected = [similarity for k, similarity in enumerate(similarities) if k < (top or 0) or k >= len(similarities) - (bottom or 0)]
+            self.assertEqual([(doc1, doc2) for doc1, doc2, _ in selected], [(doc1, doc2) for doc1, doc2, _ in expected])
+            np.testing.assert_allclose([d for _, _, d in selected], [d for _, _, d in expected])
+            if (top or 0) + (bottom or 0) < 10:
+                self.assertLess(wmd.call_count, len(similarities))
+
+    def test_signature_similarity_top_bottom(self):
+        self.signature_similarity_top_bottom(self.doc2vec_model)
+        self.signature_similarity_top_bottom(self.word2vec_model)
+
+    def knn_graph(self, model):
+        expected = [model.nearest_traces(doc_id, 3) for doc_id in range(len(model._corpus))]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_dir = os.path.join(tmp_dir, 'knn')
+            graph = KNNGraph.build(model, 3, None, workers=2, checkpoint_dir=checkpoint_dir, chunk_size=100)
+            self.assertEqual(graph.neighbors.shape, (len(model._corpus), 3))
+            for doc_id, nearest in enumerate(expected):
+                nearest = [(other, distance) for other, distance in nearest if distance != float('inf')]
+                np.testing.assert_allclose(graph.distances[doc_id, :len(nearest)], [distance for _, distance in nearest])
+                self.assertNotIn(doc_id, graph.neighbors[doc_id].tolist())
+
+            # an interrupted job only searches the missing chunks
+            os.remove(KNNGraph._chunk_path(checkpoint_dir, 100))
+            with mock.patch.object(KNNGraph, '_nearest', wraps=KNNGraph._nearest) as nearest:
+                resumed = KNNGraph.build(model, 3, None, workers=1, checkpoint_dir=checkpoint_dir, chunk_size=100)
+                self.assertEqual(nearest.call_count, 1)
+            np.testing.assert_array_equal(resumed.distances, graph.distances)
+
+            clusters, _, timings = cluster_signatures(model, 3, 2, max_distance=10.0, min_links=1, workers=1)
+            self.assertEqual(set(timings), {'index', 'knn', 'cluster'})
+            self.assertGreater(len(clusters.clusters), 0)
+
+    def test_knn_graph(self):
+        self.knn_graph(self.doc2vec_model)
+        self.knn_graph(self.word2vec_model)
+
+    def pairwise_trace_distances(self, model):
+        traces = StackTracesGetter.get_local_stack_traces_for_signature(self.paths, 'OOM | small', 30)
+        distinct, pairs = model.pairwise_trace_distances(traces + traces[:5])
+        self.assertEqual(len(distinct), len(set(tuple(sorted(w for w in StackTraceProcessor.preprocess(t) if w in model.get_model().wv.vocab)) for t in traces)))
+        self.assertEqual([(i, j) for i, j, _ in pairs], [(i, j) for i in range(len(distinct)) for j in range(i + 1, len(distinct))])
+        vectors = model._word_vectors()
+        vocab = model.get_model().wv.vocab
+        for i, j, distance in pairs[:20]:
+            indices1 = np.unique([vocab[w].index for w in StackTraceProcessor.preprocess(distinct[i]) if w in vocab]).astype(np.int32)
+            indices2 = np.array([vocab[w].index for w in StackTraceProcessor.preprocess(distinct[j]) if w in vocab], dtype=np.int32)
+            all_distances = np.array(1.0 - np.dot(vectors, vectors[indices1].transpose()), dtype=np.double)
+            all_distances[indices1, np.arange(len(indices1))] = 0
+            if len(indices1) and len(indices2) and not all_distances[indices2].any():
+                # moving words at distance 0 of each other costs nothing
+                self.assertEqual(distance, 0.0)
+            else:
+                self.assertAlmostEqual(distance, model._wmd(indices1, indices2, all_distances), places=5)
+
+        # the same words in other numbers are another bag of words, and words at distance 0 are at distance 0, not inf
+        word1, word2 = [w for w in model.get_model().wv.index2word if StackTraceProcessor.preprocess(w) == [w]][:2]
+        distinct, pairs = model.pairwise_trace_distances([word1, word1 + ' | ' + word1, word2 + ' | ' + word1, word1 + ' | ' + word2 + ' | ' + word2])
+        self.assertEqual(len(distinct), 4)
+        self.assertEqual(pairs[0], (0, 1, 0.0))
+        self.assertGreater(pairs[-1][2], 0.0)
+        self.assertTrue(all(np.isfinite(distance) for _, _, distance in pairs))
+
+    def test_pairwise_trace_distances(self):
+        self.pairwise_trace_distances(self.doc2vec_model)
+        self.pairwise_trace_distances(self.word2vec_model)
+
+    def test_coherence_report(self):
+        signatures = StackTracesGetter.get_top_signatures(self.paths, 4)
+        report = coherence_report(self.word2vec_model, self.paths, signatures, workers=2, traces_num=20)
+        self.assertEqual(set(report['timings']), {'traces', 'coherence'})
+        self.assertEqual([row['signature'] for row in report['signatures']], signatures)
+        sequential = coherence_report(self.word2vec_model, self.paths, signatures, workers=1, traces_num=20)
+        for row, expected in zip(report['signatures'], sequential['signatures']):
+            self.assertEqual(set(row), set(REPORT_FIELDS))
+            self.assertEqual({k: v for k, v in row.items() if k != 'seconds'}, {k: v for k, v in expected.items() if k != 'seconds'})
+        self.assertGreater(report['signatures'][0]['pairs'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_report(report, os.path.join(tmp_dir, 'coherence.json'))
+            with open(os.path.join(tmp_dir, 'coherence.json')) as f:
+                self.assertEqual(json.load(f)['signatures'][0]['signature'], signatures[0])
+            write_report(report, os.path.join(tmp_dir, 'coherence.csv'))
+            with open(os.path.join(tmp_dir, 'coherence.csv')) as f:
+                self.assertEqual(len(f.readlines()), len(signatures) + 1)
+
     def read_corpus(self, model):
         resp = model._read_corpus()
         self.assertEqual(type(resp), list)
@@ -181,3 +663,110 @@ class CrashSimilarityTest(unittest.TestCase):
     def test_train_model(self):
         self.train_model(self.doc2vec_model)
         self.train_model(self.word2vec_model)
+
+    def test_incremental_update(self):
+        paths = [os.path.abspath(path) for path in self.paths]
+        today = datetime.now().strftime('%d%b%Y')
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%d%b%Y')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                model = word2vec.Word2Vec(paths)
+                # pretend that the model was trained yesterday, along with the arrays saved next to it
+                for name in os.listdir(model._models_dir()):
+                    os.rename(os.path.join(model._models_dir(), name), os.path.join(model._models_dir(), name.replace(today, yesterday)))
+
+                new_day = os.path.join(tmp_dir, 'new-day.json')
+                with open(new_day, 'w') as f:
+                    for i in range(10):
+                        f.write(json.dumps({'proto_signature': 'NewFrame | Other{} | js::GC'.format(i), 'uuid': str(i), 'signature': 'NewSignature'}) + '\n')
+                    # already in the corpus of the previous model
+                    f.write(next(open(paths[0])))
+
+                updated = word2vec.Word2Vec(paths + [new_day], incremental=True)
+                self.assertEqual(len(updated._corpus), len(model._corpus) + 10)
+                self.assertIn('newframe', updated.get_model().wv.vocab)
+                self.assertEqual(updated._corpus.sources, paths + [new_day])
+                self.assertEqual(updated.get_trace(len(updated._corpus) - 1)[1], 'newsignature')
+                self.assertTrue(os.path.exists(updated._model_path(today)))
+                self.assertTrue(os.path.exists(updated._corpus_path(today)))
+                self.assertFalse(os.path.exists(updated._model_path(yesterday)))
+            finally:
+                os.chdir(cwd)
+
+    def test_incremental_update_window(self):
+        paths = [os.path.abspath(path) for path in self.paths]
+        today = datetime.now().strftime('%d%b%Y')
+        yesterday = (datetime.now() - timedelta(days=1)).strftime('%d%b%Y')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                def write_day(name, prefix, signature):
+                    path = os.path.join(tmp_dir, name)
+                    with open(path, 'w') as f:
+                        for i in range(10):
+                            f.write(json.dumps({'proto_signature': '{}Frame | Other{} | js::GC'.format(prefix, i), 'uuid': prefix + str(i), 'signature': signature}) + '\n')
+                    return path
+
+                old_day = write_day('old-day.json', 'Old', 'OldSignature')
+                new_day = write_day('new-day.json', 'New', 'NewSignature')
+                model = word2vec.Word2Vec([old_day] + paths)
+                for name in os.listdir(model._models_dir()):
+                    os.rename(os.path.join(model._models_dir(), name), os.path.join(model._models_dir(), name.replace(today, yesterday)))
+
+                # the window moves forward one day, the traces of the day that left it are dropped
+                updated = word2vec.Word2Vec(paths + [new_day], incremental=True)
+                self.assertEqual(updated._corpus.sources, paths + [new_day])
+                self.assertEqual(len(updated._corpus), len(model._corpus))
+                signatures = [updated.get_trace(doc_id)[1] for doc_id in range(len(updated._corpus))]
+                self.assertNotIn('oldsignature', signatures)
+                self.assertEqual(signatures.count('newsignature'), 10)
+                similar = updated.top_similar_traces('OldFrame | Other1 | js::GC', 20)
+                self.assertNotIn('oldsignature', [updated.get_trace(doc_id)[1] for doc_id, _ in similar])
+            finally:
+                os.chdir(cwd)
+
+    def test_memory_mapped_vectors(self):
+        paths = [os.path.abspath(path) for path in self.paths]
+        today = datetime.now().strftime('%d%b%Y')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                trained = word2vec.Word2Vec(paths)
+                self.assertTrue(os.path.exists(trained._vectors_path(today)))
+                loaded = word2vec.Word2Vec(paths)
+                vectors = loaded._word_vectors()
+                self.assertIsInstance(vectors, np.memmap)
+                self.assertEqual(vectors.dtype, np.float32)
+                self.assertFalse(vectors.flags.writeable)
+                np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1, rtol=1e-5)
+
+                # training shuffles the corpus, so only the distances are comparable
+                query = 'js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack'
+                distances = [distance for _, distance in loaded.top_similar_traces(query, 5)]
+                self.assertEqual([distance for _, distance in trained.top_similar_traces(query, 5)], distances)
+
+                # models saved without their normalized vectors get them on the first load
+                os.remove(trained._vectors_path(today))
+                self.assertEqual([distance for _, distance in word2vec.Word2Vec(paths).top_similar_traces(query, 5)], distances)
+                self.assertTrue(os.path.exists(trained._vectors_path(today)))
+            finally:
+                os.chdir(cwd)
+
+    def test_streaming_corpus(self):
+        paths = [os.path.abspath(path) for path in self.paths]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            try:
+                for algo in [word2vec.Word2Vec, doc2vec.Doc2Vec]:
+                    model = algo(paths, corpus_dir=os.path.join(tmp_dir, 'corpus'))
+                    self.assertEqual(len(model._corpus), 378)
+                    self.assertEqual(101, len(model.get_model().wv.vocab))
+                    similarities = model.top_similar_traces('js::GCMarker::processMarkStackTop | js::GCMarker::drainMarkStack', 3)
+                    self.assertEqual(len(similarities), 3)
+            finally:
+                os.chdir(cwd)
@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from crashsimilarity.models import pool as pool_module
+from crashsimilarity.models.pool import SharedArray, WorkerPool, shared_array, task_array
+
+
+def take_shared(offset, item):
+    values, index = item
+    return int(task_array(values)[index]) + offset
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_fork(self):
+        values = np.arange(100, dtype=np.float32)
+        with WorkerPool(2, np.take, values, start_method='fork') as pool:
+            self.assertEqual(pool._blocks, [])
+            self.assertEqual(pool.map([1, 5, 99]), [1.0, 5.0, 99.0])
+            self.assertEqual(list(pool.imap(range(10), chunksize=3)), list(range(10)))
+
+    @unittest.skipIf(pool_module.shared_memory is None, 'shared memory needs Python 3.8+')
+    def test_spawn(self):
+        values = np.arange(100, dtype=np.int64).reshape(10, 10)
+        with WorkerPool(2, np.take, values, start_method='spawn') as pool:
+            names = [block.name for block in pool._blocks]
+            self.assertEqual(len(names), 1)
+            self.assertEqual(sorted(pool.imap_unordered([0, 42, 99])), [0, 42, 99])
+        # the shared memory blocks are released along with the pool
+        with self.assertRaises(FileNotFoundError):
+            pool_module.shared_memory.SharedMemory(names[0])
+
+    @unittest.skipIf(pool_module.shared_memory is None, 'shared memory needs Python 3.8+')
+    def test_shared_array(self):
+        values = np.random.RandomState(0).rand(3, 4)
+        block, handle = SharedArray.share(values)
+        try:
+            np.testing.assert_array_equal(handle.attach(), values)
+            empty_block, empty = SharedArray.share(np.zeros((0, 4)))
+            self.assertEqual(empty.attach().shape, (0, 4))
+            empty_block.close()
+            empty_block.unlink()
+        finally:
+            block.close()
+            block.unlink()
+
+    def test_spawn_without_shared_memory(self):
+        values = np.arange(10, dtype=np.int64)
+        with mock.patch.object(pool_module, 'shared_memory', None):
+            with WorkerPool(2, np.take, values, start_method='spawn') as pool:
+                self.assertEqual(pool._blocks, [])
+                self.assertEqual(pool.map([0, 3, 9]), [0, 3, 9])
+
+    @unittest.skipIf(pool_module.shared_memory is None, 'shared memory needs Python 3.8+')
+    def test_task_arrays(self):
+        with WorkerPool(2, take_shared, 1000, start_method='spawn') as pool:
+            for query in range(3):
+                values = np.arange(100, dtype=np.int64) * (query + 1)
+                with shared_array(values) as handle:
+                    self.assertIsInstance(handle, SharedArray)
+                    self.assertEqual(pool.map([(handle, i) for i in [0, 7, 99]]), [1000, 1000 + 7 * (query + 1), 1000 + 99 * (query + 1)])
+                # the block of a query is released once it is done
+                with self.assertRaises(FileNotFoundError):
+                    pool_module.shared_memory.SharedMemory(handle.name)
+
+    def test_task_arrays_without_shared_memory(self):
+        values = np.arange(10, dtype=np.int64)
+        with mock.patch.object(pool_module, 'shared_memory', None):
+            with shared_array(values) as handle:
+                self.assertIs(handle, values)
+                self.assertIs(task_array(handle), values)
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from crashsimilarity.models import quantization
+from crashsimilarity.models.quantization import QuantizedMatrix
+
+
+class QuantizedMatrixTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.matrix = rng.randn(500, 32).astype(np.float32)
+        self.matrix[7] = 0
+        self.query = rng.randn(32).astype(np.float32)
+
+    def test_build(self):
+        quantized = QuantizedMatrix.build(self.matrix, chunk_size=64)
+        self.assertEqual(len(quantized), 500)
+        self.assertEqual(quantized.codes.dtype, np.int8)
+        self.assertTrue(np.all(np.abs(quantized.codes.astype(np.float32) * quantized.scales[:, np.newaxis] - self.matrix) <= quantized.scales[:, np.newaxis] / 2 + 1e-6))
+        self.assertEqual(quantized.codes[7].tolist(), [0] * 32)
+
+    def test_dot_upper_bound(self):
+        quantized = QuantizedMatrix.build(self.matrix)
+        exact = np.dot(self.matrix, self.query)
+        upper = quantized.dot_upper_bound(self.query)
+        self.assertEqual(upper.dtype, np.float32)
+        self.assertTrue(np.all(upper >= exact - 1e-5))
+        self.assertLess(np.max(upper - exact), 1.0)
+        np.testing.assert_array_equal(quantized.dot_upper_bound(self.query, np.arange(10, 20)), upper[10:20])
+
+    def test_python_dot(self):
+        quantized = QuantizedMatrix.build(self.matrix)
+        native = quantization.native_dot_int8
+        try:
+            quantization.native_dot_int8 = None
+            python = quantized.dot_upper_bound(self.query)
+        finally:
+            quantization.native_dot_int8 = native
+        np.testing.assert_array_equal(quantized.dot_upper_bound(self.query), python)
@@ -0,0 +1,89 @@
+import json
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from crashsimilarity.server import QueryServer
+
+
+class StaticModel(object):
+    """Stands in for an EmbeddingAlgo so that the server can be tested without training"""
+
+    def __init__(self, name):
+        self.name = name
+        self.downloads = []
+
+    def get_model_name(self):
+        return self.name
+
+    def top_similar_traces(self, stack_trace, top=10):
+        return [(0, 0.0), (1, 0.5)][:top]
+
+    def get_trace(self, doc_id):
+        return ['frame{}'.format(doc_id)], 'sig{}'.format(doc_id)
+
+    def signature_similarity(self, paths, signature1, signature2, top=None, bottom=None, download=True):
+        self.downloads.append(download)
+        similarities = [(signature1 + ' | a', signature2 + ' | b', i / 10.) for i in range(5)]
+        return similarities[:top] + similarities[-bottom:]
+
+
+class QueryServerTest(unittest.TestCase):
+    def setUp(self):
+        self.loads = 0
+        self.server = QueryServer(('127.0.0.1', 0), self.load_model)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def load_model(self):
+        self.loads += 1
+        return StaticModel('Model{}'.format(self.loads)), ['dump.json']
+
+    def post(self, path, data=None):
+        request = Request(self.url + path, data=json.dumps(data or {}).encode('utf8'), headers={'Content-Type': 'application/json'})
+        with urlopen(request) as response:
+            return json.loads(response.read().decode('utf8'))
+
+    def test_status(self):
+        with urlopen(self.url + '/status') as response:
+            status = json.loads(response.read().decode('utf8'))
+        self.assertEqual(status['model'], 'Model1')
+        self.assertEqual(status['paths'], ['dump.json'])
+
+    def test_top_similar_traces(self):
+        resp = self.post('/top_similar_traces', {'stack_trace': 'a | b', 'top': 1})
+        self.assertEqual(resp, [{'doc_id': 0, 'distance': 0.0, 'signature': 'sig0', 'trace': ['frame0']}])
+
+    def test_signature_similarity(self):
+        resp = self.post('/signature_similarity', {'signature1': 's1', 'signature2': 's2', 'top': 2})
+        self.assertEqual([s['distance'] for s in resp['top']], [0.0, 0.1])
+        self.assertEqual([s['distance'] for s in resp['bottom']], [0.3, 0.4])
+        self.assertEqual(resp['top'][0]['trace1'], 's1 | a')
+        self.assertEqual(resp['top'][0]['trace2'], 's2 | b')
+        resp = self.post('/signature_coherence', {'signature': 's1', 'top': 1})
+        self.assertEqual(resp['top'][0]['trace2'], 's1 | b')
+        # the traces are read from the local crash dumps
+        self.assertEqual(self.server.snapshot()[0].downloads, [False, False])
+
+    def test_download_traces(self):
+        self.server.download_traces = True
+        self.post('/signature_coherence', {'signature': 's1', 'top': 1})
+        self.assertEqual(self.server.snapshot()[0].downloads, [True])
+
+    def test_reload(self):
+        resp = self.post('/reload')
+        self.assertEqual(resp['model'], 'Model2')
+        self.assertEqual(self.loads, 2)
+
+    def test_errors(self):
+        with self.assertRaises(HTTPError) as ctx:
+            self.post('/top_similar_traces', {'top': 1})
+        self.assertEqual(ctx.exception.code, 400)
+        with self.assertRaises(HTTPError) as ctx:
+            self.post('/unknown')
+        self.assertEqual(ctx.exception.code, 404)
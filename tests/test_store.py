@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from crashsimilarity import store as store_module
+from crashsimilarity import utils
+from crashsimilarity.stacktrace import StackTraceProcessor
+from crashsimilarity.store import TraceStore
+
+
+class TraceStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'test.json')
+        shutil.copy('tests/test.json', self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_open(self):
+        crashes = [json.loads(line) for line in utils.read_files([self.path])]
+        store = TraceStore.open(self.path)
+        self.assertTrue(os.path.isdir(TraceStore.path(self.path)))
+        self.assertIsInstance(store.frames, np.memmap)
+        self.assertEqual(len(store), len(crashes))
+        self.assertEqual([store.proto_signature(row) for row in range(len(store))], [crash['proto_signature'] for crash in crashes])
+        self.assertEqual([store.signature(row) for row in range(len(store))], [crash['signature'] for crash in crashes])
+        self.assertEqual([store.uuid(row) for row in range(len(store))], [crash['uuid'] for crash in crashes])
+
+        signature = crashes[0]['signature']
+        self.assertEqual(store.rows_with_signature(signature).tolist(), [i for i, crash in enumerate(crashes) if crash['signature'] == signature])
+        self.assertEqual(len(store.rows_with_signature('no such signature')), 0)
+
+        frame = 'js::gcmarker::processmarkstacktop'
+        expected = [i for i, crash in enumerate(crashes) if frame in StackTraceProcessor.preprocess(crash['proto_signature'])]
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(store.rows_with_frame(frame).tolist(), expected)
+        self.assertEqual(len(store.rows_with_frame('no such frame')), 0)
+
+        # the index is persisted along with the columns
+        self.assertIs(TraceStore.open(self.path), store)
+        TraceStore._opened.clear()
+        self.assertEqual(TraceStore.open(self.path).rows_with_frame(frame).tolist(), expected)
+
+    def test_open_converts_changed_dump(self):
+        rows = len(TraceStore.open(self.path))
+        with open(self.path, 'a') as f:
+            f.write('\n' + json.dumps({'proto_signature': 'new | frame', 'uuid': 'new', 'signature': 'new'}) + '\n')
+        os.utime(self.path, (0, 0))
+        store = TraceStore.open(self.path)
+        self.assertEqual(len(store), rows + 1)
+        self.assertEqual(store.proto_signature(rows), 'new | frame')
+
+    def test_save(self):
+        store = TraceStore.open(self.path)
+        store_path = TraceStore.path(self.path)
+        self.assertTrue(os.path.islink(store_path))
+        first = os.path.realpath(store_path)
+        proto_signature = store.proto_signature(0)
+
+        # concurrent conversions of the same dump each write their own directory
+        converted = TraceStore.convert(self.path)
+        source = TraceStore._source(self.path)
+        threads = [threading.Thread(target=converted.save, args=(store_path, source)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertNotEqual(os.path.realpath(store_path), first)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(TraceStore.load(store_path)[0].proto_signature(0), proto_signature)
+        self.assertFalse(any(name.endswith('.link') for name in os.listdir(self.tmp_dir)))
+        # the store mapped before the conversion can still be read
+        self.assertEqual(store.proto_signature(0), proto_signature)
+
+        # a store saved as a directory is replaced too
+        current = os.path.realpath(store_path)
+        os.remove(store_path)
+        shutil.copytree(current, store_path)
+        converted.save(store_path, source)
+        self.assertTrue(os.path.islink(store_path))
+        self.assertEqual(TraceStore.load(store_path)[0].proto_signature(0), proto_signature)
+
+    def test_opened_stores(self):
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(self.tmp_dir, 'day{}.json'.format(i)))
+            shutil.copy(self.path, paths[-1])
+        TraceStore._opened.clear()
+        with mock.patch.object(store_module, 'OPENED_STORES', 2):
+            first = TraceStore.open(paths[0])
+            TraceStore.open(paths[1])
+            self.assertIs(TraceStore.open(paths[0]), first)
+            TraceStore.open(paths[2])
+        self.assertEqual(list(TraceStore._opened), [paths[0], paths[2]])
+
+    def test_process_stores(self):
+        for take in [None, 3, 10]:
+            self.assertEqual(list(StackTraceProcessor.process_stores([self.path], take)),
+                             list(StackTraceProcessor.process(utils.read_files([self.path]), take)))
+        duplicates = set()
+        expected = set()
+        list(StackTraceProcessor.process_stores([self.path], 10, duplicates=duplicates))
+        list(StackTraceProcessor.process(utils.read_files([self.path]), 10, duplicates=expected))
+        self.assertEqual(duplicates, expected)
+        # some traces of the dump are shared by several signatures
+        self.assertGreater(len(set(signature for _, signature in duplicates)), 1)
+        selected = set()
+        self.assertGreater(len(list(StackTraceProcessor.process_stores([self.path], 10, selected))), 0)
+        self.assertEqual(list(StackTraceProcessor.process_stores([self.path], 10, selected)), [])
+
+    def test_process_stores_in_parallel(self):
+        paths = [self.path]
+        lines = [line.rstrip('\n') for line in utils.read_files([self.path])]
+        for i, shard in enumerate([lines[:200], lines[150:400], lines[300:]]):
+            paths.append(os.path.join(self.tmp_dir, 'shard{}.json'.format(i)))
+            with open(paths[-1], 'w') as f:
+                f.write('\n'.join(shard) + '\n')
+        duplicates = set()
+        expected_duplicates = set()
+        expected = list(StackTraceProcessor.process(utils.read_files(paths), 10, duplicates=expected_duplicates))
+        self.assertEqual(list(StackTraceProcessor.process_stores(paths, 10, workers=3, duplicates=duplicates)), expected)
+        self.assertEqual(duplicates, expected_duplicates)
+        self.assertTrue(all(os.path.isdir(TraceStore.path(path)) for path in paths))
+        selected = set()
+        self.assertEqual(list(StackTraceProcessor.process_stores(paths[1:], 10, selected, workers=2)),
+                         list(StackTraceProcessor.process_stores(paths[1:], 10)))
+        self.assertEqual(list(StackTraceProcessor.process_stores(paths, 10, selected, workers=2)), [])
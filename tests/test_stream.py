@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+import numpy as np
+
+from crashsimilarity import utils
+from crashsimilarity.models.corpus import TraceCorpus
+from crashsimilarity.models.stream import HashSet, StreamingCorpus
+from crashsimilarity.stacktrace import StackTraceProcessor
+
+Vocab = namedtuple('Vocab', 'index')
+
+
+class HashSetTest(unittest.TestCase):
+    def test_contains(self):
+        hashes = HashSet([3, 2 ** 64 - 1, 7])
+        self.assertIn(2 ** 64 - 1, hashes)
+        self.assertIn(7, hashes)
+        self.assertNotIn(5, hashes)
+        hashes.add(5)
+        self.assertIn(5, hashes)
+        self.assertEqual(len(hashes), 4)
+        hashes.flush()
+        self.assertIn(5, hashes)
+        self.assertNotIn(2 ** 64 - 2, hashes)
+        self.assertEqual(len(hashes), 4)
+
+    def test_empty(self):
+        self.assertNotIn(0, HashSet())
+
+
+class StreamingCorpusTest(unittest.TestCase):
+    paths = ['tests/test.json']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.corpus_dir = os.path.join(self.tmp_dir, 'corpus')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ingest(self):
+        expected = list(StackTraceProcessor.process(utils.read_files(self.paths), 10))
+        corpus = StreamingCorpus.ingest(self.paths, self.corpus_dir, block_size=50, seed=0)
+        self.assertEqual(len(corpus), len(expected))
+        self.assertEqual(corpus.sources, self.paths)
+        for doc_id, (trace, signature) in enumerate(expected):
+            self.assertEqual(corpus[doc_id].words, trace)
+            self.assertEqual(corpus[doc_id].tags, [doc_id, signature])
+
+    def test_iter(self):
+        corpus = StreamingCorpus.ingest(self.paths, self.corpus_dir, block_size=50, seed=0)
+        first = list(corpus)
+        second = list(corpus)
+        self.assertEqual(sorted(doc.tags[0] for doc in first), list(range(len(corpus))))
+        self.assertNotEqual([doc.tags[0] for doc in first], [doc.tags[0] for doc in second])
+        for doc in first:
+            self.assertEqual(doc, corpus[doc.tags[0]])
+        self.assertEqual(sorted(map(tuple, corpus.sentences())), sorted(tuple(doc.words) for doc in first))
+
+    def test_resume(self):
+        StreamingCorpus.ingest(self.paths, self.corpus_dir)
+        # an interrupted ingestion leaves uncommitted data behind
+        with open(os.path.join(self.corpus_dir, 'tokens.bin'), 'ab') as f:
+            f.write(b'garbage')
+        with open(os.path.join(self.corpus_dir, 'frames.jsonl'), 'ab') as f:
+            f.write(b'"garbage"\n')
+
+        new_day = os.path.join(self.tmp_dir, 'new-day.json')
+        with open(new_day, 'w') as f:
+            f.write(json.dumps({'proto_signature': 'NewFrame | js::GC', 'uuid': '1', 'signature': 'NewSignature'}) + '\n')
+            f.write(next(open(self.paths[0])))
+
+        corpus = StreamingCorpus.ingest(self.paths + [new_day], self.corpus_dir)
+        self.assertEqual(corpus.sources, self.paths + [new_day])
+        self.assertEqual(len(corpus), len(list(StackTraceProcessor.process(utils.read_files(self.paths), 10))) + 1)
+        self.assertEqual(corpus[len(corpus) - 1].words, ['newframe', 'js::gc'])
+        self.assertNotIn('garbage', corpus.frames)
+        self.assertEqual(corpus.offsets[-1], len(corpus.tokens))
+
+    def test_window(self):
+        days = []
+        for day, frames in enumerate([['A', 'B', 'C'], ['A', 'D', 'E'], ['D', 'F', 'G']]):
+            days.append(os.path.join(self.tmp_dir, 'day{}.json'.format(day)))
+            with open(days[-1], 'w') as f:
+                for i, frame in enumerate(frames):
+                    # the first trace of a day is also in the previous day
+                    f.write(json.dumps({'proto_signature': '{} | js::GC'.format(frame), 'uuid': str(i), 'signature': frame}) + '\n')
+
+        first = StreamingCorpus.ingest(days[:2], self.corpus_dir)
+        self.assertEqual(len(first), 5)
+        corpus = StreamingCorpus.ingest(days[1:], self.corpus_dir)
+        self.assertEqual(corpus.sources, days[1:])
+        # the traces of the dropped day are gone, the ones it shared with the window are kept
+        expected = StreamingCorpus.ingest(days[1:], os.path.join(self.tmp_dir, 'expected'))
+        self.assertEqual([corpus[doc_id] for doc_id in range(len(corpus))], [expected[doc_id] for doc_id in range(len(expected))])
+        self.assertEqual(sorted(doc.words[0] for doc in corpus), ['a', 'd', 'e', 'f', 'g'])
+        # the temporary directories of the rebuild are removed
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp_dir) if not name.startswith('day')), ['corpus', 'expected'])
+        # the old corpus can still be read by the processes that mapped it
+        self.assertEqual(first[4].words, ['e', 'js::gc'])
+
+    def test_to_trace_corpus(self):
+        corpus = StreamingCorpus.ingest(self.paths, self.corpus_dir)
+        vocab = {frame: Vocab(i) for i, frame in enumerate(corpus.frames[::2])}
+        duplicates = set()
+        list(StackTraceProcessor.process_stores(self.paths, 10, duplicates=duplicates))
+        expected = TraceCorpus.build([corpus[doc_id] for doc_id in range(len(corpus))], vocab, self.paths, duplicates)
+        actual = corpus.to_trace_corpus(vocab)
+        for name in ['token_ids', 'offsets', 'signature_ids', 'hashes', 'duplicate_hashes', 'duplicate_signature_ids']:
+            self.assertEqual(getattr(actual, name).tolist(), getattr(expected, name).tolist())
+        self.assertEqual(actual.signatures, expected.signatures)
+        self.assertEqual(actual.sources, expected.sources)
+        self.assertEqual(actual.token_ids.dtype, np.int32)
@@ -4,7 +4,8 @@ import json
 from datetime import datetime
 
 from crashsimilarity import utils
-from crashsimilarity.stacktrace import StackTracesGetter, StackTraceProcessor
+from crashsimilarity.models.distances import native_edit_distances
+from crashsimilarity.stacktrace import FrameTable, StackTracesGetter, StackTraceProcessor
 
 
 class UtilsTest(unittest.TestCase):
@@ -50,11 +51,50 @@ class StackTraceProcessorTest(unittest.TestCase):
         actual = StackTraceProcessor.preprocess(stack_trace, 3)
         self.assertEqual(actual, expected[:3])
 
+    def test_trace_hash(self):
+        self.assertEqual(StackTraceProcessor.trace_hash(['a', 'b', 'c']), StackTraceProcessor.trace_hash(['c', 'a', 'b', 'a']))
+        self.assertNotEqual(StackTraceProcessor.trace_hash(['a', 'b', 'c']), StackTraceProcessor.trace_hash(['a', 'b']))
+        self.assertLess(StackTraceProcessor.trace_hash(['a', 'b', 'c']), 2 ** 64)
+
     def test_process(self):
         actual = list(StackTraceProcessor.process(self.raw_traces))
         self.assertEqual(actual, self.expected_traces)
 
 
+class FrameTableTest(unittest.TestCase):
+    proto_signatures = ['a | CAPITAL_LETTERS | c', 'with | name@0xAddr | drop', 'with | xul.dll@', 'A@0X12 | b\n | XUL@0x1',
+                        ' x | y@0x1@0x2 | z ', '', 'a | | b', ' | ', 'x |  | y', '\u00e9@0x\u00c9 | \u00dc | a', 'a | CAPITAL_LETTERS | e']
+
+    def check_normalize(self, frame_table):
+        for take in [None, 1, 2]:
+            ids, offsets, skipped = frame_table.normalize(self.proto_signatures, take)
+            self.assertEqual(len(offsets), len(self.proto_signatures) + 1)
+            for i, proto_signature in enumerate(self.proto_signatures):
+                self.assertEqual(skipped[i], StackTraceProcessor.should_skip(proto_signature))
+                frames = [frame_table.normalized_frames[j] for j in ids[offsets[i]:offsets[i + 1]]]
+                self.assertEqual(frames, StackTraceProcessor.preprocess(proto_signature, take))
+        self.assertEqual(len(frame_table.normalized_frames), len(set(frame_table.normalized_frames)))
+
+    def test_normalize(self):
+        frame_table = FrameTable()
+        if native_edit_distances is not None:
+            # the native normalizer builds wherever the other extensions do
+            self.assertIsNotNone(frame_table._normalizer)
+        self.check_normalize(frame_table)
+
+    def test_normalize_without_native_normalizer(self):
+        frame_table = FrameTable()
+        frame_table._normalizer = None
+        self.check_normalize(frame_table)
+
+    def test_intern(self):
+        frame_table = FrameTable()
+        ids, lengths = frame_table.intern(['a | b@0x1', 'b@0x2 | a'])
+        self.assertEqual(lengths.tolist(), [2, 2])
+        self.assertEqual([frame_table.raw_frames[i] for i in ids], ['a', 'b@0x1', 'b@0x2', 'a'])
+        self.assertEqual([frame_table.normalized_frames[i] for i in frame_table.normalized_ids(ids)], ['a', 'b@0x', 'b@0x', 'a'])
+
+
 class StackTracesGetterTest(unittest.TestCase):
     paths = ['tests/test.json']
 